@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the logging and monitoring of tedega_share.
+
+The records are sent to a local :class:`tedega_share.testing.FakeFluentd`.
+For every combination of payload size, number of threads and transport
+the benchmark reports
+
+* the throughput in messages per second,
+* the percentiles of the latency of a single logging call,
+* the bytes allocated and not yet freed per call (difference of
+  tracemalloc snapshots) and the peak of the memory allocated during
+  one call and
+* the fraction of the records which arrived at the fake fluentd.
+
+Further the costs of :func:`log_proctime`, :func:`build_tag` and of the
+monitors are measured. The overhead of the :func:`log_proctime` wrapper
+against the undecorated function is checked against
+:data:`PROCTIME_OVERHEAD_BUDGET`, the benchmark exits with status 1 if
+it is exceeded. The console output of the root logger is
+disabled for the logger of the benchmark.
+
+Usage::
+
+        python benchmarks/bench_logging.py [--quick] [--json FILE]
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from time import perf_counter_ns
+
+from tedega_share import logger as tedega_logger
+from tedega_share.connectivity import ConnectivityProber
+from tedega_share.logger import build_tag, get_logger, init_logger, log_proctime
+from tedega_share.metrics import Histogram
+from tedega_share.monitor import get_scheduler
+from tedega_share.system import SystemSampler
+from tedega_share.testing import FakeFluentd
+
+PAYLOADS = {
+    "small": {"message": "x" * 16},
+    "medium": {"message": "x" * 512, "items": list(range(64)), "user": "benchmark"},
+    "large": {"message": "x" * 16384},
+}
+TRANSPORTS = [("forward", False), ("packed", False), ("forward", True), ("packed", True)]
+ALLOCATION_CALLS = 200
+#: Maximum overhead of :func:`log_proctime` with aggregation per call in
+#: ns. About 600 to 800 ns are measured with CPython 3.11.
+PROCTIME_OVERHEAD_BUDGET = 1000
+
+_services = itertools.count()
+
+
+def measure(func, count):
+    """Call the function `count` times.
+
+    :returns: Tuple with the :class:`Histogram` of the latencies in ns
+    and the total time in ns.
+    """
+    histogram = Histogram()
+    record = histogram.record
+    started_at = perf_counter_ns()
+    for _ in range(count):
+        call_started_at = perf_counter_ns()
+        func()
+        record(perf_counter_ns() - call_started_at)
+    return histogram, perf_counter_ns() - started_at
+
+
+def allocations(func, count=ALLOCATION_CALLS):
+    """Will return the bytes allocated and not yet freed per call of the
+    function, from the difference of tracemalloc snapshots before and
+    after all calls, and the average peak of the memory allocated
+    during one call in bytes."""
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    tracemalloc.start()
+    try:
+        # The first call may allocate caches.
+        func()
+        before = tracemalloc.take_snapshot().filter_traces(filters)
+        peak = 0
+        for _ in range(count):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            func()
+            peak += tracemalloc.get_traced_memory()[1] - current
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+    finally:
+        tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return {"allocated": allocated / count, "peak": peak / count}
+
+
+def result(name, histogram, elapsed, calls, **extra):
+    stats = histogram.stats(scale=1e3)
+    row = {"name": name,
+           "ops": calls / (elapsed / 1e9) if elapsed else 0,
+           "p50": stats.get("p50"),
+           "p99": stats.get("p99"),
+           "max": stats.get("max")}
+    row.update(extra)
+    return row
+
+
+def bench_logger(payload, threads, transport, asynchronous, count, fluentd):
+    """Log `count` messages of the payload in every thread."""
+    service = "benchmark%d" % next(_services)
+    init_logger(service, host=fluentd.host, port=fluentd.port,
+                transport=transport, asynchronous=asynchronous,
+                queue_size=count * threads + ALLOCATION_CALLS)
+    logger = logging.getLogger(build_tag(service))
+    logger.propagate = False
+    log = get_logger()
+    message = PAYLOADS[payload]
+    received = fluentd.stats["events"]
+
+    def call():
+        log.info(message, "CUSTOM")
+
+    allocated = allocations(call)
+    histograms = []
+
+    def worker():
+        histograms.append(measure(call, count)[0])
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started_at = perf_counter_ns()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = perf_counter_ns() - started_at
+
+    for handler in list(logger.handlers):
+        handler.close()
+        logger.removeHandler(handler)
+    sent = count * threads + ALLOCATION_CALLS
+    fluentd.wait_for(received + sent, timeout=10)
+    histogram = Histogram()
+    for item in histograms:
+        histogram.merge(item)
+    name = "log %s payload, %d threads, %s%s" % (
+        payload, threads, transport, " async" if asynchronous else "")
+    return result(name, histogram, elapsed, count * threads,
+                  delivered=(fluentd.stats["events"] - received) / sent, **allocated)
+
+
+def bench_disabled(count, fluentd):
+    service = "benchmark%d" % next(_services)
+    init_logger(service, host=fluentd.host, port=fluentd.port)
+    logger = logging.getLogger(build_tag(service))
+    logger.propagate = False
+    log = get_logger()
+    payload = PAYLOADS["large"]
+
+    def call():
+        log.debug(payload)
+    try:
+        return result("log disabled level", *measure(call, count), count,
+                      **allocations(call))
+    finally:
+        for handler in list(logger.handlers):
+            handler.close()
+            logger.removeHandler(handler)
+
+
+def overhead(func, baseline, count, runs=16):
+    """Will return the time in ns which one call of the function takes
+    longer than one call of the baseline. Like timeit, the garbage
+    collector is disabled and the fastest of several alternating runs
+    is taken to filter out noise."""
+    def total(call):
+        started_at = perf_counter_ns()
+        for _ in range(count):
+            call()
+        return perf_counter_ns() - started_at
+
+    gc.disable()
+    try:
+        times = [(total(func), total(baseline)) for _ in range(runs)][1:]
+    finally:
+        gc.enable()
+    return (min(t[0] for t in times) - min(t[1] for t in times)) / count
+
+
+def bench_proctime(count):
+    tedega_logger.aggregate_proctime(interval=3600)
+
+    def noop():
+        pass
+    func = log_proctime(noop)
+    try:
+        return result("log_proctime aggregated", *measure(func, count), count,
+                      overhead=overhead(func, noop, min(count, 20000)), **allocations(func))
+    finally:
+        get_scheduler().unregister("proctime")
+        tedega_logger.proctime_aggregator = None
+
+
+def bench_build_tag(count):
+    def call():
+        build_tag("benchmark")
+    return result("build_tag", *measure(call, count), count, **allocations(call))
+
+
+def bench_system(count):
+    sampler = SystemSampler()
+    return result("SystemSampler.sample", *measure(sampler.sample, count), count)
+
+
+def bench_connectivity(count, fluentd):
+    # Reachable and refused hosts
+    prober = ConnectivityProber([(fluentd.host, fluentd.port), ("127.0.0.1", 1)] * 10)
+    try:
+        return result("connectivity 20 hosts", *measure(prober.check, count), count)
+    finally:
+        prober.close()
+
+
+def run(quick=False, latency=0.0, failure_rate=0.0, selection=None):
+    count = 2000 if quick else 20000
+    thread_counts = [1, 4] if quick else [1, 4, 16]
+    payloads = ["small", "large"] if quick else list(PAYLOADS)
+    rows = []
+    with FakeFluentd(keep=False, latency=latency, failure_rate=failure_rate) as fluentd:
+        for transport, asynchronous in TRANSPORTS:
+            for payload in payloads:
+                for threads in thread_counts:
+                    rows.append(bench_logger(payload, threads, transport, asynchronous,
+                                             count // threads, fluentd))
+        rows.append(bench_disabled(count * 10, fluentd))
+        rows.append(bench_proctime(count * 10))
+        rows.append(bench_build_tag(count))
+        rows.append(bench_system(10 if quick else 100))
+        rows.append(bench_connectivity(5 if quick else 20, fluentd))
+    if selection:
+        rows = [row for row in rows if selection in row["name"]]
+    return rows
+
+
+def _format(value, pattern):
+    return pattern % value if value is not None else "-"
+
+
+def report(rows, out=sys.stdout):
+    out.write("%-45s %12s %10s %10s %10s %10s %10s %9s %12s\n" % (
+        "benchmark", "ops/s", "p50 us", "p99 us", "max us", "alloc B", "peak B",
+        "delivered", "overhead ns"))
+    for row in rows:
+        out.write("%-45s %12s %10s %10s %10s %10s %10s %9s %12s\n" % (
+            row["name"], _format(row["ops"], "%.0f"),
+            _format(row["p50"], "%.2f"), _format(row["p99"], "%.2f"),
+            _format(row["max"], "%.0f"), _format(row.get("allocated"), "%.0f"),
+            _format(row.get("peak"), "%.0f"), _format(row.get("delivered"), "%.3f"),
+            _format(row.get("overhead"), "%.0f")))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--quick", action="store_true", help="Fewer iterations and variants")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds the fake fluentd waits per message")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="Probability that the fake fluentd drops the connection")
+    parser.add_argument("--filter", help="Only report benchmarks containing this text")
+    parser.add_argument("--json", help="Write the results as JSON into this file")
+    args = parser.parse_args(argv)
+    started_at = time.time()
+    rows = run(args.quick, args.latency, args.failure_rate, args.filter)
+    report(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"time": started_at, "python": sys.version, "results": rows}, f, indent=2)
+    exceeded = [row for row in rows if row.get("overhead", 0) > PROCTIME_OVERHEAD_BUDGET]
+    for row in exceeded:
+        sys.stderr.write("%s: overhead of %.0f ns exceeds the budget of %d ns\n" % (
+            row["name"], row["overhead"], PROCTIME_OVERHEAD_BUDGET))
+    if exceeded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,48 @@
 # -*- coding: utf-8 -*-
-from .logger import get_logger, init_logger, log_proctime, monitor_system, monitor_connectivity
+"""
+The public API is loaded lazily on first access, so importing the
+package (e.g only for :mod:`tedega_share.lib.security`) does not import
+the logger and its dependencies.
+"""
+import importlib
 
-__all__ = [get_logger, init_logger, log_proctime, monitor_connectivity, monitor_system]
+#: Name of the module of every public function
+_API = {
+    "get_logger": ".logger",
+    "init_logger": ".logger",
+    "log_proctime": ".logger",
+    "aggregate_proctime": ".logger",
+    "track_concurrency": ".logger",
+    "aggregate_concurrency": ".logger",
+    "monitor_system": ".logger",
+    "monitor_container": ".logger",
+    "monitor_memory": ".logger",
+    "monitor_runtime": ".logger",
+    "monitor_connectivity": ".logger",
+    "share_monitoring": ".logger",
+    "deduplicate": ".logger",
+    "buffer_requests": ".logger",
+    "export_metrics": ".logger",
+    "adapt_logging": ".logger",
+    "profile": ".logger",
+    "span": ".tracing",
+}
+
+__all__ = list(_API)
 
 __author__ = """Torsten Irländer"""
 __email__ = 'torsten.irlaender@googlemail.com'
 __version__ = '0.1.0'
+
+
+def __getattr__(name):
+    module = _API.get(name)
+    if module is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_API))
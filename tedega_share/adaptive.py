@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Adaptive log verbosity under backpressure.
+
+If the service is overloaded, writing every log message makes it worse.
+The :class:`AdaptiveController` is a filter for the
+:class:`tedega_share.logger.Logger` and a probe of the monitor
+scheduler which watches
+
+* the fill level of the queues of the asynchronous handlers,
+* the lag of the senders, the age of the oldest queued record, and
+* the CPU usage since the last run, e.g from a
+  :class:`tedega_share.system.CpuMeter`,
+
+and steps through a list of stages as the pressure rises. Every stage
+maps levels and categories to the fraction of their messages which are
+kept. The default stages drop DEBUG messages first and then sample
+*REQUEST* and *PROCTIME* messages with decreasing rates. Messages of
+level ERROR or higher and *AUTH* messages are never dropped.
+
+If any input exceeds its high threshold the controller steps up one
+stage per run. It steps down one stage after all inputs stayed below
+their low thresholds for `recover_after` runs. Every change of the
+stage is logged as *CUSTOM* WARNING message with the inputs::
+
+        {"message": "Logging stage changed", "stage": 2, "previous": 1,
+         "rates": {"DEBUG": 0.0, "REQUEST": 0.5, "PROCTIME": 0.5},
+         "queue": 0.62, "lag": 0.4, "cpu": 93.5}
+
+As with the :class:`tedega_share.sampling.Sampler` the decision depends
+on the correlation_id of the message, so all messages of a request are
+either kept or dropped, and kept messages carry their `sample_rate`.
+"""
+
+import logging
+
+from .handler import AsyncHandler
+from .monitor import Probe
+from .sampling import Policy
+
+#: Rates of the messages by level or category for every stage
+DEFAULT_STAGES = [
+    {},
+    {logging.DEBUG: 0.0},
+    {logging.DEBUG: 0.0, "REQUEST": 0.5, "PROCTIME": 0.5},
+    {logging.DEBUG: 0.0, "REQUEST": 0.1, "PROCTIME": 0.1},
+    {logging.DEBUG: 0.0, "REQUEST": 0.01, "PROCTIME": 0.01},
+]
+
+#: Categories which are never dropped
+PROTECTED_CATEGORIES = ("AUTH",)
+
+
+class AdaptiveController(Probe):
+    """Filter which reduces the logged messages as the pressure on the
+    logging rises."""
+
+    def __init__(self, logger, stages=None, queue=(0.1, 0.5), lag=(0.2, 1.0),
+                 cpu=(70.0, 90.0), recover_after=3, get_cpu=None, interval=5,
+                 name="adaptive"):
+        """
+        :logger: :class:`tedega_share.logger.Logger`
+        :stages: List of dictionaries with the rate of the messages by
+        level or category. Defaults to :data:`DEFAULT_STAGES`.
+        :queue: Tuple of the low and high fill level (0 - 1) of the
+        queues
+        :lag: Tuple of the low and high lag of the senders in seconds
+        :cpu: Tuple of the low and high CPU usage in percent
+        :recover_after: Number of runs with low pressure before stepping
+        down a stage
+        :get_cpu: Function which returns the current CPU usage or None
+        :interval: Pressure is checked every X seconds
+        """
+        Probe.__init__(self, name, interval)
+        self.logger = logger
+        self.queue = queue
+        self.lag = lag
+        self.cpu = cpu
+        self.recover_after = recover_after
+        self.get_cpu = get_cpu
+        self.rates = stages if stages is not None else DEFAULT_STAGES
+        self._stages = [self._policies(rates) for rates in self.rates]
+        self.stage = 0
+        self._policies_of_stage = self._stages[0]
+        self._calm = 0
+        self._dropped = 0
+
+    def _policies(self, rates):
+        policies = {}
+        for key, rate in rates.items():
+            if key in PROTECTED_CATEGORIES or (isinstance(key, int) and key >= logging.ERROR):
+                raise ValueError("{} messages can not be dropped.".format(key))
+            policies[key] = Policy(rate, by_correlation_id=True)
+        return policies
+
+    def filter(self, entry):
+        policies = self._policies_of_stage
+        if not policies or entry.level >= logging.ERROR:
+            return True
+        if entry.category in PROTECTED_CATEGORIES:
+            return True
+        rate = 1.0
+        for key in (entry.level, entry.category):
+            policy = policies.get(key)
+            if policy is not None:
+                rate *= policy.sample(entry.correlation_id)
+                if not rate:
+                    self._dropped += 1
+                    return False
+        if rate < 1:
+            if entry.extra is None:
+                entry.extra = {}
+            entry.extra["sample_rate"] = entry.extra.get("sample_rate", 1.0) * rate
+        return True
+
+    def pressure(self):
+        """Will return a dictionary with the highest fill level of the
+        queues, the highest lag of the senders and the CPU usage."""
+        queue = lag = 0.0
+        for handler in self.logger._logger.handlers:
+            if isinstance(handler, AsyncHandler):
+                queue = max(queue, handler.stats()["queued"] / float(handler.maxsize))
+                lag = max(lag, handler.lag())
+        cpu = self.get_cpu() if self.get_cpu is not None else None
+        return {"queue": round(queue, 3), "lag": round(lag, 3), "cpu": cpu}
+
+    def run(self):
+        pressure = self.pressure()
+        cpu = pressure["cpu"]
+        if cpu is None:
+            cpu = self.cpu[0]
+        values = (pressure["queue"], pressure["lag"], cpu)
+        limits = (self.queue, self.lag, self.cpu)
+        high = any(value >= limit[1] for value, limit in zip(values, limits))
+        low = all(value <= limit[0] for value, limit in zip(values, limits))
+        if high:
+            self._calm = 0
+            if self.stage < len(self._stages) - 1:
+                self.set_stage(self.stage + 1, pressure)
+        elif low and self.stage:
+            self._calm += 1
+            if self._calm >= self.recover_after:
+                self._calm = 0
+                self.set_stage(self.stage - 1, pressure)
+        else:
+            self._calm = 0
+
+    def set_stage(self, stage, pressure=None):
+        """Switch to the given stage and log the change."""
+        previous, self.stage = self.stage, stage
+        self._policies_of_stage = self._stages[stage]
+        rates = dict((logging.getLevelName(key) if isinstance(key, int) else key, rate)
+                     for key, rate in self.rates[stage].items())
+        message = dict(pressure or {}, message="Logging stage changed", stage=stage,
+                       previous=previous, rates=rates)
+        self.logger.emit(logging.WARNING, message, "CUSTOM")
+
+    def stats(self):
+        """Will return the current stage and the number of dropped
+        messages."""
+        return {"stage": self.stage, "dropped": self._dropped}
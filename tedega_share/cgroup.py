@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Resource usage of the container (cgroup) and of the process.
+
+Inside a container the host wide utilisation of
+:class:`tedega_share.system.SystemSampler` says little about the limits
+of the service. The :class:`CgroupSampler` reads the accounting of the
+cgroup of the process (v2, with a fallback to v1):
+
+* `cpu_limit`: CPU quota in cores or None if unlimited
+* `cpu_usage`: Used cores on average and `cpu_percent` of the quota
+* `throttled_periods`, `throttled_seconds` and `throttled_ratio`: How
+  often and how long the cgroup was throttled because it exceeded its
+  quota, and the ratio of throttled scheduling periods.
+* `memory`, `memory_limit` and `memory_percent`: Memory usage in bytes
+  and of the limit
+* `cpu_pressure`, `memory_pressure` and `io_pressure`: Percentage of
+  the time in which some tasks were stalled waiting for the resource
+  (PSI, the `avg10` value of `some`). With cgroup v1 the pressure of
+  the whole system is reported if available.
+
+and the resources of the process itself: `rss` in bytes, open `fds`,
+`threads`, `cpu` in percent of one core and the voluntary and
+involuntary context switches per second.
+
+The files are opened once and read with `os.pread` on every sample, so
+taking a sample only costs a few system calls. Counters are reported
+as rates or differences since the previous sample.
+
+The :class:`ContainerProbe` logs the samples as *SYSTEM* message and
+closes the files when it is removed from the scheduler.
+"""
+
+import os
+import threading
+import time
+
+from .monitor import Probe
+
+#: Limits of cgroup v1 above this value mean no limit
+UNLIMITED = 1 << 60
+
+PRESSURE = ("cpu", "memory", "io")
+
+
+def _int(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
+
+def _keyed(text):
+    """Will return the values of a file with lines of `key value`."""
+    result = {}
+    for line in (text or "").splitlines():
+        fields = line.split()
+        if len(fields) >= 2:
+            result[fields[0].rstrip(":")] = fields[1]
+    return result
+
+
+def _pressure(text):
+    """Will return the avg10 value of `some` from a PSI file."""
+    for line in (text or "").splitlines():
+        if line.startswith("some "):
+            for field in line.split()[1:]:
+                key, _, value = field.partition("=")
+                if key == "avg10":
+                    return float(value)
+    return None
+
+
+def _cgroup_dirs(root, membership):
+    """Will return the cgroup version and the directory of the cgroup
+    of the process by controller.
+
+    :root: Mount point of the cgroup filesystem
+    :membership: Content of /proc/self/cgroup
+    """
+    paths = {}
+    for line in (membership or "").splitlines():
+        fields = line.split(":", 2)
+        if len(fields) == 3:
+            for controller in fields[1].split(","):
+                paths[controller] = fields[2]
+
+    def directory(base, path):
+        # In a container the cgroup namespace usually makes its cgroup
+        # the root of the mount.
+        candidate = os.path.normpath(os.path.join(base, path.lstrip("/")))
+        return candidate if os.path.isdir(candidate) else base
+
+    if os.path.exists(os.path.join(root, "cgroup.controllers")):
+        path = directory(root, paths.get("", "/"))
+        return 2, {"cpu": path, "cpuacct": path, "memory": path}
+    dirs = {}
+    for controller in ("cpu", "cpuacct", "memory"):
+        base = os.path.join(root, controller)
+        if os.path.isdir(base):
+            dirs[controller] = directory(base, paths.get(controller, "/"))
+    return (1 if dirs else None), dirs
+
+
+class CgroupSampler(object):
+    """Samples the resource usage of the cgroup and of the process."""
+
+    def __init__(self, root="/sys/fs/cgroup", proc="/proc"):
+        """
+        :root: Mount point of the cgroup filesystem
+        :proc: Mount point of the proc filesystem
+        """
+        self.root = root
+        self.proc = proc
+        self._fds = {}
+        # Guards the cached files, close() may be called from another
+        # thread while sampling.
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.version, self._dirs = _cgroup_dirs(root, self._read(self._self("cgroup")))
+        self._last = self._counters()
+
+    def _self(self, name):
+        return os.path.join(self.proc, str(self._pid), name)
+
+    def _read(self, path):
+        """Will return the content of the file or None. The file is
+        kept open."""
+        if path is None:
+            return None
+        fd = self._fds.get(path)
+        try:
+            if fd is None:
+                fd = self._fds[path] = os.open(path, os.O_RDONLY)
+            return os.pread(fd, 65536, 0).decode("utf-8", "replace")
+        except OSError:
+            self._fds.pop(path, None)
+            if fd is not None:
+                os.close(fd)
+            return None
+
+    def _cgroup(self, controller, name):
+        directory = self._dirs.get(controller)
+        if directory is None:
+            return None
+        return self._read(os.path.join(directory, name))
+
+    def _counters(self):
+        if os.getpid() != self._pid:
+            # The files of /proc/<pid> belong to the parent process.
+            self.close()
+            self._pid = os.getpid()
+        counters = {"time": time.monotonic()}
+        cpu_stat = _keyed(self._cgroup("cpu", "cpu.stat"))
+        counters["periods"] = _int(cpu_stat.get("nr_periods"))
+        counters["throttled"] = _int(cpu_stat.get("nr_throttled"))
+        if self.version == 2:
+            usage = _int(cpu_stat.get("usage_usec"))
+            counters["usage"] = usage / 1e6 if usage is not None else None
+            throttled = _int(cpu_stat.get("throttled_usec"))
+            counters["throttled_time"] = throttled / 1e6 if throttled is not None else None
+        else:
+            usage = _int(self._cgroup("cpuacct", "cpuacct.usage"))
+            counters["usage"] = usage / 1e9 if usage is not None else None
+            throttled = _int(cpu_stat.get("throttled_time"))
+            counters["throttled_time"] = throttled / 1e9 if throttled is not None else None
+        stat = self._read(self._self("stat"))
+        if stat:
+            fields = stat.rpartition(")")[2].split()
+            counters["process_cpu"] = (int(fields[11]) + int(fields[12])) / float(self._ticks)
+        status = _keyed(self._read(self._self("status")))
+        counters["voluntary"] = _int(status.get("voluntary_ctxt_switches"))
+        counters["involuntary"] = _int(status.get("nonvoluntary_ctxt_switches"))
+        counters["status"] = status
+        return counters
+
+    def _limits(self):
+        """Will return the CPU limit in cores and the memory usage and
+        limit in bytes."""
+        if self.version == 2:
+            quota, _, period = (self._cgroup("cpu", "cpu.max") or "max").partition(" ")
+            quota, period = _int(quota), _int(period)
+            memory = _int(self._cgroup("memory", "memory.current"))
+            memory_limit = _int(self._cgroup("memory", "memory.max"))
+        else:
+            quota = _int(self._cgroup("cpu", "cpu.cfs_quota_us"))
+            period = _int(self._cgroup("cpu", "cpu.cfs_period_us"))
+            memory = _int(self._cgroup("memory", "memory.usage_in_bytes"))
+            memory_limit = _int(self._cgroup("memory", "memory.limit_in_bytes"))
+            if memory_limit is not None and memory_limit >= UNLIMITED:
+                memory_limit = None
+        cpu_limit = None
+        if quota is not None and quota > 0 and period:
+            cpu_limit = round(quota / float(period), 3)
+        return cpu_limit, memory, memory_limit
+
+    def sample(self):
+        """Will return a dictionary with the usage of the cgroup and of
+        the process since the last sample. Values which are not
+        available are omitted.
+
+        :returns: Dictionary with the keys `cgroup` and `process`
+        """
+        with self._lock:
+            return self._sample()
+
+    def _sample(self):
+        last, current = self._last, self._counters()
+        self._last = current
+        elapsed = current["time"] - last["time"]
+
+        def delta(key):
+            if current.get(key) is None or last.get(key) is None:
+                return None
+            return current[key] - last[key]
+
+        cgroup = {"version": self.version}
+        cpu_limit, memory, memory_limit = self._limits()
+        cgroup["cpu_limit"] = cpu_limit
+        usage = delta("usage")
+        if usage is not None and elapsed > 0:
+            cgroup["cpu_usage"] = round(usage / elapsed, 3)
+            if cpu_limit:
+                cgroup["cpu_percent"] = round(usage / elapsed / cpu_limit * 100, 1)
+        periods, throttled = delta("periods"), delta("throttled")
+        if periods is not None:
+            cgroup["throttled_periods"] = throttled
+            cgroup["throttled_seconds"] = round(delta("throttled_time") or 0.0, 6)
+            cgroup["throttled_ratio"] = round(throttled / float(periods), 3) if periods else 0.0
+        if memory is not None:
+            cgroup["memory"] = memory
+            cgroup["memory_limit"] = memory_limit
+            if memory_limit:
+                cgroup["memory_percent"] = round(memory / float(memory_limit) * 100, 1)
+        for resource in PRESSURE:
+            if self.version == 2:
+                text = self._cgroup("cpu", "%s.pressure" % resource)
+            else:
+                text = self._read(os.path.join(self.proc, "pressure", resource))
+            pressure = _pressure(text)
+            if pressure is not None:
+                cgroup["%s_pressure" % resource] = pressure
+
+        process = {}
+        status = current["status"]
+        rss = _int(status.get("VmRSS"))
+        if rss is not None:
+            process["rss"] = rss * 1024
+        threads = _int(status.get("Threads"))
+        if threads is not None:
+            process["threads"] = threads
+        try:
+            process["fds"] = len(os.listdir(self._self("fd")))
+        except OSError:
+            pass
+        if elapsed > 0:
+            cpu = delta("process_cpu")
+            if cpu is not None:
+                process["cpu"] = round(cpu / elapsed * 100, 1)
+            for key, name in (("voluntary", "ctx_switches_voluntary"),
+                              ("involuntary", "ctx_switches_involuntary")):
+                value = delta(key)
+                if value is not None:
+                    process[name] = int(value / elapsed)
+        return {"cgroup": cgroup, "process": process}
+
+    def close(self):
+        """Close the cached files. A running sample is finished
+        first."""
+        with self._lock:
+            fds, self._fds = self._fds, {}
+            for fd in fds.values():
+                os.close(fd)
+
+
+class ContainerProbe(Probe):
+    """Probe which logs the samples of a :class:`CgroupSampler`. The
+    first sample is logged after the first interval."""
+
+    def __init__(self, logger, interval=60, root="/sys/fs/cgroup", proc="/proc",
+                 name="container"):
+        """
+        :logger: :class:`tedega_share.logger.Logger`
+        :interval: Sample is logged every X seconds
+        :root: Mount point of the cgroup filesystem
+        :proc: Mount point of the proc filesystem
+        """
+        Probe.__init__(self, name, interval)
+        self.logger = logger
+        self.root = root
+        self.proc = proc
+        self.sampler = None
+
+    def run(self):
+        sampler = self.sampler
+        if sampler is None:
+            self.sampler = CgroupSampler(self.root, self.proc)
+        else:
+            self.logger.info(sampler.sample(), "SYSTEM")
+
+    def stop(self):
+        sampler, self.sampler = self.sampler, None
+        if sampler is not None:
+            sampler.close()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Concurrent checking of the connectivity to other hosts.
+
+All hosts are checked concurrently with asyncio. Every check is limited
+by a timeout, so a host which does not answer does not delay the checks
+of the other hosts. For every host the time for the DNS resolution and
+for establishing the connection is measured. The connection is closed
+immediately. Resolved addresses are cached for `dns_ttl` seconds.
+
+The :class:`ConnectivityProbe` only logs the hosts which changed their
+state (up -> down, down -> up) since the last check. On the first check
+and every `report_interval` seconds all hosts are logged. A message of
+the category *PING* looks like this::
+
+        {"hosts": {"www.google.de:80": {"up": true, "previous": false,
+                                        "dns": 0.002, "connect": 0.011}}}
+"""
+
+import asyncio
+import concurrent.futures
+import socket
+import sys
+import threading
+import time
+from time import perf_counter
+
+from .monitor import Probe
+
+
+class ConnectivityProber(object):
+    """Checks the connectivity to a list of hosts."""
+
+    def __init__(self, hosts, timeout=5.0, dns_ttl=300):
+        """
+        :hosts: List of tuples (hostname, port)
+        :timeout: Timeout in seconds for DNS resolution and connect
+        :dns_ttl: Seconds the resolved addresses are cached
+        """
+        self.hosts = [(host, int(port)) for host, port in hosts]
+        self.timeout = timeout
+        self.dns_ttl = dns_ttl
+        self._dns = {}
+        self._loop = None
+        self._executor = None
+        # Held while the loop is used, as close may be called from
+        # another thread than check.
+        self._lock = threading.Lock()
+        self._close_requested = False
+
+    def check(self):
+        """Check all hosts concurrently.
+
+        :returns: Dictionary with the result for every "host:port"
+        """
+        with self._lock:
+            if self._loop is None:
+                self._close_requested = False
+                self._loop = asyncio.new_event_loop()
+                # DNS lookups are done in the executor of the loop.
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=4, thread_name_prefix="tedega_dns")
+                self._loop.set_default_executor(self._executor)
+            results = self._loop.run_until_complete(self._check_all())
+        if self._close_requested:
+            self.close()
+        return dict(("%s:%s" % hostport, result)
+                    for hostport, result in zip(self.hosts, results))
+
+    async def _check_all(self):
+        return await asyncio.gather(*[self._check(host, port)
+                                      for host, port in self.hosts])
+
+    async def _check(self, host, port):
+        result = {"up": False}
+        started_at = perf_counter()
+        try:
+            await asyncio.wait_for(self._connect(host, port, result), self.timeout)
+            result["up"] = True
+        except asyncio.TimeoutError:
+            result["error"] = "timeout"
+        except OSError as e:
+            result["error"] = e.__class__.__name__
+        result["time"] = round(perf_counter() - started_at, 6)
+        return result
+
+    async def _resolve(self, host, port, result):
+        key = (host, port)
+        cached = self._dns.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            result["dns"] = 0.0
+            return cached[0]
+        started_at = perf_counter()
+        addresses = await self._loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        result["dns"] = round(perf_counter() - started_at, 6)
+        self._dns[key] = (addresses, time.monotonic() + self.dns_ttl)
+        return addresses
+
+    async def _connect(self, host, port, result):
+        addresses = await self._resolve(host, port, result)
+        error = None
+        for family, type_, proto, _, address in addresses:
+            sock = socket.socket(family, type_, proto)
+            try:
+                sock.setblocking(False)
+                started_at = perf_counter()
+                await self._loop.sock_connect(sock, address)
+                result["connect"] = round(perf_counter() - started_at, 6)
+                return
+            except OSError as e:
+                error = e
+            finally:
+                sock.close()
+        raise error or OSError("No address for {}".format(host))
+
+    def close(self):
+        """Close the event loop of the prober. Can be called from any
+        thread. If a check is running, the loop is closed by the thread
+        running the check when it is finished. Waiting for pending DNS
+        lookups is limited by the timeout."""
+        self._close_requested = True
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            loop, self._loop = self._loop, None
+            if loop is None:
+                return
+            # The executor is shut down in a separate thread, as a hanging
+            # DNS lookup can not be cancelled. Queued lookups can only be
+            # cancelled since Python 3.9.
+            if sys.version_info >= (3, 9):
+                kwargs = {"cancel_futures": True}
+            else:
+                kwargs = {"wait": False}
+            waiter = threading.Thread(target=self._executor.shutdown, kwargs=kwargs,
+                                      daemon=True)
+            waiter.start()
+            waiter.join(self.timeout)
+            loop.close()
+        finally:
+            self._lock.release()
+
+
+class ConnectivityProbe(Probe):
+    """Probe which logs changes of the connectivity to a list of
+    hosts."""
+
+    per_host = True
+
+    def __init__(self, hosts, interval=60, timeout=5.0, dns_ttl=300,
+                 report_interval=900, name="connectivity"):
+        """
+        :hosts: List of tuples (hostname, port)
+        :interval: Check will be executed every X seconds
+        :timeout: Timeout in seconds for DNS resolution and connect
+        :dns_ttl: Seconds the resolved addresses are cached
+        :report_interval: All hosts are logged every X seconds. If
+        None only the changes are logged.
+        """
+        Probe.__init__(self, name, interval)
+        self.prober = ConnectivityProber(hosts, timeout, dns_ttl)
+        self.report_interval = report_interval
+        self._states = {}
+        self._reported_at = None
+
+    def changes(self, results):
+        """Will return the results of the hosts which changed their
+        state since the last call, or of all hosts if a full report is
+        due. The previous state is added to every result."""
+        now = time.monotonic()
+        full = self._reported_at is None
+        if not full and self.report_interval is not None:
+            full = now - self._reported_at >= self.report_interval
+        if full:
+            self._reported_at = now
+        changes = {}
+        for hostport, result in results.items():
+            previous = self._states.get(hostport)
+            self._states[hostport] = result["up"]
+            if full or previous != result["up"]:
+                result["previous"] = previous
+                changes[hostport] = result
+        return changes
+
+    def run(self):
+        changes = self.changes(self.prober.check())
+        if changes:
+            # Imported here, as the logger module depends on this module.
+            from .logger import log
+            if log is not None:
+                log.info({"hosts": changes}, "PING")
+
+    def stop(self):
+        self.prober.close()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Suppression of repeated log messages.
+
+If a dependency fails, the same error is often logged thousands of
+times per second. The :class:`Deduplicator` is a filter for the
+:class:`tedega_share.logger.Logger` which writes the first occurrence
+of a message and suppresses its repetitions for `window` seconds.
+Periodically a summary is written for every suppressed message with
+the same level and category as the message::
+
+        {"message": "Connection refused", "suppressed": 4711,
+         "first": 1508224325.1, "last": 1508224334.9}
+
+`first` and `last` are the timestamps of the first and the last
+suppressed repetition. For dictionaries these fields are added to the
+message.
+
+Messages are identical if they have the same category, level and
+fingerprint. The fingerprint of a string is the string itself. The
+fingerprint of a dictionary are the values of the given `fields` or of
+all fields. Messages given as callable are never suppressed as they
+would have to be evaluated.
+
+The fingerprints are kept in a LRU with at most `max_fingerprints`
+entries. Evicted fingerprints are summarized immediately.
+"""
+
+import collections
+import threading
+import time
+
+from .monitor import Probe
+
+
+class Deduplicator(Probe):
+    """Filter which suppresses repeated messages. As probe of the
+    monitor scheduler it writes the summaries of suppressed messages."""
+
+    def __init__(self, logger, window=10.0, max_fingerprints=1000, fields=None,
+                 name="dedup"):
+        """
+        :logger: :class:`tedega_share.logger.Logger` writing the summaries
+        :window: Seconds in which repetitions are suppressed. The
+        summaries are written in the same interval.
+        :max_fingerprints: Maximum number of remembered messages
+        :fields: List of fields to build the fingerprint of dictionaries
+        """
+        Probe.__init__(self, name, window)
+        self.logger = logger
+        self.window = window
+        self.max_fingerprints = max_fingerprints
+        self.fields = fields
+        self._lock = threading.Lock()
+        # fingerprint -> [started, suppressed, first, last, entry]
+        self._seen = collections.OrderedDict()
+
+    def fingerprint(self, entry):
+        """Will return the fingerprint of the entry or None if it can
+        not be deduplicated."""
+        message = entry.message
+        if isinstance(message, dict):
+            if self.fields is not None:
+                key = tuple(str(message.get(field)) for field in self.fields)
+            else:
+                # Keys of different types can not be compared.
+                key = tuple(sorted((repr(k), str(v)) for k, v in message.items()))
+        elif isinstance(message, str):
+            key = message
+        else:
+            return None
+        return entry.category, entry.level, key
+
+    def filter(self, entry):
+        fingerprint = self.fingerprint(entry)
+        if fingerprint is None:
+            return True
+        now = time.monotonic()
+        evicted = None
+        with self._lock:
+            state = self._seen.get(fingerprint)
+            if state is not None and now - state[0] < self.window:
+                if not state[1]:
+                    state[2] = time.time()
+                state[1] += 1
+                state[3] = time.time()
+                self._seen.move_to_end(fingerprint)
+                return False
+            if state is not None:
+                # The window is over, the summary of the last window is
+                # written before the message.
+                self._seen.move_to_end(fingerprint)
+                summary = state[:]
+                state[:] = [now, 0, None, None, entry]
+            else:
+                summary = None
+                self._seen[fingerprint] = [now, 0, None, None, entry]
+                if len(self._seen) > self.max_fingerprints:
+                    evicted = self._seen.popitem(last=False)[1]
+        for state in (summary, evicted):
+            if state is not None and state[1]:
+                self._write_summary(state)
+        return True
+
+    def _write_summary(self, state):
+        _, suppressed, first, last, entry = state
+        message = entry.message
+        if not isinstance(message, dict):
+            message = {"message": message}
+        message = dict(message, suppressed=suppressed, first=first, last=last)
+        self.logger.emit(entry.level, message, entry.category,
+                         entry.correlation_id, entry.extra)
+
+    def run(self):
+        """Write the summaries of all suppressed messages."""
+        summaries = []
+        with self._lock:
+            for state in self._seen.values():
+                if state[1]:
+                    summaries.append(state[:])
+                    state[1:4] = [0, None, None]
+        for state in summaries:
+            self._write_summary(state)
+
+    def stop(self):
+        self.run()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fast encoding of the structured log messages.
+
+Every log message consists of a constant envelope (service, category
+and for fluentd the host) and the dynamic part (correlation_id and the
+logged payload). The :class:`EnvelopeEncoder` renders the constant part
+once per category and only encodes the dynamic part for every message.
+
+The :class:`Envelope` which is logged as message of the record is
+rendered lazily and only in the format which is needed by the handlers.
+A handler writing text uses the JSON rendering (`str(envelope)`),
+while the fluentd handlers use the dictionary or the msgpack rendering
+without a detour over JSON.
+"""
+
+import collections
+import importlib
+import json
+import logging
+import struct
+
+ENVELOPE_KEYS = ("host", "service", "category", "correlation_id")
+
+_json_encode = json.dumps
+
+# Imported on first use to keep the import of the package fast.
+msgpack = None
+
+
+def _msgpack_encode(obj):
+    global msgpack
+    if msgpack is None:
+        msgpack = importlib.import_module("msgpack")
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_map_header(size):
+    if size < 16:
+        return bytes((0x80 | size,))
+    elif size < 0x10000:
+        return b"\xde" + struct.pack(">H", size)
+    return b"\xdf" + struct.pack(">I", size)
+
+
+def _msgpack_map_body(packed):
+    """Will strip the header from a packed msgpack map."""
+    first = packed[0]
+    if first == 0xde:
+        return packed[3:]
+    elif first == 0xdf:
+        return packed[5:]
+    return packed[1:]
+
+
+class EnvelopeEncoder(object):
+    """Encoder for the log messages of a service."""
+
+    def __init__(self, service, hostname=None):
+        """
+        :service: Name of the service
+        :hostname: Hostname which is added to the fluentd records.
+        Defaults to the hostname of the system.
+        """
+        self.service = service
+        if hostname is None:
+            import socket
+            hostname = socket.gethostname()
+        self.hostname = hostname
+        self._json_prefixes = {}
+        self._msgpack_prefixes = {}
+
+    def envelope(self, message, category=None, correlation_id=None, extra=None):
+        """Will return the :class:`Envelope` for the given message.
+
+        :message: String or dictionary to log.
+        :category: Category of the message
+        :correlation_id: Correlation id of the message
+        :extra: Dictionary with additional fields which are added
+        before the message.
+        :returns: :class:`Envelope`
+        """
+        return Envelope(self, message, category, correlation_id, extra)
+
+    def json_prefix(self, category):
+        prefix = self._json_prefixes.get(category)
+        if prefix is None:
+            prefix = '{{"service": {}, "category": {}, "correlation_id": '.format(
+                _json_encode(self.service), _json_encode(category))
+            self._json_prefixes[category] = prefix
+        return prefix
+
+    def msgpack_prefix(self, category):
+        prefix = self._msgpack_prefixes.get(category)
+        if prefix is None:
+            prefix = b"".join(_msgpack_encode(item) for item in (
+                "host", self.hostname, "service", self.service,
+                "category", category, "correlation_id"))
+            self._msgpack_prefixes[category] = prefix
+        return prefix
+
+
+class Envelope(object):
+    """Log message which is rendered on demand. The renderings are
+    cached, so every format is only rendered once, regardless how many
+    handlers are using it.
+
+    The payload is rendered when a handler needs it. As with the args
+    of a usual log record, a logged dictionary should not be changed
+    after it was logged.
+    """
+
+    __slots__ = ("encoder", "message", "category", "correlation_id",
+                 "extra", "_json", "_packed")
+
+    def __init__(self, encoder, message, category, correlation_id, extra=None):
+        self.encoder = encoder
+        self.message = message
+        self.category = category
+        self.correlation_id = correlation_id
+        self.extra = extra
+        self._json = None
+        self._packed = None
+
+    def _payload(self):
+        message = self.message
+        if isinstance(message, dict):
+            if any(key in message for key in ENVELOPE_KEYS):
+                return None
+        else:
+            message = {"message": message}
+        if self.extra:
+            payload = dict(self.extra)
+            payload.update(message)
+            return payload
+        return message
+
+    def to_dict(self, host=True):
+        """Will return the message as dictionary.
+
+        :host: Include the hostname.
+        :returns: Dictionary
+        """
+        msg = collections.OrderedDict()
+        if host:
+            msg["host"] = self.encoder.hostname
+        msg["service"] = self.encoder.service
+        msg["category"] = self.category
+        msg["correlation_id"] = self.correlation_id
+        if self.extra:
+            msg.update(self.extra)
+        if isinstance(self.message, dict):
+            msg.update(self.message)
+        else:
+            msg["message"] = self.message
+        return msg
+
+    def to_json(self):
+        """Will return the message encoded as JSON string. The host is
+        not included."""
+        if self._json is None:
+            payload = self._payload()
+            try:
+                if payload is None:
+                    raise TypeError
+                body = _json_encode(payload)
+                self._json = "".join((
+                    self.encoder.json_prefix(self.category),
+                    _json_encode(self.correlation_id),
+                    ", " + body[1:] if len(body) > 2 else "}"))
+            except (TypeError, ValueError):
+                # Values which can not be encoded by the json module
+                # (e.g dates) are handled by voorhees.
+                import voorhees
+                self._json = voorhees.to_json(self.to_dict(host=False))
+        return self._json
+
+    def to_msgpack(self):
+        """Will return the message as msgpack encoded map including the
+        host."""
+        if self._packed is None:
+            payload = self._payload()
+            try:
+                if payload is None:
+                    self._packed = _msgpack_encode(self.to_dict())
+                else:
+                    self._packed = b"".join((
+                        _msgpack_map_header(len(ENVELOPE_KEYS) + len(payload)),
+                        self.encoder.msgpack_prefix(self.category),
+                        _msgpack_encode(self.correlation_id),
+                        _msgpack_map_body(_msgpack_encode(payload))))
+            except (TypeError, ValueError):
+                self._packed = _msgpack_encode(self._normalized_dict())
+        return self._packed
+
+    def _normalized_dict(self):
+        """Will return the message as dictionary including the host with
+        the values converted like in the JSON rendering."""
+        data = collections.OrderedDict(host=self.encoder.hostname)
+        data.update(json.loads(self.to_json(), object_pairs_hook=collections.OrderedDict))
+        return data
+
+    def to_packable_dict(self):
+        """Will return the message as dictionary including the host,
+        which can be serialized by msgpack. Values which msgpack can not
+        serialize (e.g dates) are converted like in the JSON rendering."""
+        data = self.to_dict()
+        try:
+            _msgpack_encode(data)
+        except (TypeError, ValueError):
+            return self._normalized_dict()
+        return data
+
+    def __str__(self):
+        return self.to_json()
+
+
+class EnvelopeFormatter(logging.Formatter):
+    """Formatter for the fluentd handlers. Records with an
+    :class:`Envelope` are converted into a dictionary directly instead
+    of being rendered as JSON and parsed again. All other records are
+    formatted by a `fluent.handler.FluentRecordFormatter` with the
+    given arguments, which is created on first use."""
+
+    def __init__(self, *args, **kwargs):
+        logging.Formatter.__init__(self)
+        self._args = args
+        self._kwargs = kwargs
+        self._formatter = None
+
+    def format(self, record):
+        if isinstance(record.msg, Envelope):
+            # A FluentSender replaces messages which it can not
+            # serialize, so they are checked here. The handler of
+            # tedega_share.forward does not format envelopes at all.
+            return record.msg.to_packable_dict()
+        if self._formatter is None:
+            from fluent import handler
+            self._formatter = handler.FluentRecordFormatter(*self._args, **self._kwargs)
+        return self._formatter.format(record)
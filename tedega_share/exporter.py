@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Export of metrics in the OpenMetrics text format.
+
+Shipping numeric time series as log messages to fluentd is expensive.
+Instead the metrics can be pulled by Prometheus (or any other scraper
+of the OpenMetrics format) from an embedded HTTP server::
+
+        registry = Registry()
+        requests = registry.counter("requests", "Handled requests", ["method"])
+        MetricsServer(registry, port=9464).start()
+        requests.inc(labels={"method": "GET"})
+
+A scrape never computes anything: every metric family caches its
+rendered text until one of its values changes and the registry caches
+the whole exposition until any family changed. Updating a value only
+invalidates the caches. The scrapes are served by the thread of the
+server, so they never touch the logging path.
+
+The :class:`MetricsExporter` is a filter for the
+:class:`tedega_share.logger.Logger` and a probe of the monitor
+scheduler which exports the monitoring of the service:
+
+* The numeric values of *SYSTEM* messages as gauges
+  `tedega_system_<field>`. Values of lists and dictionaries get the
+  label `key`.
+* The results of *PING* messages as gauges `tedega_ping_up`,
+  `tedega_ping_seconds`, `tedega_ping_dns_seconds` and
+  `tedega_ping_connect_seconds` with the label `host`.
+* The processing times of a
+  :class:`tedega_share.metrics.ProctimeAggregator` as histogram
+  `tedega_proctime_seconds` and the failed calls as counter
+  `tedega_proctime_errors` with the label `func`. They are copied
+  from the aggregator in the interval of the probe.
+
+Without `log_metrics` these messages are only exported and no longer
+logged. Of the *PROCTIME* messages only the statistics of the
+aggregator are dropped, other messages like spans are still logged.
+"""
+
+import bisect
+import math
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .metrics import Histogram
+from .monitor import Probe
+
+#: Content type of the exposition
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+#: Default buckets of histograms in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#: Name of the gauges for the fields of the results of *PING* messages
+PING_FIELDS = {"up": "tedega_ping_up",
+               "time": "tedega_ping_seconds",
+               "dns": "tedega_ping_dns_seconds",
+               "connect": "tedega_ping_connect_seconds"}
+
+_INVALID = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+    """A family of samples with the same name and labels. Subclasses
+    implement :meth:`_samples`."""
+
+    type = None
+
+    def __init__(self, name, help="", labels=()):
+        """
+        :name: Name of the metric
+        :help: Description of the metric
+        :labels: List with the names of the labels
+        """
+        if _INVALID.search(name):
+            raise ValueError("{} is not a valid metric name.".format(name))
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.registry = None
+        self._values = {}
+        self._lock = threading.Lock()
+        self._version = 0
+        self._cache = (None, "")
+
+    def _key(self, labels):
+        if not self.labels:
+            return ()
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _changed(self):
+        self._version += 1
+        registry = self.registry
+        if registry is not None:
+            registry._version += 1
+
+    def _set(self, labels, value):
+        key = self._key(labels or {})
+        with self._lock:
+            if self._values.get(key) == value:
+                return
+            self._values[key] = value
+        self._changed()
+
+    def remove(self, labels=None):
+        """Remove the sample with the given labels."""
+        with self._lock:
+            if self._values.pop(self._key(labels or {}), None) is None:
+                return
+        self._changed()
+
+    def clear(self):
+        """Remove all samples."""
+        with self._lock:
+            self._values = {}
+        self._changed()
+
+    def _labels(self, key, extra=""):
+        labels = ['%s="%s"' % (name, _escape(value)) for name, value in zip(self.labels, key)]
+        if extra:
+            labels.append(extra)
+        return "{%s}" % ",".join(labels) if labels else ""
+
+    def _samples(self, key, value):
+        """Will return the lines of the sample with the given label
+        values."""
+        raise NotImplementedError()
+
+    def render(self):
+        """Will return the text of the metric family."""
+        version, text = self._cache
+        if version == self._version:
+            return text
+        # Changes while rendering increase the version again, so the
+        # text is rendered again on the next call.
+        version = self._version
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ["# TYPE %s %s" % (self.name, self.type)]
+        if self.help:
+            lines.append("# HELP %s %s" % (self.name, _escape(self.help)))
+        for key, value in values:
+            lines.extend(self._samples(key, value))
+        text = "\n".join(lines) + "\n"
+        self._cache = (version, text)
+        return text
+
+
+class Gauge(Metric):
+    """A value which can go up and down."""
+
+    type = "gauge"
+
+    def set(self, value, labels=None):
+        """Set the value of the sample with the given labels.
+
+        :value: Number
+        :labels: Dictionary with the value of every label
+        """
+        self._set(labels, value)
+
+    def _samples(self, key, value):
+        return ["%s%s %s" % (self.name, self._labels(key), _number(value))]
+
+
+class Counter(Metric):
+    """A value which only goes up. The sample is named `<name>_total`."""
+
+    type = "counter"
+
+    def __init__(self, name, help="", labels=()):
+        if name.endswith("_total"):
+            name = name[:-len("_total")]
+        Metric.__init__(self, name, help, labels)
+
+    def inc(self, amount=1, labels=None):
+        """Increase the value of the sample with the given labels.
+
+        :amount: Number to add
+        :labels: Dictionary with the value of every label
+        """
+        key = self._key(labels or {})
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._changed()
+
+    def set(self, value, labels=None):
+        """Set the value of the sample with the given labels, e.g to
+        export a counter which is counted elsewhere.
+
+        :value: Number
+        :labels: Dictionary with the value of every label
+        """
+        self._set(labels, value)
+
+    def _samples(self, key, value):
+        return ["%s_total%s %s" % (self.name, self._labels(key), _number(value))]
+
+
+class HistogramMetric(Metric):
+    """Distribution of values in buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, help="", labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        :name: Name of the metric
+        :help: Description of the metric
+        :labels: List with the names of the labels
+        :buckets: Sorted list with the upper bounds of the buckets
+        """
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=None):
+        """Record a value into the sample with the given labels.
+
+        :value: Number
+        :labels: Dictionary with the value of every label
+        """
+        key = self._key(labels or {})
+        with self._lock:
+            counts, total = self._values.get(key) or ((0,) * (len(self.buckets) + 1), 0)
+            i = bisect.bisect_left(self.buckets, value)
+            counts = counts[:i] + (counts[i] + 1,) + counts[i + 1:]
+            self._values[key] = (counts, total + value)
+        self._changed()
+
+    def set(self, counts, total, labels=None):
+        """Set the distribution of the sample with the given labels.
+
+        :counts: List with the number of values of every bucket and of
+        the values above the last bucket. Not cumulative.
+        :total: Sum of all values
+        :labels: Dictionary with the value of every label
+        """
+        if len(counts) != len(self.buckets) + 1:
+            raise ValueError("Expected {} counts.".format(len(self.buckets) + 1))
+        self._set(labels, (tuple(counts), total))
+
+    def _samples(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            le = 'le="%s"' % _number(float(bound))
+            lines.append("%s_bucket%s %d" % (self.name, self._labels(key, le), cumulative))
+        labels = self._labels(key)
+        lines.append("%s_count%s %d" % (self.name, labels, cumulative))
+        lines.append("%s_sum%s %s" % (self.name, labels, _number(total)))
+        return lines
+
+
+class Registry(object):
+    """Collection of metrics which are exposed together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._version = 0
+        self._cache = (None, b"# EOF\n")
+
+    def register(self, metric):
+        """Add the metric. Will raise a ValueError if a metric with the
+        same name exists.
+
+        :metric: :class:`Metric`
+        :returns: The metric
+        """
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Metric {} already exists.".format(metric.name))
+            self._metrics[metric.name] = metric
+            metric.registry = self
+            self._version += 1
+        return metric
+
+    def unregister(self, name):
+        """Remove the metric with the given name."""
+        with self._lock:
+            metric = self._metrics.pop(name, None)
+            if metric is not None:
+                metric.registry = None
+                self._version += 1
+
+    def get(self, name):
+        """Will return the metric with the given name or None."""
+        return self._metrics.get(name)
+
+    def _get_or_create(self, cls, name, help, labels, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            try:
+                return self.register(cls(name, help, labels, *args))
+            except ValueError:
+                metric = self._metrics[name]
+        if type(metric) is not cls or metric.labels != tuple(labels):
+            raise ValueError("Metric {} exists with other type or labels.".format(name))
+        return metric
+
+    def gauge(self, name, help="", labels=()):
+        """Will return the :class:`Gauge` with the given name. It is
+        created if it does not exist."""
+        return self._get_or_create(Gauge, name, help, labels)
+
+    def counter(self, name, help="", labels=()):
+        """Will return the :class:`Counter` with the given name. It is
+        created if it does not exist."""
+        if name.endswith("_total"):
+            name = name[:-len("_total")]
+        return self._get_or_create(Counter, name, help, labels)
+
+    def histogram(self, name, help="", labels=(), buckets=DEFAULT_BUCKETS):
+        """Will return the :class:`HistogramMetric` with the given name.
+        It is created if it does not exist."""
+        return self._get_or_create(HistogramMetric, name, help, labels, buckets)
+
+    def render(self):
+        """Will return the exposition of all metrics as bytes."""
+        version, data = self._cache
+        if version == self._version:
+            return data
+        version = self._version
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        text = "".join(metric.render() for _, metric in metrics)
+        data = (text + "# EOF\n").encode("utf-8")
+        self._cache = (version, data)
+        return data
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = self.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Scrapes are not logged.
+        pass
+
+
+class MetricsServer(object):
+    """HTTP server which serves the metrics of a registry at
+    `/metrics` in a background thread."""
+
+    def __init__(self, registry, host="", port=9464):
+        """
+        :registry: :class:`Registry`
+        :host: Address to listen on. Defaults to all addresses.
+        :port: Port to listen on. 0 selects a free port.
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        """Tuple (host, port) the server is listening on."""
+        return self._server.server_address[:2]
+
+    def start(self):
+        """Start the server."""
+        handler = type("Handler", (_Handler,), {"registry": self.registry})
+        self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(name="tedega_metrics",
+                                        target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the server."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+
+class MetricsExporter(Probe):
+    """Filter which exports the *SYSTEM* and *PING* messages and probe
+    which exports the processing times."""
+
+    def __init__(self, registry=None, aggregator=None, log_metrics=True,
+                 interval=15, buckets=DEFAULT_BUCKETS, name="metrics"):
+        """
+        :registry: :class:`Registry`. Defaults to a new registry.
+        :aggregator: :class:`tedega_share.metrics.ProctimeAggregator`
+        :log_metrics: Log the *SYSTEM*, *PING* and *PROCTIME* messages
+        in addition to exporting them.
+        :interval: Processing times are exported every X seconds.
+        :buckets: Buckets of the processing times in seconds
+        """
+        Probe.__init__(self, name, interval)
+        self.registry = registry or Registry()
+        self.aggregator = aggregator
+        self.log_metrics = log_metrics
+        self.server = None
+        self.proctime = self.registry.histogram(
+            "tedega_proctime_seconds", "Processing time of functions", ["func"], buckets)
+        self.errors = self.registry.counter(
+            "tedega_proctime_errors", "Failed calls of functions", ["func", "error"])
+
+    def serve(self, host="", port=9464):
+        """Serve the registry with a :class:`MetricsServer`."""
+        self.server = MetricsServer(self.registry, host, port)
+        self.server.start()
+        return self.server
+
+    def filter(self, entry):
+        category = entry.category
+        if category == "SYSTEM":
+            message = entry.message
+            if isinstance(message, dict):
+                self.export_system(message)
+        elif category == "PING":
+            message = entry.message
+            if isinstance(message, dict):
+                self.export_ping(message.get("hosts") or {})
+        elif category != "PROCTIME" or not self._is_proctime_stats(entry.message):
+            return True
+        return self.log_metrics
+
+    def _is_proctime_stats(self, message):
+        """Will return True if the message contains the statistics of
+        the aggregator, which are exported."""
+        if self.aggregator is None or not isinstance(message, dict):
+            return False
+        return "func" in message and "count" in message
+
+    def export_system(self, sample):
+        """Export the numeric fields of a system sample as gauges."""
+        for field, value in sample.items():
+            name = "tedega_system_" + _INVALID.sub("_", field)
+            if isinstance(value, (list, tuple)):
+                value = dict(enumerate(value))
+            try:
+                if isinstance(value, dict):
+                    gauge = self.registry.gauge(name, labels=["key"])
+                    for key, v in value.items():
+                        if isinstance(v, (int, float)):
+                            gauge.set(v, {"key": key})
+                elif isinstance(value, (int, float)):
+                    self.registry.gauge(name).set(value)
+            except ValueError:
+                # The field changed its type.
+                continue
+
+    def export_ping(self, hosts):
+        """Export the results of the connectivity checks as gauges."""
+        for host, result in hosts.items():
+            labels = {"host": host}
+            for field, name in PING_FIELDS.items():
+                gauge = self.registry.gauge(name, labels=["host"])
+                value = result.get(field)
+                if value is None:
+                    gauge.remove(labels)
+                else:
+                    gauge.set(int(value) if isinstance(value, bool) else value, labels)
+
+    def run(self):
+        """Export the processing times of the aggregator."""
+        aggregator = self.aggregator
+        if aggregator is None:
+            return
+        bounds = Histogram(aggregator.precision).bounds
+        # Upper bounds of the buckets in nanoseconds
+        buckets = [bound * 1e9 for bound in self.proctime.buckets]
+        for func, (total, counts, errors) in aggregator.export().items():
+            values = [0] * (len(buckets) + 1)
+            for i, count in counts:
+                low, high = bounds(i)
+                values[bisect.bisect_left(buckets, (low + high) / 2)] += count
+            labels = {"func": func}
+            self.proctime.set(values, total / 1e9, labels)
+            for error, count in errors.items():
+                self.errors.set(count, {"func": func, "error": error})
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batched transport to fluentd using the Forward protocol.
+
+Instead of sending every record as its own `[tag, time, record]`
+message the :class:`PackedForwardSender` collects the records per tag
+and sends them as one PackedForward message::
+
+        [tag, <concatenated msgpack [time, record] entries>, option]
+
+Optionally the entries are gzip compressed (CompressedPackedForward).
+A batch is sent once it reaches `batch_size` bytes or is older than
+`flush_interval` seconds.
+
+In ack mode every message carries a unique `chunk` id and the sender
+waits for fluentd to acknowledge it. Unacknowledged messages are kept
+and sent again with the next flush.
+
+The :class:`EnvelopeFluentHandler` is used for the default `forward`
+transport, which sends every record as its own message. It sends the
+msgpack rendering of an :class:`tedega_share.encoder.Envelope`
+directly instead of packing its dictionary again.
+
+See https://github.com/fluent/fluentd/wiki/Forward-Protocol-Specification-v1
+"""
+
+import base64
+import gzip
+import logging
+import os
+import socket
+import threading
+import time
+
+import msgpack
+from fluent import handler as fluent_handler
+from fluent import sender as fluent_sender
+
+from .encoder import Envelope
+
+log = logging.getLogger(__name__)
+
+
+class PackedForwardSender(object):
+    """Sender which batches records per tag and ships them as
+    PackedForward messages to fluentd."""
+
+    def __init__(self, host="localhost", port=24224, timeout=3.0,
+                 batch_size=256 * 1024, flush_interval=1.0,
+                 compress=False, ack=False, bufmax=8 * 1024 * 1024,
+                 overflow_handler=None):
+        """
+        :host: Host where the fluentd is listening
+        :port: Port where the fluentd is listening
+        :timeout: Socket timeout in seconds
+        :batch_size: Batches are sent when they reach this size in bytes.
+        :flush_interval: Batches are sent at least every X seconds.
+        :compress: Compress the entries with gzip.
+        :ack: Wait for fluentd to acknowledge every message.
+        :bufmax: Maximum size in bytes of messages waiting for a retry.
+        :overflow_handler: Callable which gets the list of messages which
+        are discarded because `bufmax` was exceeded.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.ack = ack
+        self.bufmax = bufmax
+        self.overflow_handler = overflow_handler
+
+        self.socket = None
+        # tag -> [entries, number of entries, time of first entry]
+        self._batches = {}
+        self._pendings = []
+        self._pending_size = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._closed = False
+        self._stats = {"messages": 0, "records": 0, "bytes": 0,
+                       "errors": 0, "dropped": 0}
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(name="tedega_forward_flusher",
+                                        target=self._run, daemon=True)
+        self._thread.start()
+
+    def emit(self, tag, timestamp, record):
+        """Add a record to the batch of the given tag.
+
+        :tag: Tag for fluentd log routing.
+        :timestamp: Time of the record (int or EventTime)
+        :record: Dictionary with the log record.
+        """
+        self.emit_packed(tag, msgpack.packb((timestamp, record), use_bin_type=True))
+
+    def emit_packed(self, tag, entry):
+        """Add an already msgpack encoded `[time, record]` entry to the
+        batch of the given tag.
+
+        :tag: Tag for fluentd log routing.
+        :entry: msgpack encoded entry
+        """
+        full = None
+        with self._lock:
+            if self._closed:
+                return
+            batch = self._batches.get(tag)
+            if batch is None:
+                batch = self._batches[tag] = [bytearray(), 0, time.monotonic()]
+            batch[0] += entry
+            batch[1] += 1
+            if len(batch[0]) >= self.batch_size:
+                full = self._batches.pop(tag)
+        if full is not None:
+            self._send_batches({tag: full})
+
+    def flush(self):
+        """Send all batches regardless of their size and age."""
+        with self._lock:
+            batches, self._batches = self._batches, {}
+        self._send_batches(batches)
+
+    def _flush_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = dict((tag, batch) for tag, batch in self._batches.items()
+                           if now - batch[2] >= self.flush_interval)
+            for tag in expired:
+                del self._batches[tag]
+        if expired or self._pendings:
+            self._send_batches(expired)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval / 2.0):
+            try:
+                self._flush_expired()
+            except Exception:
+                log.exception("Flushing log batches failed")
+
+    def _build_message(self, tag, entries, size):
+        option = {"size": size}
+        if self.compress:
+            entries = gzip.compress(bytes(entries), compresslevel=1)
+            option["compressed"] = "gzip"
+        if self.ack:
+            option["chunk"] = base64.b64encode(os.urandom(16)).decode("ascii")
+        message = msgpack.packb((tag, bytes(entries), option), use_bin_type=True)
+        return message, option.get("chunk")
+
+    def _send_batches(self, batches):
+        messages = [self._build_message(tag, batch[0], batch[1]) + (batch[1],)
+                    for tag, batch in batches.items()]
+        with self._send_lock:
+            messages = self._pendings + messages
+            self._pendings = []
+            self._pending_size = 0
+            for i, (message, chunk, size) in enumerate(messages):
+                try:
+                    self._send(message, chunk)
+                except (OSError, ValueError) as e:
+                    log.debug("Sending logs to fluentd failed: %s", e)
+                    self._stats["errors"] += 1
+                    self._close()
+                    self._keep(messages[i:])
+                    return False
+                self._stats["messages"] += 1
+                self._stats["records"] += size
+                self._stats["bytes"] += len(message)
+            return True
+
+    def _keep(self, messages):
+        """Keep messages for the next retry until `bufmax` is reached."""
+        overflow = []
+        for message in messages:
+            if self._pending_size + len(message[0]) > self.bufmax:
+                overflow.append(message)
+            else:
+                self._pendings.append(message)
+                self._pending_size += len(message[0])
+        if overflow:
+            self._stats["dropped"] += sum(m[2] for m in overflow)
+            if self.overflow_handler:
+                try:
+                    self.overflow_handler([m[0] for m in overflow])
+                except Exception:
+                    log.exception("Log overflow handler failed")
+
+    def send_message(self, message):
+        """Send an already built message, e.g one which has been spilled
+        to disk by the `overflow_handler`. The message is not kept for a
+        retry if sending fails.
+
+        :message: msgpack encoded PackedForward message
+        :returns: True if the message has been sent
+        """
+        chunk = None
+        if self.ack:
+            chunk = msgpack.unpackb(message, raw=False)[2].get("chunk")
+        with self._send_lock:
+            try:
+                self._send(message, chunk)
+            except (OSError, ValueError) as e:
+                log.debug("Sending logs to fluentd failed: %s", e)
+                self._stats["errors"] += 1
+                self._close()
+                return False
+            self._stats["messages"] += 1
+            self._stats["bytes"] += len(message)
+            return True
+
+    def _send(self, message, chunk=None):
+        self._reconnect()
+        self.socket.sendall(message)
+        if chunk is not None:
+            unpacker = msgpack.Unpacker(raw=False)
+            while True:
+                data = self.socket.recv(1024)
+                if not data:
+                    raise OSError("Connection closed while waiting for ack")
+                unpacker.feed(data)
+                for response in unpacker:
+                    if not isinstance(response, dict) or response.get("ack") != chunk:
+                        raise ValueError("Unexpected ack {}".format(response))
+                    return
+
+    def _reconnect(self):
+        if self.socket is None:
+            if self.host.startswith("unix://"):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                address = self.host[len("unix://"):]
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                address = (self.host, self.port)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+            self.socket = sock
+
+    def _close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            finally:
+                self.socket = None
+
+    def stats(self):
+        """Will return a dictionary with the number of sent messages,
+        records and bytes and the number of errors and dropped records.
+
+        :returns: Dictionary with counters
+        """
+        stats = dict(self._stats)
+        stats["pending"] = len(self._pendings)
+        return stats
+
+    def close(self):
+        """Send all batches and close the connection. Messages which
+        could not be sent are passed to the `overflow_handler`."""
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+        with self._lock:
+            self._closed = True
+        with self._send_lock:
+            self._close()
+            if self._pendings and self.overflow_handler:
+                pendings, self._pendings = self._pendings, []
+                self._pending_size = 0
+                try:
+                    self.overflow_handler([m[0] for m in pendings])
+                except Exception:
+                    log.exception("Log overflow handler failed")
+
+
+class PackedForwardHandler(logging.Handler):
+    """Logging handler which sends the records with a
+    :class:`PackedForwardSender` to fluentd. Records with an
+    :class:`tedega_share.encoder.Envelope` are sent in their msgpack
+    rendering. All other records are formatted with the formatter of
+    the handler, which is expected to return a dictionary like the
+    `FluentRecordFormatter`."""
+
+    def __init__(self, tag, host="localhost", port=24224, timeout=3.0, **kwargs):
+        """
+        :tag: Tag for fluentd log routing.
+        :host: Host where the fluentd is listening
+        :port: Port where the fluentd is listening
+        :timeout: Socket timeout in seconds
+        :kwargs: Further options of :class:`PackedForwardSender`
+        """
+        logging.Handler.__init__(self)
+        self.tag = tag
+        self.sender = PackedForwardSender(host=host, port=port,
+                                          timeout=timeout, **kwargs)
+
+    def emit(self, record):
+        if isinstance(record.msg, Envelope):
+            entry = b"".join((b"\x92", msgpack.packb(int(record.created)),
+                              record.msg.to_msgpack()))
+            self.sender.emit_packed(self.tag, entry)
+        else:
+            data = self.format(record)
+            self.sender.emit(self.tag, int(record.created), data)
+
+    def flush(self):
+        self.sender.flush()
+
+    def close(self):
+        self.acquire()
+        try:
+            self.sender.close()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+class EnvelopeSender(fluent_sender.FluentSender):
+    """FluentSender which embeds the msgpack rendering of an
+    :class:`tedega_share.encoder.Envelope` into the message."""
+
+    def _make_packet(self, label, timestamp, data):
+        if not isinstance(data, Envelope):
+            return fluent_sender.FluentSender._make_packet(self, label, timestamp, data)
+        if label:
+            tag = "%s.%s" % (self.tag, label) if self.tag else label
+        else:
+            tag = self.tag
+        if self.nanosecond_precision and isinstance(timestamp, float):
+            timestamp = fluent_sender.EventTime(timestamp)
+        return b"".join((b"\x93", msgpack.packb(tag, **self.msgpack_kwargs),
+                         msgpack.packb(timestamp, **self.msgpack_kwargs),
+                         data.to_msgpack()))
+
+
+class EnvelopeFluentHandler(fluent_handler.FluentHandler):
+    """FluentHandler which sends records with an
+    :class:`tedega_share.encoder.Envelope` in their msgpack rendering.
+    All other records are formatted with the formatter of the
+    handler."""
+
+    def getSenderClass(self):
+        return EnvelopeSender
+
+    def emit(self, record):
+        if not isinstance(record.msg, Envelope):
+            return fluent_handler.FluentHandler.emit(self, record)
+        sender = self.sender
+        if sender.nanosecond_precision:
+            timestamp = fluent_sender.EventTime(record.created)
+        else:
+            timestamp = int(record.created)
+        return sender.emit_with_time(None, timestamp, record.msg)
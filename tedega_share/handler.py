@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Logging handlers which decouple the application from the log transport.
+
+The :class:`AsyncHandler` puts records into a bounded in-memory queue
+and returns immediately. A background sender thread drains the queue
+and passes the records on to the wrapped target handler (e.g. the
+FluentHandler). This way a slow or unreachable fluentd does not add
+latency to the request which writes the log message.
+
+If the queue is full one of the following overflow policies applies:
+
+* **drop-newest**. The new record is discarded (default).
+* **drop-oldest**. The oldest queued record is discarded to make room
+  for the new one.
+* **block**. The caller waits up to `timeout` seconds for free space.
+  If there is still no space the new record is discarded.
+
+Every discarded record is counted and can be inspected with
+:meth:`AsyncHandler.stats`.
+
+Target handlers with a method `emit_batch(records)` get up to
+`batch_size` queued records at once, e.g the sinks of
+:mod:`tedega_share.sinks`.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+BLOCK = "block"
+
+OVERFLOW_POLICIES = [DROP_NEWEST, DROP_OLDEST, BLOCK]
+
+
+class AsyncHandler(logging.Handler):
+    """Handler which queues records and hands them over to the `target`
+    handler in a background thread."""
+
+    #: Maximum number of records passed to `emit_batch` of the target
+    batch_size = 256
+
+    def __init__(self, target, maxsize=10000, overflow=DROP_NEWEST, timeout=1.0):
+        """
+        :target: Handler which finally emits the records.
+        :maxsize: Maximum number of queued records.
+        :overflow: Policy applied when the queue is full. See
+        :data:`OVERFLOW_POLICIES`.
+        :timeout: Seconds to wait for free space with the `block` policy.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("{} overflow policy unknown.".format(overflow))
+        logging.Handler.__init__(self)
+        self.target = target
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.timeout = timeout
+
+        # Appending to and popping from a deque is thread safe, so the
+        # hot path of the caller does not need to take a lock. Locks
+        # are only used for the counters of dropped records and by the
+        # `block` policy.
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._not_full = threading.Condition(threading.Lock())
+        self._counter_lock = threading.Lock()
+        self._dropped = 0
+        self._sent = 0
+        self._errors = 0
+        # Number of records taken from the queue but not yet sent
+        self._pending = 0
+        self._closed = False
+        self._thread = threading.Thread(name="tedega_log_sender",
+                                        target=self._run, daemon=True)
+        self._thread.start()
+
+    def handle(self, record):
+        # The queue is thread safe on its own. Skip the handler lock
+        # which `logging.Handler.handle` would take for every record.
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        queue = self._queue
+        if self._closed:
+            self._drop()
+            return
+        if len(queue) >= self.maxsize:
+            if self.overflow == DROP_NEWEST:
+                self._drop()
+                return
+            elif self.overflow == DROP_OLDEST:
+                try:
+                    queue.popleft()
+                    self._drop()
+                except IndexError:
+                    pass
+            else:
+                with self._not_full:
+                    if not self._not_full.wait_for(lambda: len(queue) < self.maxsize,
+                                                   self.timeout):
+                        self._drop()
+                        return
+        queue.append(record)
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def _drop(self):
+        with self._counter_lock:
+            self._dropped += 1
+
+    def _run(self):
+        queue = self._queue
+        batch_size = self.batch_size
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while queue:
+                records = []
+                while queue and len(records) < batch_size:
+                    records.append(queue.popleft())
+                self._pending = len(records)
+                if self.overflow == BLOCK:
+                    with self._not_full:
+                        self._not_full.notify_all()
+                self._send(records)
+                self._pending = 0
+            if self._closed:
+                return
+
+    def _send(self, records):
+        target = self.target
+        emit_batch = getattr(target, "emit_batch", None)
+        if emit_batch is None:
+            for record in records:
+                try:
+                    target.handle(record)
+                    self._sent += 1
+                except Exception:
+                    self._errors += 1
+                    self.handleError(record)
+            return
+        records = [record for record in records if target.filter(record)]
+        if not records:
+            return
+        target.acquire()
+        try:
+            emit_batch(records)
+            self._sent += len(records)
+        except Exception:
+            self._errors += len(records)
+            self.handleError(records[0])
+        finally:
+            target.release()
+
+    def stats(self):
+        """Will return a dictionary with the current queue size and
+        the number of sent, dropped and failed records.
+
+        :returns: Dictionary with counters
+        """
+        return {"queued": len(self._queue),
+                "sent": self._sent,
+                "dropped": self._dropped,
+                "errors": self._errors}
+
+    def lag(self):
+        """Will return the seconds the oldest queued record is waiting."""
+        try:
+            return max(0.0, time.time() - self._queue[0].created)
+        except IndexError:
+            return 0.0
+
+    def flush(self, timeout=5.0):
+        """Wait until all queued records have been passed to the target
+        handler, at most `timeout` seconds, and flush the target."""
+        deadline = time.monotonic() + timeout
+        self._wakeup.set()
+        while self._queue or self._pending:
+            if not self._thread.is_alive() or time.monotonic() >= deadline:
+                break
+            time.sleep(0.005)
+        self.target.flush()
+
+    def close(self, timeout=5.0):
+        """Stop accepting records, send all queued records and close
+        the target handler."""
+        if not self._closed:
+            self._closed = True
+            self._wakeup.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join(timeout)
+            self.target.close()
+        logging.Handler.close(self)
@@ -2,20 +2,40 @@
 # -*- coding: utf-8 -*-
 import random
 import string
-from passlib.context import CryptContext
 
-pwd_context = CryptContext(
-    # replace this list with the hash(es) you wish to support.
-    # this example sets pbkdf2_sha256 as the default,
-    # with support for legacy md5 hashes.
-    schemes=["pbkdf2_sha256"],
-    default="pbkdf2_sha256",
+_pwd_context = None
 
-    # set the number of rounds that should be used...
-    # (appropriate values may vary for different schemes,
-    # and the amount of time you wish it to take)
-    pbkdf2_sha256__default_rounds=8000,
-)
+
+def get_pwd_context():
+    """Will return the passlib `CryptContext` used for the passwords.
+    It is created on first use, as importing passlib and building the
+    context is expensive.
+
+    :returns: `CryptContext`
+    """
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(
+            # replace this list with the hash(es) you wish to support.
+            # this example sets pbkdf2_sha256 as the default,
+            # with support for legacy md5 hashes.
+            schemes=["pbkdf2_sha256"],
+            default="pbkdf2_sha256",
+
+            # set the number of rounds that should be used...
+            # (appropriate values may vary for different schemes,
+            # and the amount of time you wish it to take)
+            pbkdf2_sha256__default_rounds=8000,
+        )
+    return _pwd_context
+
+
+def __getattr__(name):
+    # `pwd_context` used to be created on import.
+    if name == "pwd_context":
+        return get_pwd_context()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def generate_password(length=8):
@@ -38,7 +58,7 @@ def encrypt_password(password, scheme=None):
     CryptContext default
     :returns: encrypted password
     """
-    return pwd_context.encrypt(password, scheme=scheme)
+    return get_pwd_context().encrypt(password, scheme=scheme)
 
 
 def verify_password(password, pwhash):
@@ -48,4 +68,4 @@ def verify_password(password, pwhash):
     :pwhash: encrypted password
     :returns: True or False
     """
-    return pwd_context.verify(password, pwhash)
+    return get_pwd_context().verify(password, pwhash)
@@ -34,6 +34,10 @@ The following categories are logged:
   storage space in order to detect bottlenecks early. The
   corresponding category is *SYSTEM*.
 
+* **Profiles**. Optionally the stacks of all threads are sampled and
+  logged periodically as compressed folded stacks, see
+  :func:`profile`. The category is *PROFILE*.
+
 * **More information**. In addition to the information described above,
   of course also any other information can be logged as needed. These
   should then be categorized with *CUSTOM*.
@@ -71,15 +75,24 @@ LEVEL          Indicates whether the message is an ERROR, a WARNING, an INFO, or
 
 """
 
-import threading
-import collections
-import socket
-import time
+import functools
 import os
+import sys
 import logging
-import voorhees
-import psutil
-from fluent import handler
+import threading
+from time import perf_counter_ns
+
+from .handler import AsyncHandler, DROP_NEWEST
+from .encoder import EnvelopeEncoder, EnvelopeFormatter
+from .metrics import ConcurrencyAggregator, ProctimeAggregator
+from .tracing import _correlation_id, _current_span
+from .monitor import FunctionProbe, get_scheduler
+from .dedup import Deduplicator
+from .tailbuffer import TailBuffer
+
+# Modules with expensive imports (psutil, asyncio, fluent, msgpack) are
+# imported in the functions which need them, so importing the logger
+# stays fast for short-lived processes.
 
 custom_format = {
     'host': '%(hostname)s',
@@ -89,110 +102,705 @@ custom_format = {
 }
 
 CATEGORIES = ["PING", "SYSTEM", "PROCTIME",
-              "RETURNCODE", "REQUEST", "AUTH", "CUSTOM"]
+              "RETURNCODE", "REQUEST", "AUTH", "CUSTOM", "PROFILE"]
+
+TRANSPORTS = ["forward", "packed"]
 
 log = None
+proctime_aggregator = None
+#: Calls in flight of the functions, see :func:`track_concurrency`
+concurrency_aggregator = ConcurrencyAggregator()
+shared_metrics = None
 
 
 def log_proctime(func):
-    """Decorator to log the processing time of the decorated method."""
-    def wrap(*args, **kwargs):
-        started_at = time.time()
-        result = func(*args, **kwargs)
-        log.info({"time": time.time() - started_at, "func": "%s.%s" % (func.__module__, func.__name__)}, "PROCTIME")
-        return result
-    return wrap
+    """Decorator to log the processing time of the decorated method.
+
+    Coroutine functions are timed until the coroutine is finished.
+    Generators and asynchronous generators are timed while they are
+    producing items, the time spent by the consumer between the items
+    is not included. If the function raises an exception the time is
+    logged together with the name of the exception.
+
+    If the aggregation of processing times is enabled with
+    :func:`aggregate_proctime` the time is recorded in a histogram
+    instead of being logged on every call."""
+    import inspect
+    record = _proctime_recorder("%s.%s" % (func.__module__, func.__qualname__))
+
+    if inspect.iscoroutinefunction(func):
+        async def wrap(*args, **kwargs):
+            started_at = perf_counter_ns()
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException as e:
+                record(perf_counter_ns() - started_at, type(e).__name__)
+                raise
+            record(perf_counter_ns() - started_at)
+            return result
+
+    elif inspect.isasyncgenfunction(func):
+        async def wrap(*args, **kwargs):
+            agen = func(*args, **kwargs)
+            elapsed = 0
+            error = None
+            send, value = agen.asend, None
+            try:
+                while True:
+                    started_at = perf_counter_ns()
+                    try:
+                        item = await send(value)
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        elapsed += perf_counter_ns() - started_at
+                    send, value = agen.asend, None
+                    try:
+                        value = yield item
+                    except GeneratorExit:
+                        await agen.aclose()
+                        raise
+                    except BaseException as e:
+                        send, value = agen.athrow, e
+            except GeneratorExit:
+                raise
+            except BaseException as e:
+                error = type(e).__name__
+                raise
+            finally:
+                record(elapsed, error)
+
+    elif inspect.isgeneratorfunction(func):
+        def wrap(*args, **kwargs):
+            gen = func(*args, **kwargs)
+            elapsed = 0
+            error = None
+            send, value = gen.send, None
+            try:
+                while True:
+                    started_at = perf_counter_ns()
+                    try:
+                        item = send(value)
+                    except StopIteration as e:
+                        return e.value
+                    finally:
+                        elapsed += perf_counter_ns() - started_at
+                    send, value = gen.send, None
+                    try:
+                        value = yield item
+                    except GeneratorExit:
+                        gen.close()
+                        raise
+                    except BaseException as e:
+                        send, value = gen.throw, e
+            except GeneratorExit:
+                raise
+            except BaseException as e:
+                error = type(e).__name__
+                raise
+            finally:
+                record(elapsed, error)
+
+    else:
+        def wrap(*args, **kwargs):
+            started_at = perf_counter_ns()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                record(perf_counter_ns() - started_at, type(e).__name__)
+                raise
+            record(perf_counter_ns() - started_at)
+            return result
+
+    return functools.wraps(func)(wrap)
+
+
+def _proctime_recorder(name):
+    """Will return a function which records or logs the processing time
+    of the function with the given name. The histogram of the function
+    is cached to keep the overhead of every call low."""
+    cache = [None, None]
+
+    def record(proctime, error=None):
+        aggregator = proctime_aggregator
+        if aggregator is None:
+            message = {"time": proctime / 1e9, "func": name}
+            if error is not None:
+                message["error"] = error
+            log.info(message, "PROCTIME")
+            return
+        if aggregator is not cache[0]:
+            cache[:] = aggregator, aggregator.histogram(name).record
+        cache[1](proctime)
+        if error is not None:
+            aggregator.record_error(name, error)
+    return record
+
+
+def aggregate_proctime(interval=60):
+    """Aggregate the processing times of the functions decorated with
+    :func:`log_proctime` and log the statistics (count, min, max, mean
+    and the p50, p90, p99 and p999 percentiles) of every function once
+    in the given interval in seconds instead of one message per call.
+
+    The statistics are logged by the `proctime` probe of the monitor
+    scheduler, see :mod:`tedega_share.monitor`. Calling the function
+    again changes the interval.
+
+    :interval: Statistics are logged every X seconds
+    :returns: :class:`tedega_share.metrics.ProctimeAggregator`
+    """
+    global proctime_aggregator
+    if proctime_aggregator is None:
+        proctime_aggregator = ProctimeAggregator()
+    aggregator = proctime_aggregator
+    if shared_metrics is None:
+        check = functools.partial(_log_proctime_stats, aggregator)
+    else:
+        check = functools.partial(_share_proctime_stats, shared_metrics, aggregator)
+    get_scheduler().register(FunctionProbe("proctime", check, interval=interval))
+    return aggregator
+
+
+def track_concurrency(func=None, limit=None):
+    """Decorator to track the calls of the decorated function or
+    coroutine function which are in flight. Can be used with or without
+    arguments.
+
+    The current, peak and mean number of calls in flight and the
+    throughput are logged with :func:`aggregate_concurrency`. Together
+    with the processing times of :func:`log_proctime` this shows which
+    functions saturate their worker pool.
+
+    :limit: Maximum number of concurrent calls. Further calls wait for
+    a semaphore and the wait times are tracked too. For coroutine
+    functions the limit applies per event loop. If the decorator is
+    applied above :func:`log_proctime`, the wait is not included in the
+    processing time.
+    """
+    if func is None:
+        return functools.partial(track_concurrency, limit=limit)
+    import inspect
+    tracker = concurrency_aggregator.tracker("%s.%s" % (func.__module__, func.__qualname__),
+                                             limit)
+
+    if inspect.iscoroutinefunction(func):
+        if limit is not None:
+            import asyncio
+            import weakref
+            # An asyncio semaphore is bound to one event loop.
+            semaphores = weakref.WeakKeyDictionary()
+
+        async def wrap(*args, **kwargs):
+            if limit is None:
+                tracker.enter()
+            else:
+                loop = asyncio.get_running_loop()
+                semaphore = semaphores.get(loop)
+                if semaphore is None:
+                    semaphore = semaphores.setdefault(loop, asyncio.Semaphore(limit))
+                waiting_since = tracker.wait()
+                try:
+                    await semaphore.acquire()
+                except BaseException:
+                    tracker.abandon()
+                    raise
+                tracker.enter(waiting_since)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                tracker.exit()
+                if limit is not None:
+                    semaphore.release()
+
+    elif inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+        raise TypeError("Generator functions are not supported.")
+
+    else:
+        if limit is not None:
+            semaphore = threading.Semaphore(limit)
+
+        def wrap(*args, **kwargs):
+            if limit is None:
+                tracker.enter()
+            else:
+                waiting_since = tracker.wait()
+                try:
+                    semaphore.acquire()
+                except BaseException:
+                    tracker.abandon()
+                    raise
+                tracker.enter(waiting_since)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracker.exit()
+                if limit is not None:
+                    semaphore.release()
+
+    return functools.wraps(func)(wrap)
+
+
+def aggregate_concurrency(interval=60):
+    """Log the number of calls in flight of the functions decorated
+    with :func:`track_concurrency` once in the given interval in seconds
+    as PROCTIME message::
+
+        {"func": "users.api.get_user",
+         "concurrency": {"current": 3, "peak": 8, "mean": 4.2,
+                         "started": 1200, "completed": 1198,
+                         "throughput": 19.97, "limit": 8, "waiting": 0,
+                         "wait": {"count": 1200, "max": 0.2, ...}}}
+
+    `limit`, `waiting` and `wait` are only logged for functions with a
+    limit. Functions without calls in the interval are omitted.
+
+    The statistics are logged by the `concurrency` probe of the monitor
+    scheduler, see :mod:`tedega_share.monitor`. Calling the function
+    again changes the interval.
+
+    :interval: Statistics are logged every X seconds
+    :returns: :class:`tedega_share.metrics.ConcurrencyAggregator`
+    """
+    check = functools.partial(_log_concurrency_stats, concurrency_aggregator)
+    get_scheduler().register(FunctionProbe("concurrency", check, interval=interval))
+    return concurrency_aggregator
+
+
+def _log_concurrency_stats(aggregator):
+    for stats in aggregator.collect():
+        log.info(stats, "PROCTIME")
+
 
+def _log_proctime_stats(aggregator):
+    for stats in aggregator.collect():
+        log.info(stats, "PROCTIME")
 
-def monitor_system(interval=300, duration=10):
-    """Continually logging of CPU, RAM and DISK usage in the
-    given intervall in seconds. The CPU will be the averange for the
-    given duration.
+
+def _share_proctime_stats(shared, aggregator):
+    shared.publish({"precision": aggregator.precision,
+                    "functions": aggregator.export()})
+    if shared.is_leader():
+        for stats in shared.collect():
+            log.info(stats, "PROCTIME")
+
+
+def share_monitoring(path=None, interval=60, slots=64):
+    """Share the monitoring between the processes of the service on
+    this host, e.g the workers of a prefork server. Must be called in
+    every process after :func:`init_logger`.
+
+    Every process writes the aggregated processing times of its
+    functions into a shared memory mapped file. One process is elected
+    as leader. It logs the statistics of all processes and is the only
+    one running the `system` and `connectivity` checks, see
+    :mod:`tedega_share.multiprocess`. Enables :func:`aggregate_proctime`.
+
+    :path: Path of the shared file. Defaults to a file named after the
+    service in /dev/shm or the temporary directory.
+    :interval: Statistics are shared and logged every X seconds
+    :slots: Maximum number of processes
+    :returns: :class:`tedega_share.multiprocess.SharedMetrics`
+    """
+    from .multiprocess import SharedMetrics
+    global shared_metrics
+    if path is None:
+        import tempfile
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        path = os.path.join(directory, "tedega_%s.metrics" % log._service)
+    shared_metrics = SharedMetrics(path, slots)
+    get_scheduler().is_leader = shared_metrics.is_leader
+    aggregate_proctime(interval)
+    return shared_metrics
+
+
+def monitor_system(interval=300, duration=None):
+    """Continually logging of CPU, RAM, swap, DISK and network usage in
+    the given intervall in seconds. The CPU usage and the I/O rates are
+    the averages over the interval, see
+    :class:`tedega_share.system.SystemSampler`. The first message is
+    logged after the first interval.
+
+    The check runs as `system` probe of the monitor scheduler, see
+    :mod:`tedega_share.monitor`. Calling the function again replaces
+    the settings of the check.
 
     :interval: Check will be executed every X seconds
-    :duration: CPU is the averange of the given duration
+    :duration: Deprecated and ignored. The CPU is the averange of the
+    interval.
     """
-    def worker():
-        while 1:
-            _log_system(duration)
-            time.sleep(interval)
-    t = threading.Thread(name="monitor_system", target=worker, daemon=True)
-    t.start()
+    sampler = []
 
+    def check():
+        from .system import SystemSampler
+        if not sampler:
+            sampler.append(SystemSampler())
+        else:
+            _log_system(sampler[0])
+    probe = FunctionProbe("system", check, interval=interval)
+    probe.per_host = True
+    get_scheduler().register(probe)
+
+
+def _log_system(sampler):
+    log.info(sampler.sample(), "SYSTEM")
 
-def _log_system(interval):
-    cpu = psutil.cpu_percent(interval=interval, percpu=False)
-    memory = psutil.virtual_memory().percent
-    disk = psutil.disk_usage('/').percent
-    log.info({"cpu": cpu, "memory": memory, "disk": disk}, "SYSTEM")
 
+def monitor_container(interval=60):
+    """Continually logging of the CPU and memory usage of the cgroup
+    (e.g the container) of the service compared to its limits, how
+    often it was throttled for exceeding its CPU quota, the resource
+    pressure and the RSS, open files, threads, CPU usage and context
+    switches of the process, see :class:`tedega_share.cgroup.CgroupSampler`.
+    The messages are logged as SYSTEM. The first message is logged after
+    the first interval.
 
-def monitor_connectivity(hosts, interval=60):
+    The check runs as `container` probe of the monitor scheduler, see
+    :mod:`tedega_share.monitor`. Calling the function again replaces
+    the settings of the check.
+
+    :interval: Check will be executed every X seconds
+    :returns: :class:`tedega_share.cgroup.ContainerProbe`
+    """
+    from .cgroup import ContainerProbe
+    return get_scheduler().register(ContainerProbe(log, interval))
+
+
+def monitor_memory(interval=300, top=10, frames=1, duty_cycle=0.25, objects=10000):
+    """Continually logging of the allocation sites with the most growing
+    memory and of the number of objects by type, see
+    :mod:`tedega_share.memory`. The allocations are traced with
+    `tracemalloc` for the fraction `duty_cycle` of every interval. The
+    messages are logged as SYSTEM.
+
+    The check runs as `memory` probe of the monitor scheduler, see
+    :mod:`tedega_share.monitor`. Calling the function again replaces
+    the settings of the check. Unregistering the probe stops tracing.
+
+    :interval: Growth is logged every X seconds
+    :top: Number of reported allocation sites and object types
+    :frames: Depth of the traceback of an allocation site
+    :duty_cycle: Fraction of the interval in which the allocations are
+    traced (0 - 1)
+    :objects: Maximum number of objects sampled to count the types
+    :returns: :class:`tedega_share.memory.MemoryProbe`
+    """
+    from .memory import MemoryProbe
+    return get_scheduler().register(MemoryProbe(log, interval, top, frames,
+                                                duty_cycle, objects))
+
+
+def monitor_runtime(interval=60, loop=None, heartbeat=0.1, threshold=0.25):
+    """Continually logging of the pauses of the garbage collector by
+    generation and of the lag of an asyncio event loop, see
+    :mod:`tedega_share.runtime`. If the loop is blocked for more than
+    `threshold` seconds, the stack of the blocking callback is logged
+    too. The messages are logged as SYSTEM.
+
+    The check runs as `runtime` probe of the monitor scheduler, see
+    :mod:`tedega_share.monitor`. Calling the function again replaces
+    the settings of the check.
+
+    :interval: Statistics are logged every X seconds
+    :loop: asyncio event loop. Defaults to the running loop if called
+    from a coroutine, else only the garbage collector is monitored.
+    :heartbeat: Seconds between two heartbeats on the loop
+    :threshold: Seconds after which the loop counts as blocked
+    :returns: :class:`tedega_share.runtime.RuntimeProbe`
+    """
+    from .runtime import GCMonitor, LoopMonitor, RuntimeProbe
+    if loop is None and "asyncio" in sys.modules:
+        try:
+            loop = sys.modules["asyncio"].get_running_loop()
+        except RuntimeError:
+            pass
+    gc_monitor = GCMonitor()
+    loop_monitor = None
+    if loop is not None:
+        loop_monitor = LoopMonitor(loop, heartbeat, threshold)
+    probe = get_scheduler().register(RuntimeProbe(log, gc_monitor, loop_monitor, interval))
+    gc_monitor.install()
+    if loop_monitor is not None:
+        loop_monitor.start()
+    return probe
+
+
+def monitor_connectivity(hosts, interval=60, timeout=5.0, dns_ttl=300,
+                         report_interval=900):
     """Continually check and log the connection to the list of given
     hosts in the given intervall in seconds.
 
+    The check runs as `connectivity` probe of the monitor scheduler,
+    see :mod:`tedega_share.monitor`. Calling the function again
+    replaces the settings of the check. All hosts are checked
+    concurrently and only changes of their state are logged, see
+    :mod:`tedega_share.connectivity`.
+
     :hosts: List of tuples (hostname, port)
     :interval: Check will be executed every X seconds
+    :timeout: Timeout in seconds for the check of one host
+    :dns_ttl: Seconds the resolved addresses of the hosts are cached
+    :report_interval: The state of all hosts is logged every X
+    seconds. If None only the changes are logged.
     """
-    def worker(hosts):
-        while 1:
-            _log_connectivity(hosts)
-            time.sleep(interval)
-    t = threading.Thread(name="monitor_connectivity", target=worker, args=(hosts,), daemon=True)
-    t.start()
-
-
-def _log_connectivity(hosts):
-    result = collections.OrderedDict()
-    for host, port in hosts:
-        try:
-            socket.create_connection((host, port))
-            result[host] = True
-        except OSError:
-            result[host] = False
-    log.info(result, "PING")
+    from .connectivity import ConnectivityProbe
+    get_scheduler().register(ConnectivityProbe(hosts, interval, timeout, dns_ttl,
+                                               report_interval))
+
+
+def profile(interval=60, rate=50.0, max_overhead=0.01, max_stacks=1000):
+    """Sample the stacks of all threads `rate` times per second and log
+    the counted folded stacks of every interval as PROFILE message, see
+    :mod:`tedega_share.profiler`. The rate is lowered if sampling takes
+    more than `max_overhead` of the time. Calling the function again
+    replaces the settings. The rate and the overhead cap can be changed
+    at runtime with :meth:`tedega_share.profiler.StackSampler.set_rate`
+    of the `sampler` of the returned probe.
+
+    :interval: Profile is logged every X seconds
+    :rate: Samples per second
+    :max_overhead: Maximum fraction of the time spent sampling
+    :max_stacks: Only the most frequent stacks are logged.
+    :returns: :class:`tedega_share.profiler.ProfileProbe`
+    """
+    from .profiler import ProfileProbe, StackSampler
+    sampler = StackSampler(rate, max_overhead)
+    probe = get_scheduler().register(ProfileProbe(log, sampler, interval, max_stacks))
+    sampler.start()
+    return probe
+
+
+def deduplicate(window=10.0, max_fingerprints=1000, fields=None):
+    """Suppress repetitions of the same message for the given window in
+    seconds and log a summary with the number of suppressed messages
+    instead, see :mod:`tedega_share.dedup`. Calling the function again
+    replaces the settings.
+
+    :window: Seconds in which repetitions are suppressed
+    :max_fingerprints: Maximum number of remembered messages
+    :fields: List of fields which identify a dictionary message.
+    Defaults to all fields.
+    :returns: :class:`tedega_share.dedup.Deduplicator`
+    """
+    for f in log._filters:
+        if isinstance(f, Deduplicator):
+            log.remove_filter(f)
+    deduplicator = Deduplicator(log, window, max_fingerprints, fields)
+    log.add_filter(deduplicator)
+    get_scheduler().register(deduplicator)
+    return deduplicator
+
+
+def buffer_requests(max_records=200, max_total=20000, latency=None,
+                    buffer_level=logging.INFO):
+    """Buffer the DEBUG and INFO messages of every request and only log
+    them if the request fails, see :mod:`tedega_share.tailbuffer`. A
+    request fails if an ERROR is logged, its RETURNCODE is 500 or
+    higher or it took longer than `latency` seconds. Messages below
+    INFO are only logged for failed requests.
+
+    As a side effect the level of the Python logger is set to DEBUG, so
+    the DEBUG messages reach the buffer. The level is not restored if
+    the filter is removed again.
+
+    :max_records: Maximum number of buffered messages per request
+    :max_total: Maximum number of buffered messages of all requests
+    :latency: Log the messages of requests which took longer than X
+    seconds.
+    :buffer_level: Messages up to this level are buffered.
+    :returns: :class:`tedega_share.tailbuffer.TailBuffer`
+    """
+    for f in log._filters:
+        if isinstance(f, TailBuffer):
+            log.remove_filter(f)
+    tail = TailBuffer(log, max_records, max_total, latency, buffer_level)
+    log.add_filter(tail)
+    log._logger.setLevel(logging.DEBUG)
+    return tail
+
+
+def adapt_logging(interval=5, stages=None, queue=(0.1, 0.5), lag=(0.2, 1.0),
+                  cpu=(70.0, 90.0), recover_after=3):
+    """Reduce the logged messages while the service is under pressure,
+    see :mod:`tedega_share.adaptive`. As the queues of the asynchronous
+    handlers fill, the senders lag behind or the CPU usage since the
+    last check rises, DEBUG messages are dropped first and
+    then REQUEST and PROCTIME messages are sampled. ERROR and AUTH
+    messages are never dropped. Calling the function again replaces
+    the settings.
+
+    :interval: Pressure is checked every X seconds
+    :stages: List of dictionaries with the rate of the messages by
+    level or category for every stage.
+    :queue: Tuple of the low and high fill level (0 - 1) of the queues
+    :lag: Tuple of the low and high lag of the senders in seconds
+    :cpu: Tuple of the low and high CPU usage in percent
+    :recover_after: Number of checks with low pressure before the
+    verbosity is raised again.
+    :returns: :class:`tedega_share.adaptive.AdaptiveController`
+    """
+    from .adaptive import AdaptiveController
+    from .system import CpuMeter
+    for f in log._filters:
+        if isinstance(f, AdaptiveController):
+            log.remove_filter(f)
+    controller = AdaptiveController(log, stages, queue, lag, cpu, recover_after,
+                                    CpuMeter(), interval)
+    log.add_filter(controller)
+    get_scheduler().register(controller)
+    return controller
+
+
+def export_metrics(port=9464, host="", interval=15, log_metrics=True):
+    """Serve the metrics of the service in the OpenMetrics text format
+    at http://<host>:<port>/metrics, e.g for Prometheus, see
+    :mod:`tedega_share.exporter`. The SYSTEM and PING messages are
+    exported as gauges and the processing times as histograms. Enables
+    :func:`aggregate_proctime`. Calling the function again replaces
+    the exporter.
+
+    :port: Port of the HTTP server
+    :host: Address of the HTTP server. Defaults to all addresses.
+    :interval: The processing times are exported every X seconds.
+    :log_metrics: Log the SYSTEM, PING and PROCTIME messages in
+    addition to exporting them.
+    :returns: :class:`tedega_share.exporter.MetricsExporter`
+    """
+    from .exporter import MetricsExporter
+    for f in log._filters:
+        if isinstance(f, MetricsExporter):
+            log.remove_filter(f)
+    # Stops the server of a previous exporter.
+    get_scheduler().unregister("metrics")
+    aggregator = proctime_aggregator or aggregate_proctime()
+    exporter = MetricsExporter(aggregator=aggregator, log_metrics=log_metrics,
+                               interval=interval)
+    exporter.serve(host, port)
+    log.add_filter(exporter)
+    get_scheduler().register(exporter)
+    return exporter
+
+
+class Entry(object):
+    """A message passed to the filters of a :class:`Logger` before it
+    is built. Filters may add fields to `extra` which are added to the
+    logged message."""
+
+    __slots__ = ("level", "message", "category", "correlation_id", "extra")
+
+    def __init__(self, level, message, category, correlation_id):
+        self.level = level
+        self.message = message
+        self.category = category
+        self.correlation_id = correlation_id
+        self.extra = None
 
 
 class Logger(object):
     """Wrapper around the Python logger to ensure a specific log
-    format."""
-    def __init__(self, logger, service):
+    format.
+
+    The messages are encoded by an
+    :class:`tedega_share.encoder.EnvelopeEncoder`. The encoding is
+    deferred until a handler needs the message.
+
+    The message is only built if the level of the message is enabled
+    on the underlying logger. The message may also be a callable which
+    returns the string or dictionary to log. It is only called if the
+    message is actually written, which allows to log expensive payloads
+    in hot paths at nearly no cost::
+
+        log.debug(lambda: {"state": expensive_dump()})
+
+    Filters added with :meth:`add_filter` decide which messages are
+    written, e.g a :class:`tedega_share.sampling.Sampler`. A filter
+    has a method `filter(entry)` which gets an :class:`Entry` and
+    returns False to drop the message.
+    """
+    def __init__(self, logger, service, encoder=None):
         self._logger = logger
         self._service = service
-
-    def _build_message(self, message, category, correlation_id):
+        self._encoder = encoder or EnvelopeEncoder(service)
+        self._filters = []
+
+    def add_filter(self, filter):
+        """Add a filter which is called for every message of an enabled
+        level.
+
+        :filter: Object with a method `filter(entry)`
+        """
+        self._filters = self._filters + [filter]
+
+    def remove_filter(self, filter):
+        """Remove a filter added with :meth:`add_filter`."""
+        self._filters = [f for f in self._filters if f is not filter]
+
+    def _build_message(self, message, category, correlation_id, extra=None):
+        if callable(message):
+            message = message()
+        # Add the span of the current request, see
+        # :mod:`tedega_share.tracing`.
+        span = _current_span.get()
+        if span is not None:
+            extra = dict(extra or {}, span_id=span.span_id)
+        return self._encoder.envelope(message, category, correlation_id, extra)
+
+    def _log(self, level, message, category, correlation_id):
         if category is not None and category not in CATEGORIES:
             raise ValueError("{} logging category unknown.".format(category))
-        msg = collections.OrderedDict()
-        msg["service"] = self._service
-        msg["category"] = category
-        msg["correlation_id"] = correlation_id
-
-        if isinstance(message, dict):
-            msg.update(message)
-        else:
-            msg["message"] = message
-        return voorhees.to_json(msg)
+        # The Python logger caches the result of `isEnabledFor` and
+        # clears the cache if the level of any logger is changed.
+        if not self._logger.isEnabledFor(level):
+            return
+        # Add the correlation_id of the current request, see
+        # :mod:`tedega_share.tracing`.
+        if correlation_id is None:
+            correlation_id = _correlation_id.get()
+        extra = None
+        filters = self._filters
+        if filters:
+            entry = Entry(level, message, category, correlation_id)
+            for f in filters:
+                if not f.filter(entry):
+                    return
+            extra = entry.extra
+        self.emit(level, message, category, correlation_id, extra)
+
+    def emit(self, level, message, category=None, correlation_id=None, extra=None):
+        """Write the message without calling the filters, e.g for
+        messages created by a filter.
+
+        :level: Level of the message, e.g `logging.DEBUG`
+        :message: String, dictionary or callable returning one of them
+        :category: Category of the message
+        :correlation_id: Correlation id of the message
+        :extra: Dictionary with fields added to the message
+        """
+        self._logger.log(level, self._build_message(message, category, correlation_id, extra))
+
+    def is_enabled_for(self, level):
+        """Will return True if messages of the given level are written.
+
+        :level: Level of the message, e.g `logging.DEBUG`
+        :returns: True or False
+        """
+        return self._logger.isEnabledFor(level)
 
     def debug(self, message, category=None, correlation_id=None):
         """Write a debug message."""
-        message = self._build_message(message, category, correlation_id)
-        self._logger.debug(message)
+        self._log(logging.DEBUG, message, category, correlation_id)
 
     def info(self, message, category=None, correlation_id=None):
         """Write a info message."""
-        message = self._build_message(message, category, correlation_id)
-        self._logger.info(message)
+        self._log(logging.INFO, message, category, correlation_id)
 
     def error(self, message, category=None, correlation_id=None):
         """Write a error message."""
-        message = self._build_message(message, category, correlation_id)
-        self._logger.error(message)
+        self._log(logging.ERROR, message, category, correlation_id)
 
     def warning(self, message, category=None, correlation_id=None):
         """Write a warning message."""
-        message = self._build_message(message, category, correlation_id)
-        self._logger.warning(message)
+        self._log(logging.WARNING, message, category, correlation_id)
 
 
 def build_tag(service):
@@ -213,6 +821,7 @@ def build_tag(service):
     :returns: Logging tag
 
     """
+    import socket
     tag = []
     hostname = os.environ.get("DOCKER_HOSTNAME", socket.gethostname())
     tag.append(hostname)
@@ -223,27 +832,105 @@ def build_tag(service):
     return ".".join(tag)
 
 
-def init_logger(service, host="fluentd", port=24224):
+def init_logger(service, host="fluentd", port=24224,
+                asynchronous=False, queue_size=10000, overflow=DROP_NEWEST,
+                timeout=1.0, transport="forward", compress=False, ack=False,
+                spill_dir=None, sinks=None):
     """Will initialise a global :class:`Logger` instance to log to fluentd.
 
+    The `forward` transport sends every record as its own message. The
+    `packed` transport batches the records and sends them as
+    PackedForward messages, see
+    :class:`tedega_share.forward.PackedForwardSender`.
+
+    In asynchronous mode the records are put into a bounded queue and
+    sent to fluentd by a background thread, see
+    :class:`tedega_share.handler.AsyncHandler`. Queued records are
+    flushed when the interpreter shuts down.
+
     :tag: String used as tag for fluentd log routing.
     :host: Host where the fluentd is listening
     :port: Port where the fluentd is listening
+    :asynchronous: Send the records in a background thread.
+    :queue_size: Maximum number of queued records in asynchronous mode.
+    :overflow: Policy if the queue is full. One of
+    :data:`tedega_share.handler.OVERFLOW_POLICIES`.
+    :timeout: Seconds to wait for free space with the `block` policy.
+    :transport: One of :data:`TRANSPORTS`.
+    :compress: Compress the batches of the `packed` transport with gzip.
+    :ack: Wait for fluentd to acknowledge the batches of the `packed`
+    transport.
+    :spill_dir: Directory where records are stored which exceed the
+    buffer of the sender while fluentd is not reachable. They are sent
+    again once fluentd is back, see :mod:`tedega_share.spill`.
+    :sinks: List of additional sinks, e.g a
+    :class:`tedega_share.sinks.StreamSink` for stdout or a
+    :class:`tedega_share.sinks.FileSink`. If given, every sink and
+    fluentd get their own queue and sender thread, and the records are
+    no longer written to stderr by the root logger.
 
     """
+    if transport not in TRANSPORTS:
+        raise ValueError("{} transport unknown.".format(transport))
 
     tag = build_tag(service)
-    logging.basicConfig(level=logging.INFO)
     l = logging.getLogger(tag)
-    h = handler.FluentHandler(tag, host=host, port=port)
-    formatter = handler.FluentRecordFormatter(custom_format)
+    if sinks is None:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        l.setLevel(logging.INFO)
+        l.propagate = False
+    spill = None
+    if spill_dir:
+        from .spill import SpillBuffer
+        spill = SpillBuffer(spill_dir)
+    if transport == "packed":
+        from .forward import PackedForwardHandler
+        h = PackedForwardHandler(tag, host=host, port=port,
+                                 compress=compress, ack=ack,
+                                 overflow_handler=spill and spill.extend)
+        send = h.sender.send_message
+    else:
+        from .forward import EnvelopeFluentHandler
+        h = EnvelopeFluentHandler(tag, host=host, port=port,
+                                  buffer_overflow_handler=spill and spill.append)
+        send = _fluent_replay(h.sender)
+    if spill is not None:
+        from .spill import SpillReplayProbe
+        get_scheduler().register(SpillReplayProbe(spill, send))
+    formatter = EnvelopeFormatter(custom_format)
     h.setFormatter(formatter)
+    if asynchronous or sinks is not None:
+        h = AsyncHandler(h, maxsize=queue_size, overflow=overflow, timeout=timeout)
     l.addHandler(h)
+    for sink in sinks or []:
+        h = AsyncHandler(sink, maxsize=queue_size, overflow=overflow, timeout=timeout)
+        h.setLevel(sink.level)
+        l.addHandler(h)
 
     global log
     log = Logger(l, service)
 
 
+def _fluent_replay(sender):
+    """Will return a function which sends spilled messages with the
+    given `fluent.sender.FluentSender`."""
+    def send(data):
+        # Keep the messages on disk as long as the sender can not send
+        # its own buffer.
+        if sender.pendings:
+            return False
+        import msgpack
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(data)
+        for message in unpacker:
+            # Messages which can not be sent end up in the buffer of
+            # the sender and are spilled again if it overflows.
+            sender.emit_with_time(None, message[1], message[2])
+        return True
+    return send
+
+
 def get_logger():
     """Will return the global :class:`Logger` instance. Will raise an
     exception if the Logger is not initialised.
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Reporting of the memory growth of the service.
+
+The :class:`MemoryProbe` traces the allocations of the process with
+`tracemalloc`, compares a snapshot of the traced blocks with a baseline
+and logs the allocation sites which grew the most as *SYSTEM* message::
+
+        {"tracemalloc": {"traced": 10485760, "peak": 12582912,
+                         "growth": 1048576, "duration": 0.05, "window": 75.0,
+                         "top": [{"site": "app/cache.py:42", "size": 1048576,
+                                  "size_diff": 1048576, "count": 1024,
+                                  "count_diff": 1024}, ...]},
+         "objects": {"total": 150000, "sampled": 10000,
+                     "types": {"dict": 60000, ...}, "growth": {"Session": 300, ...}}}
+
+`objects` counts the objects tracked by the garbage collector by type
+from a sample of `gc.get_objects`. `growth` is the change of the counts
+since the previous report.
+
+Tracing slows down every allocation, more with deeper tracebacks, so
+the depth is given by `frames` and tracing is only enabled for the
+fraction `duty_cycle` of the interval: the baseline is taken when
+tracing starts and the report is logged when it stops, so the report
+shows the blocks which were allocated in this window and are still
+alive. A leak shows up in every window. With a duty cycle of 1 tracing
+is never stopped and every report is compared with the first snapshot.
+"""
+
+import gc
+import time
+import tracemalloc
+
+from .monitor import Probe, get_scheduler
+
+#: Traces of the import machinery, of tracemalloc and of the probe
+#: itself are ignored.
+FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),
+           tracemalloc.Filter(False, __file__),
+           tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+           tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"))
+
+
+def _site(traceback):
+    return "; ".join("%s:%d" % (frame.filename, frame.lineno) for frame in traceback)
+
+
+def _type_name(obj):
+    cls = type(obj)
+    if cls.__module__ == "builtins":
+        return cls.__qualname__
+    return "%s.%s" % (cls.__module__, cls.__qualname__)
+
+
+class MemoryProbe(Probe):
+    """Probe which logs the growth of the traced memory."""
+
+    def __init__(self, logger, interval=300, top=10, frames=1, duty_cycle=0.25,
+                 objects=10000, name="memory"):
+        """
+        :logger: :class:`tedega_share.logger.Logger`
+        :interval: Growth is logged every X seconds.
+        :top: Number of reported allocation sites and object types
+        :frames: Depth of the traceback of an allocation site
+        :duty_cycle: Fraction of the interval in which the allocations
+        are traced (0 - 1)
+        :objects: Maximum number of objects sampled to count the types.
+        0 disables the counting.
+        """
+        if not 0 < duty_cycle <= 1:
+            raise ValueError("Duty cycle must be greater than 0 and at most 1.")
+        Probe.__init__(self, name, interval)
+        self.logger = logger
+        self.period = interval
+        self.top = top
+        self.frames = frames
+        self.duty_cycle = duty_cycle
+        self.objects = objects
+        self._baseline = None
+        self._started_at = None
+        self._tracing = False
+        self._types = None
+
+    def _reschedule(self, interval):
+        scheduler = get_scheduler()
+        if scheduler.probes.get(self.name) is self:
+            scheduler.reconfigure(self.name, interval=interval)
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(FILTERS)
+
+    def start(self):
+        """Start tracing and take the baseline."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._tracing = True
+        self._baseline = self._snapshot()
+        self._started_at = time.monotonic()
+
+    def stop(self):
+        """Stop tracing if it was started by the probe."""
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        self._baseline = None
+
+    def run(self):
+        if self._baseline is None:
+            self.start()
+            if self.duty_cycle < 1:
+                self._reschedule(self.period * self.duty_cycle)
+            return
+        self.logger.info(self.report(), "SYSTEM")
+        if self.duty_cycle < 1:
+            self.stop()
+            self._reschedule(self.period * (1 - self.duty_cycle))
+
+    def report(self):
+        """Will return the growth since the baseline."""
+        started_at = time.perf_counter()
+        key = "lineno" if self.frames == 1 else "traceback"
+        stats = self._snapshot().compare_to(self._baseline, key)
+        current, peak = tracemalloc.get_traced_memory()
+        top = [{"site": _site(stat.traceback),
+                "size": stat.size,
+                "size_diff": stat.size_diff,
+                "count": stat.count,
+                "count_diff": stat.count_diff}
+               for stat in stats if stat.size_diff > 0][:self.top]
+        result = {"tracemalloc": {"traced": current,
+                                  "peak": peak,
+                                  "growth": sum(stat.size_diff for stat in stats),
+                                  "window": round(time.monotonic() - self._started_at, 3),
+                                  "top": top}}
+        if self.objects:
+            result["objects"] = self.count_objects()
+        result["tracemalloc"]["duration"] = round(time.perf_counter() - started_at, 3)
+        return result
+
+    def count_objects(self):
+        """Will return the estimated number of objects tracked by the
+        garbage collector by type and the growth since the last call."""
+        objects = gc.get_objects()
+        total = len(objects)
+        step = max(1, total // self.objects)
+        counts = {}
+        for obj in objects[::step]:
+            name = _type_name(obj)
+            counts[name] = counts.get(name, 0) + step
+        del objects
+        previous, self._types = self._types, counts
+        result = {"total": total,
+                  "sampled": (total + step - 1) // step,
+                  "types": dict(sorted(counts.items(), key=lambda item: -item[1])[:self.top])}
+        if previous is not None:
+            growth = [(name, count - previous.get(name, 0)) for name, count in counts.items()]
+            result["growth"] = dict(item for item in sorted(growth, key=lambda item: -item[1])
+                                    [:self.top] if item[1] > 0)
+        return result
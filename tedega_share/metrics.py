@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process aggregation of metrics.
+
+Instead of logging every single measurement the values are recorded
+into histograms and only the aggregated statistics are logged
+periodically.
+
+The :class:`Histogram` uses log-linear buckets like the HdrHistogram:
+Every power of two is divided into a fixed number of linear sub
+buckets, so the relative error of a recorded value is bound by the
+`precision` while the memory for the buckets is fixed.
+
+To avoid locking in the hot path every thread records into its own
+shard of a :class:`ShardedHistogram`. The shards are only merged when
+the statistics are collected.
+
+The :class:`ConcurrencyTracker` counts the calls of a function which
+are in flight and the time they waited for an optional limiter.
+"""
+
+import threading
+import weakref
+from time import perf_counter_ns
+
+
+class Histogram(object):
+    """Log-linear histogram for non negative integer values."""
+
+    def __init__(self, precision=5):
+        """
+        :precision: Number of bits used for the sub buckets. The relative
+        error of the values is below 2^-(precision-1).
+        """
+        self.precision = precision
+        self._sub = 1 << precision
+        self._half = self._sub >> 1
+        self.counts = [0] * (self.index((1 << 64) - 1) + 1)
+        self.sum = 0
+
+    def index(self, value):
+        """Will return the index of the bucket for the given value."""
+        if value < self._sub:
+            return value
+        shift = value.bit_length() - self.precision
+        return (shift << (self.precision - 1)) + (value >> shift)
+
+    def bounds(self, index):
+        """Will return the lowest and highest value of the bucket with
+        the given index."""
+        if index < self._sub:
+            return index, index
+        shift, mantissa = divmod(index, self._half)
+        shift -= 1
+        low = (mantissa + self._half) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, value):
+        """Record a value."""
+        if value < 0:
+            value = 0
+        self.counts[self.index(value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        """Add the counts of the other histogram to this histogram."""
+        counts = self.counts
+        for i, count in enumerate(other.counts):
+            if count:
+                counts[i] += count
+        self.sum += other.sum
+
+    def copy(self):
+        histogram = Histogram(self.precision)
+        histogram.merge(self)
+        return histogram
+
+    def diff(self, other):
+        """Will return a new histogram with the values recorded in this
+        histogram but not in the other (older) histogram."""
+        histogram = Histogram(self.precision)
+        histogram.counts = [a - b for a, b in zip(self.counts, other.counts)]
+        histogram.sum = self.sum - other.sum
+        return histogram
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, percent):
+        """Will return the value at the given percentile. The value is
+        the midpoint of the bucket containing the percentile.
+
+        :percent: Percentile in range 0 - 100
+        :returns: Value or None if the histogram is empty
+        """
+        total = self.count
+        if not total:
+            return None
+        rank = max(1, int(round(total * percent / 100.0)))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count:
+                seen += count
+                if seen >= rank:
+                    low, high = self.bounds(i)
+                    return (low + high) // 2
+
+    def stats(self, scale=1):
+        """Will return a dictionary with count, min, max, mean and the
+        p50, p90, p99 and p999 percentiles. The values are divided by
+        the given `scale`.
+
+        :scale: Divisor for the values, e.g to convert ns into s.
+        :returns: Dictionary with the statistics
+        """
+        counts = self.counts
+        total = self.count
+        if not total:
+            return {"count": 0}
+        first = next(i for i, c in enumerate(counts) if c)
+        last = len(counts) - next(i for i, c in enumerate(reversed(counts)) if c) - 1
+        return {"count": total,
+                "min": self.bounds(first)[0] / scale,
+                "max": self.bounds(last)[1] / scale,
+                "mean": self.sum / total / scale,
+                "p50": self.percentile(50) / scale,
+                "p90": self.percentile(90) / scale,
+                "p99": self.percentile(99) / scale,
+                "p999": self.percentile(99.9) / scale}
+
+
+class ShardedHistogram(object):
+    """Histogram with one shard per recording thread. Recording does
+    not need any lock as every thread only writes into its own shard.
+
+    The shards of finished threads are merged into one retired shard,
+    so a server starting a thread per request does not accumulate
+    shards."""
+
+    def __init__(self, precision=5):
+        self.precision = precision
+        self._local = threading.local()
+        # List of (weak reference to the thread, shard)
+        self._shards = []
+        self._retired = Histogram(precision)
+        self._retire_at = 64
+        self._lock = threading.Lock()
+        #: Record a value.
+        self.record = self._recorder()
+
+    def _new_shard(self):
+        shard = Histogram(self.precision)
+        with self._lock:
+            if len(self._shards) >= self._retire_at:
+                self._retire()
+                self._retire_at = max(64, 2 * len(self._shards))
+            self._shards.append((weakref.ref(threading.current_thread()), shard))
+        self._local.shard = shard
+        return shard
+
+    def _retire(self):
+        """Merge the shards of finished threads into the retired shard.
+        Must be called with the lock held."""
+        alive = []
+        for ref, shard in self._shards:
+            thread = ref()
+            if thread is not None and thread.is_alive():
+                alive.append((ref, shard))
+            else:
+                self._retired.merge(shard)
+        self._shards = alive
+
+    def _recorder(self):
+        """Will return the function used as `record`. It is the
+        same as `Histogram.record` but inlined and working on local
+        variables only, as it is called for every measured function
+        call."""
+        local = self._local
+        new_shard = self._new_shard
+        bits = self.precision
+        shift_bits = bits - 1
+        sub = 1 << bits
+
+        def record(value):
+            try:
+                shard = local.shard
+            except AttributeError:
+                shard = new_shard()
+            if value < sub:
+                if value < 0:
+                    value = 0
+                shard.counts[value] += 1
+            else:
+                shift = value.bit_length() - bits
+                shard.counts[(shift << shift_bits) + (value >> shift)] += 1
+            shard.sum += value
+        return record
+
+    def snapshot(self):
+        """Will return a :class:`Histogram` with all values recorded so
+        far in all threads."""
+        histogram = Histogram(self.precision)
+        with self._lock:
+            self._retire()
+            histogram.merge(self._retired)
+            shards = [shard for ref, shard in self._shards]
+        for shard in shards:
+            histogram.merge(shard)
+        return histogram
+
+
+class ProctimeAggregator(object):
+    """Aggregates the processing times of functions in nanoseconds."""
+
+    def __init__(self, precision=5):
+        self.precision = precision
+        self._histograms = {}
+        self._last = {}
+        self._errors = {}
+        # Error counts since the start, which are not reset by collect.
+        self._error_totals = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        """Will return the :class:`ShardedHistogram` for the given name."""
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, ShardedHistogram(self.precision))
+        return histogram
+
+    def record(self, name, value, error=None):
+        """Record a processing time.
+
+        :name: Name of the function
+        :value: Processing time in nanoseconds
+        :error: Name of the exception if the function failed.
+        """
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self.histogram(name)
+        histogram.record(value)
+        if error is not None:
+            self.record_error(name, error)
+
+    def record_error(self, name, error):
+        """Count a failed call.
+
+        :name: Name of the function
+        :error: Name of the exception
+        """
+        with self._lock:
+            for counts in (self._errors, self._error_totals):
+                errors = counts.setdefault(name, {})
+                errors[error] = errors.get(error, 0) + 1
+
+    def collect(self):
+        """Will return a list of dictionaries with the statistics of
+        every function since the last call. Times are in seconds.
+        Functions without calls since the last collection are omitted.
+
+        :returns: List of dictionaries
+        """
+        with self._lock:
+            histograms = list(self._histograms.items())
+            errors, self._errors = self._errors, {}
+        result = []
+        for name, histogram in histograms:
+            current = histogram.snapshot()
+            last = self._last.get(name)
+            self._last[name] = current
+            interval = current.diff(last) if last else current
+            stats = interval.stats(scale=1e9)
+            if not stats["count"]:
+                continue
+            stats["func"] = name
+            if name in errors:
+                stats["errors"] = errors[name]
+            result.append(stats)
+        return result
+
+    def export(self):
+        """Will return the cumulative histograms and error counts of all
+        functions in a compact form, e.g to share them with other
+        processes.
+
+        :returns: Dictionary with a list `[sum, [[index, count], ...],
+        errors]` by function name
+        """
+        with self._lock:
+            histograms = list(self._histograms.items())
+            errors = dict((name, dict(counts)) for name, counts in self._error_totals.items())
+        result = {}
+        for name, histogram in histograms:
+            snapshot = histogram.snapshot()
+            result[name] = [snapshot.sum,
+                            [[i, count] for i, count in enumerate(snapshot.counts) if count],
+                            errors.get(name, {})]
+        return result
+
+
+class ConcurrencyTracker(object):
+    """Tracks the calls of a function which are in flight.
+
+    Besides the current number of calls it integrates the number over
+    the time, so the mean concurrency of an interval is known. By
+    Little's law it is the throughput times the mean processing time; if
+    it approaches the size of the worker pool or the `limit`, the
+    function is saturated. Times are in nanoseconds."""
+
+    def __init__(self, name, limit=None, precision=5):
+        """
+        :name: Name of the function
+        :limit: Maximum number of concurrent calls if a limiter is used
+        :precision: Precision of the histogram of the wait times
+        """
+        self.name = name
+        self.limit = limit
+        self.precision = precision
+        #: Calls in flight
+        self.current = 0
+        #: Calls waiting for the limiter
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self._changed_at = self._collected_at = perf_counter_ns()
+        self._area = 0
+        self._peak = 0
+        self._started = 0
+        self._completed = 0
+        self._wait = Histogram(precision)
+
+    def wait(self):
+        """Count a call which waits for the limiter.
+
+        :returns: Start of the wait to be passed to :meth:`enter`
+        """
+        with self._lock:
+            self.waiting += 1
+        return perf_counter_ns()
+
+    def abandon(self):
+        """Count a call which gave up waiting for the limiter."""
+        with self._lock:
+            self.waiting -= 1
+
+    def enter(self, waiting_since=None):
+        """Count a started call.
+
+        :waiting_since: Return value of :meth:`wait` if the call waited
+        for the limiter.
+        """
+        now = perf_counter_ns()
+        with self._lock:
+            if waiting_since is not None:
+                self.waiting -= 1
+                self._wait.record(now - waiting_since)
+            self._area += self.current * (now - self._changed_at)
+            self._changed_at = now
+            self.current += 1
+            self._started += 1
+            if self.current > self._peak:
+                self._peak = self.current
+
+    def exit(self):
+        """Count a finished call."""
+        now = perf_counter_ns()
+        with self._lock:
+            self._area += self.current * (now - self._changed_at)
+            self._changed_at = now
+            self.current -= 1
+            self._completed += 1
+
+    def collect(self):
+        """Will return a dictionary with the current, peak and mean
+        number of calls in flight, the number of started and completed
+        calls, the throughput in completed calls per second and the
+        statistics of the wait times in seconds since the last call.
+
+        :returns: Dictionary or None if the function was idle.
+        """
+        now = perf_counter_ns()
+        with self._lock:
+            area = self._area + self.current * (now - self._changed_at)
+            duration = now - self._collected_at
+            current, waiting = self.current, self.waiting
+            stats = {"current": current,
+                     "peak": self._peak,
+                     "started": self._started,
+                     "completed": self._completed}
+            wait, self._wait = self._wait, Histogram(self.precision)
+            self._area, self._changed_at, self._collected_at = 0, now, now
+            self._peak, self._started, self._completed = current, 0, 0
+        if not stats["started"] and not current:
+            return None
+        stats["mean"] = round(area / duration, 3) if duration else float(current)
+        stats["throughput"] = round(stats["completed"] * 1e9 / duration, 3) if duration else 0.0
+        if self.limit is not None:
+            stats["limit"] = self.limit
+            stats["waiting"] = waiting
+            stats["wait"] = wait.stats(scale=1e9)
+        return stats
+
+
+class ConcurrencyAggregator(object):
+    """Holds the :class:`ConcurrencyTracker` of every function."""
+
+    def __init__(self):
+        self._trackers = {}
+        self._lock = threading.Lock()
+
+    def tracker(self, name, limit=None):
+        """Will return the :class:`ConcurrencyTracker` for the given name.
+
+        :raises ValueError: If the tracker exists with another limit.
+        """
+        with self._lock:
+            tracker = self._trackers.get(name)
+            if tracker is None:
+                tracker = self._trackers[name] = ConcurrencyTracker(name, limit)
+            elif tracker.limit != limit:
+                raise ValueError("{} is tracked with the limit {}.".format(name, tracker.limit))
+            return tracker
+
+    def collect(self):
+        """Will return a list of dictionaries with the statistics of
+        every function since the last call, see
+        :meth:`ConcurrencyTracker.collect`. Idle functions are omitted.
+
+        :returns: List of dictionaries with the name of the function as
+        `func` and the statistics as `concurrency`.
+        """
+        with self._lock:
+            trackers = list(self._trackers.values())
+        result = []
+        for tracker in trackers:
+            stats = tracker.collect()
+            if stats is not None:
+                result.append({"func": tracker.name, "concurrency": stats})
+        return result
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Scheduler for the periodic monitoring of the service.
+
+All periodic checks (e.g the system utilisation or the connectivity to
+other hosts) are implemented as :class:`Probe` and run by one
+:class:`Scheduler` in a single background thread. Probes can be added,
+removed and reconfigured at runtime without starting new threads.
+
+The probes are scheduled on a fixed grid: the next run is computed
+from the planned time of the previous run and not from the time the
+run finished, so the runs do not drift. An optional jitter spreads the
+runs of many processes which have been started at the same time. If a
+run takes longer than the interval, missed runs are skipped.
+
+The scheduler does not survive a fork. In the child process it is
+stopped but keeps its probes, so it can be started again with
+:meth:`Scheduler.start`.
+"""
+
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Probe(object):
+    """A periodic check. Subclasses implement :meth:`run`."""
+
+    #: Probes which monitor the host instead of the process are only
+    #: run by the leader if the processes of the service share the
+    #: monitoring, see :attr:`Scheduler.is_leader`.
+    per_host = False
+
+    def __init__(self, name, interval=60, jitter=0.0):
+        """
+        :name: Unique name of the probe
+        :interval: Probe is run every X seconds
+        :jitter: Fraction of the interval by which the runs are delayed
+        randomly.
+        """
+        if interval <= 0:
+            raise ValueError("Interval must be greater than 0.")
+        self.name = name
+        self.interval = interval
+        self.jitter = jitter
+
+    def run(self):
+        """Run the check."""
+        raise NotImplementedError()
+
+    def stop(self):
+        """Called when the probe is removed from the scheduler."""
+
+
+class FunctionProbe(Probe):
+    """Probe which calls a function."""
+
+    def __init__(self, name, func, interval=60, jitter=0.0):
+        """
+        :name: Unique name of the probe
+        :func: Function which is called on every run
+        :interval: Probe is run every X seconds
+        :jitter: Fraction of the interval by which the runs are delayed
+        randomly.
+        """
+        Probe.__init__(self, name, interval, jitter)
+        self.func = func
+
+    def run(self):
+        self.func()
+
+
+class Scheduler(object):
+    """Runs the registered probes in one background thread."""
+
+    def __init__(self):
+        self._probes = {}
+        # Heap of (due time, sequence, name, planned time, generation)
+        self._queue = []
+        self._generations = {}
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = True
+        #: Callable which returns if the process runs the probes with
+        #: `per_host` set, or None to run them in every process.
+        self.is_leader = None
+        atexit.register(self.stop)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def probes(self):
+        """Dictionary of the registered probes by name."""
+        return dict(self._probes)
+
+    def register(self, probe):
+        """Add the probe and start the scheduler if it is not running.
+        A probe with the same name is replaced.
+
+        :probe: :class:`Probe`
+        :returns: The probe
+        """
+        with self._cond:
+            previous = self._probes.get(probe.name)
+            self._probes[probe.name] = probe
+            self._schedule(probe, time.monotonic())
+            self._cond.notify()
+        if previous is not None and previous is not probe:
+            previous.stop()
+        self.start()
+        return probe
+
+    def unregister(self, name):
+        """Remove the probe with the given name.
+
+        :name: Name of the probe
+        """
+        with self._cond:
+            probe = self._probes.pop(name, None)
+            self._generations.pop(name, None)
+        if probe is not None:
+            probe.stop()
+
+    def reconfigure(self, name, interval=None, jitter=None):
+        """Change the interval or jitter of a registered probe. The
+        probe is run with the new settings starting from now.
+
+        :name: Name of the probe
+        :interval: New interval in seconds
+        :jitter: New jitter
+        """
+        if interval is not None and interval <= 0:
+            raise ValueError("Interval must be greater than 0.")
+        with self._cond:
+            probe = self._probes[name]
+            if interval is not None:
+                probe.interval = interval
+            if jitter is not None:
+                probe.jitter = jitter
+            self._schedule(probe, time.monotonic() + probe.interval)
+            self._cond.notify()
+
+    def _schedule(self, probe, planned):
+        """Put the next run of the probe into the queue. Runs which
+        have been scheduled before are invalidated."""
+        generation = self._generations.get(probe.name, 0) + 1
+        self._generations[probe.name] = generation
+        self._push(probe, planned, generation)
+
+    def _push(self, probe, planned, generation):
+        due = planned
+        if probe.jitter:
+            due += random.uniform(0, probe.jitter * probe.interval)
+        heapq.heappush(self._queue, (due, next(self._sequence), probe.name,
+                                     planned, generation))
+
+    def start(self):
+        """Start the background thread if it is not running."""
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped = False
+            self._thread = threading.Thread(name="tedega_monitor",
+                                            target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Stop the background thread. The probes stay registered."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _after_fork(self):
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = True
+
+    def _next(self):
+        """Wait for the next due probe and return it. Returns None if
+        the scheduler is stopped."""
+        with self._cond:
+            while not self._stopped:
+                queue = self._queue
+                # Discard runs of removed or rescheduled probes.
+                while queue and self._generations.get(queue[0][2]) != queue[0][4]:
+                    heapq.heappop(queue)
+                if not queue:
+                    self._cond.wait()
+                    continue
+                delay = queue[0][0] - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                due, _, name, planned, generation = heapq.heappop(queue)
+                probe = self._probes[name]
+                # Plan the next run on the grid of the interval and
+                # skip runs which have been missed.
+                now = time.monotonic()
+                planned += probe.interval
+                if planned < now:
+                    planned += ((now - planned) // probe.interval + 1) * probe.interval
+                self._push(probe, planned, generation)
+                return probe
+
+    def _run(self):
+        while True:
+            probe = self._next()
+            if probe is None:
+                return
+            try:
+                if probe.per_host and self.is_leader is not None and not self.is_leader():
+                    continue
+                probe.run()
+            except Exception:
+                log.exception("Probe %s failed", probe.name)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Will return the global :class:`Scheduler` which runs the
+    monitors of the service.
+
+    :returns: :class:`Scheduler`
+    """
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler()
+    return _scheduler
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sharing of the monitoring between the worker processes of a service.
+
+Under a prefork server (gunicorn, uwsgi) every worker process would
+sample the system, check the connectivity and log the statistics of
+its own processing times. With :class:`SharedMetrics` the workers on a
+host share a memory mapped file instead:
+
+* Every worker owns one slot in the file. It periodically writes the
+  cumulative histograms of its processing times into the slot. A
+  sequence number around every write (seqlock) allows to read the slot
+  without locking.
+* One worker is elected as leader by a lock on the file. The lock is
+  released by the operating system when the leader dies and another
+  worker takes over on its next try.
+* The leader reads all slots, merges the histograms of the interval and
+  logs the statistics. Only the leader runs the probes which monitor
+  the host, see :attr:`tedega_share.monitor.Probe.per_host`.
+
+Slots of workers which are no longer running are reused.
+"""
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+
+import msgpack
+
+from .metrics import Histogram
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"TDGM"
+HEADER = struct.Struct("<4sII")
+HEADER_SIZE = 64
+# pid, length of the data, sequence number
+SLOT = struct.Struct("<IIQ")
+SEQUENCE = struct.Struct("<Q")
+# Byte ranges of the file which are locked
+ALLOCATION_LOCK = 0
+LEADER_LOCK = 1
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedMetrics(object):
+    """Metrics shared by the processes of a service on one host."""
+
+    def __init__(self, path, slots=64, slot_size=64 * 1024):
+        """
+        :path: Path of the shared file, preferably on a tmpfs
+        :slots: Maximum number of processes
+        :slot_size: Size in bytes of the data of a process
+        """
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, ALLOCATION_LOCK)
+        try:
+            header = os.pread(self._fd, HEADER.size, 0)
+            if len(header) == HEADER.size and header.startswith(MAGIC):
+                # Use the layout of the processes which created the file.
+                _, slots, slot_size = HEADER.unpack(header)
+            else:
+                os.ftruncate(self._fd, HEADER_SIZE + slots * slot_size)
+                os.pwrite(self._fd, HEADER.pack(MAGIC, slots, slot_size), 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, ALLOCATION_LOCK)
+        self.slots = slots
+        self.slot_size = slot_size
+        self._map = mmap.mmap(self._fd, HEADER_SIZE + slots * slot_size)
+        self._pid = None
+        self._slot = None
+        self._leader = None
+        self._last = None
+
+    def _offset(self, slot):
+        return HEADER_SIZE + slot * self.slot_size
+
+    def _claim(self):
+        """Claim a free slot for the current process."""
+        pid = os.getpid()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, ALLOCATION_LOCK)
+        try:
+            for slot in range(self.slots):
+                offset = self._offset(slot)
+                owner = SLOT.unpack_from(self._map, offset)[0]
+                if owner == 0 or owner == pid or not _alive(owner):
+                    SLOT.pack_into(self._map, offset, pid, 0, 0)
+                    self._pid, self._slot = pid, slot
+                    return True
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, ALLOCATION_LOCK)
+        log.warning("No free slot in %s for process %s", self.path, pid)
+        return False
+
+    def publish(self, data):
+        """Write the data of the current process into its slot.
+
+        :data: msgpack serializable data
+        :returns: False if there is no slot or the data is too large.
+        """
+        if self._pid != os.getpid() and not self._claim():
+            return False
+        payload = msgpack.packb(data, use_bin_type=True)
+        if SLOT.size + len(payload) > self.slot_size:
+            log.warning("Metrics of process %s exceed the slot size", self._pid)
+            return False
+        offset = self._offset(self._slot)
+        sequence = SLOT.unpack_from(self._map, offset)[2]
+        # An odd sequence number marks the slot as being written.
+        SEQUENCE.pack_into(self._map, offset + 8, sequence + 1)
+        self._map[offset + SLOT.size:offset + SLOT.size + len(payload)] = payload
+        SLOT.pack_into(self._map, offset, self._pid, len(payload), sequence + 2)
+        return True
+
+    def read(self):
+        """Will return the data of all running processes.
+
+        :returns: Dictionary with the data by pid
+        """
+        result = {}
+        for slot in range(self.slots):
+            offset = self._offset(slot)
+            for _ in range(100):
+                pid, length, sequence = SLOT.unpack_from(self._map, offset)
+                if sequence % 2:
+                    continue
+                data = self._map[offset + SLOT.size:offset + SLOT.size + length]
+                if SEQUENCE.unpack_from(self._map, offset + 8)[0] == sequence:
+                    break
+            else:
+                continue
+            if pid and length and _alive(pid):
+                result[pid] = msgpack.unpackb(data, raw=False)
+        return result
+
+    def is_leader(self):
+        """Will return True if the current process is the leader. If
+        there is no leader the current process becomes the leader."""
+        pid = os.getpid()
+        if self._leader == pid:
+            return True
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, LEADER_LOCK)
+        except OSError:
+            return False
+        self._leader = pid
+        self._last = None
+        return True
+
+    def collect(self):
+        """Will return the statistics of the processing times of all
+        processes since the last call, like
+        :meth:`tedega_share.metrics.ProctimeAggregator.collect`. The
+        first call after the process became the leader only remembers
+        the current values and returns an empty list.
+
+        :returns: List of dictionaries
+        """
+        current = self.read()
+        last, self._last = self._last, current
+        if last is None:
+            return []
+        histograms = {}
+        errors = {}
+        for pid, data in current.items():
+            before = last.get(pid, {}).get("functions", {})
+            for name, (total, counts, errs) in data["functions"].items():
+                histogram = histograms.get(name)
+                if histogram is None:
+                    histogram = histograms[name] = Histogram(data["precision"])
+                histogram.sum += total
+                for index, count in counts:
+                    histogram.counts[index] += count
+                previous = before.get(name)
+                if previous is not None:
+                    histogram.sum -= previous[0]
+                    for index, count in previous[1]:
+                        histogram.counts[index] -= count
+                for error, count in errs.items():
+                    count -= previous[2].get(error, 0) if previous else 0
+                    if count:
+                        counter = errors.setdefault(name, {})
+                        counter[error] = counter.get(error, 0) + count
+        result = []
+        for name, histogram in histograms.items():
+            stats = histogram.stats(scale=1e9)
+            if not stats["count"]:
+                continue
+            stats["func"] = name
+            if name in errors:
+                stats["errors"] = errors[name]
+            result.append(stats)
+        return result
+
+    def close(self):
+        """Release the slot and the leadership of the process."""
+        if self._pid == os.getpid():
+            SLOT.pack_into(self._map, self._offset(self._slot), 0, 0, 0)
+            self._pid = None
+        self._map.close()
+        os.close(self._fd)
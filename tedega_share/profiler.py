@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Statistical profiling of the service.
+
+The :class:`StackSampler` takes the stacks of all threads with
+`sys._current_frames` in a background thread `rate` times per second
+and counts them as folded stacks: the frames from the root to the
+leaf, separated by semicolons, as used by flame graph tools::
+
+        threading:Thread._bootstrap;...;users.api:get_user;db:query 42
+
+The stacks are sampled regardless of whether the thread is running or
+waiting, so the profile shows where the time of the threads goes.
+
+Sampling holds the GIL, so it stalls the service. The sampler measures
+how long it takes and lowers the rate if the fraction of the time spent
+sampling exceeds `max_overhead`. The rate and the overhead cap can be
+changed at runtime.
+
+The :class:`ProfileProbe` logs the counted stacks of every interval as
+*PROFILE* message. The stacks are sent as zlib compressed and base64
+encoded text with one folded stack and its count per line, see
+:func:`decode_profile`::
+
+        {"format": "folded", "encoding": "zlib+base64", "profile": "eJy...",
+         "samples": 2980, "stacks": 57, "duration": 60.0, "rate": 50.0,
+         "overhead": 0.002}
+"""
+
+import base64
+import sys
+import threading
+import time
+import zlib
+
+from .monitor import Probe
+
+
+def decode_profile(profile):
+    """Will return the counts of the folded stacks of a profile.
+
+    :profile: Value of the `profile` field of a *PROFILE* message
+    :returns: Dictionary with the count by folded stack
+    """
+    counts = {}
+    for line in zlib.decompress(base64.b64decode(profile)).decode("utf-8").splitlines():
+        stack, _, count = line.rpartition(" ")
+        counts[stack] = int(count)
+    return counts
+
+
+class StackSampler(object):
+    """Samples the stacks of all threads in a background thread."""
+
+    def __init__(self, rate=50.0, max_overhead=0.01, max_depth=64):
+        """
+        :rate: Samples per second
+        :max_overhead: Maximum fraction of the time spent sampling
+        :max_depth: Frames above this depth are omitted.
+        """
+        self.rate = rate
+        self.max_overhead = max_overhead
+        self.max_depth = max_depth
+        self._labels = {}
+        self._counts = {}
+        self._samples = 0
+        self._busy = 0.0
+        self._started_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        #: Average duration of one sample in seconds
+        self.cost = 0.0
+
+    def set_rate(self, rate=None, max_overhead=None):
+        """Change the rate or the overhead cap."""
+        if rate is not None:
+            if rate <= 0:
+                raise ValueError("Rate must be greater than 0.")
+            self.rate = rate
+        if max_overhead is not None:
+            self.max_overhead = max_overhead
+
+    def _label(self, code, frame):
+        label = self._labels.get(code)
+        if label is None:
+            if len(self._labels) >= 100000:
+                # Code objects created at runtime would be kept forever.
+                self._labels.clear()
+            module = frame.f_globals.get("__name__", "?")
+            label = "%s:%s" % (module, getattr(code, "co_qualname", code.co_name))
+            self._labels[code] = label
+        return label
+
+    def sample(self):
+        """Take the stacks of all threads except the sampling one."""
+        current = threading.get_ident()
+        max_depth = self.max_depth
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == current:
+                continue
+            labels = []
+            while frame is not None and len(labels) < max_depth:
+                labels.append(self._label(frame.f_code, frame))
+                frame = frame.f_back
+            labels.reverse()
+            stacks.append(";".join(labels))
+        with self._lock:
+            counts = self._counts
+            for stack in stacks:
+                counts[stack] = counts.get(stack, 0) + 1
+            self._samples += 1
+
+    def _run(self):
+        while not self._stopped.is_set():
+            started_at = time.perf_counter()
+            self.sample()
+            cost = time.perf_counter() - started_at
+            self._busy += cost
+            self.cost = cost if not self.cost else self.cost * 0.9 + cost * 0.1
+            # Wait at least as long as it takes to keep the overhead
+            # below the cap.
+            delay = 1.0 / self.rate
+            if self.max_overhead:
+                delay = max(delay, self.cost / self.max_overhead)
+            self._stopped.wait(max(delay - cost, 0.0))
+
+    def start(self):
+        """Start sampling."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(name="tedega_profiler", target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def snapshot(self):
+        """Will return the counts of the folded stacks and the sampling
+        statistics since the last snapshot and reset them.
+
+        :returns: Tuple of the dictionary with the count by stack and a
+        dictionary with the number of samples, the duration in seconds,
+        the effective rate and the overhead.
+        """
+        now = time.monotonic()
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            samples, self._samples = self._samples, 0
+        busy, self._busy = self._busy, 0.0
+        duration, self._started_at = now - self._started_at, now
+        stats = {"samples": samples,
+                 "duration": round(duration, 3),
+                 "rate": round(samples / duration, 2) if duration > 0 else 0.0,
+                 "overhead": round(busy / duration, 5) if duration > 0 else 0.0}
+        return counts, stats
+
+
+class ProfileProbe(Probe):
+    """Probe which logs the profile of a :class:`StackSampler`."""
+
+    def __init__(self, logger, sampler, interval=60, max_stacks=1000, name="profiler"):
+        """
+        :logger: :class:`tedega_share.logger.Logger`
+        :sampler: :class:`StackSampler`
+        :interval: Profile is logged every X seconds
+        :max_stacks: Only the most frequent stacks are logged.
+        """
+        Probe.__init__(self, name, interval)
+        self.logger = logger
+        self.sampler = sampler
+        self.max_stacks = max_stacks
+
+    def run(self):
+        counts, stats = self.sampler.snapshot()
+        if not counts:
+            return
+        stacks = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+        text = "\n".join("%s %d" % item for item in stacks[:self.max_stacks])
+        message = dict(stats, format="folded", encoding="zlib+base64", stacks=len(stacks),
+                       profile=base64.b64encode(zlib.compress(text.encode("utf-8"))).decode("ascii"))
+        self.logger.info(message, "PROFILE")
+
+    def stop(self):
+        self.sampler.stop()
+        self.run()
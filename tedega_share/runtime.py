@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Monitoring of garbage collection pauses and of event loop lag.
+
+Latency outliers often come from pauses of the garbage collector or a
+blocked asyncio event loop. Neither shows up in the processing times of
+single functions.
+
+The :class:`GCMonitor` hooks into `gc.callbacks` and records the
+duration of every collection into a
+:class:`tedega_share.metrics.Histogram` per generation together with
+the number of collected and uncollectable objects.
+
+The :class:`LoopMonitor` schedules a heartbeat callback on the event
+loop every `heartbeat` seconds. The lag is the delay of the heartbeat
+against its planned time. A watchdog thread checks the heartbeat, and
+if it is late by more than `threshold` seconds, the loop is blocked
+and the stack of the thread of the loop is captured, which shows the
+callback which blocks the loop.
+
+The :class:`RuntimeProbe` logs the statistics of both since the last
+run as *SYSTEM* message::
+
+        {"gc": {"0": {"count": 120, "max": 0.0004, "p99": 0.0003, ...,
+                      "collected": 3100, "uncollectable": 0}, ...},
+         "loop": {"count": 600, "max": 1.2, "p99": 0.003, ...,
+                  "blocked": [{"lag": 1.2, "stack": ["app.py:10 in handler", ...]}]}}
+
+Times are in seconds.
+"""
+
+import gc
+import sys
+import threading
+import time
+import traceback
+from time import perf_counter_ns
+
+from .metrics import Histogram
+from .monitor import Probe
+
+
+def _stack(frame, limit):
+    """Will return the stack of the frame from the root to the frame."""
+    summary = traceback.StackSummary.extract(traceback.walk_stack(frame), limit=limit,
+                                             lookup_lines=False)
+    return ["%s:%d in %s" % (f.filename, f.lineno, f.name) for f in reversed(summary)]
+
+
+class GCMonitor(object):
+    """Records the pauses of the garbage collector by generation."""
+
+    def __init__(self):
+        self._started_at = None
+        self._reset()
+
+    def _reset(self):
+        # generation -> [Histogram of pauses in ns, collected, uncollectable]
+        stats, self._stats = getattr(self, "_stats", {}), {}
+        return stats
+
+    def _callback(self, phase, info):
+        if phase == "start":
+            self._started_at = perf_counter_ns()
+            return
+        started_at = self._started_at
+        if started_at is None:
+            return
+        self._started_at = None
+        generation = info["generation"]
+        stats = self._stats.get(generation)
+        if stats is None:
+            stats = self._stats[generation] = [Histogram(), 0, 0]
+        stats[0].record(perf_counter_ns() - started_at)
+        stats[1] += info["collected"]
+        stats[2] += info["uncollectable"]
+
+    def install(self):
+        """Start recording."""
+        if self._callback not in gc.callbacks:
+            gc.callbacks.append(self._callback)
+
+    def uninstall(self):
+        """Stop recording."""
+        if self._callback in gc.callbacks:
+            gc.callbacks.remove(self._callback)
+
+    def collect(self):
+        """Will return the statistics of the pauses by generation since
+        the last call."""
+        result = {}
+        for generation, (histogram, collected, uncollectable) in sorted(self._reset().items()):
+            stats = histogram.stats(scale=1e9)
+            stats["total"] = histogram.sum / 1e9
+            stats["collected"] = collected
+            stats["uncollectable"] = uncollectable
+            result[str(generation)] = stats
+        return result
+
+
+class LoopMonitor(object):
+    """Measures the lag of an asyncio event loop and captures the stack
+    of callbacks which block it."""
+
+    def __init__(self, loop, heartbeat=0.1, threshold=0.25, max_blocked=10, limit=30):
+        """
+        :loop: asyncio event loop
+        :heartbeat: Seconds between two heartbeats
+        :threshold: The loop is blocked if the heartbeat is late by more
+        than X seconds.
+        :max_blocked: Maximum number of captured stacks per interval
+        :limit: Maximum number of frames of a captured stack
+        """
+        self.loop = loop
+        self.heartbeat = heartbeat
+        self.threshold = threshold
+        self.max_blocked = max_blocked
+        self.limit = limit
+        self._histogram = Histogram()
+        self._blocked = []
+        self._pending = None
+        self._planned = None
+        self._thread_id = None
+        self._handle = None
+        self._stopped = threading.Event()
+        self._watchdog = None
+
+    def _beat(self):
+        now = time.monotonic()
+        self._thread_id = threading.get_ident()
+        if self._planned is not None:
+            lag = max(now - self._planned, 0.0)
+            self._histogram.record(int(lag * 1e9))
+            pending, self._pending = self._pending, None
+            if pending is not None:
+                pending["lag"] = round(lag, 6)
+                if len(self._blocked) < self.max_blocked:
+                    self._blocked.append(pending)
+        if not self._stopped.is_set():
+            self._planned = now + self.heartbeat
+            self._handle = self.loop.call_later(self.heartbeat, self._beat)
+
+    def _watch(self):
+        interval = min(self.heartbeat, self.threshold) / 2
+        while not self._stopped.wait(interval):
+            if self.loop.is_closed():
+                return
+            planned = self._planned
+            if planned is None or self._pending is not None or not self.loop.is_running():
+                continue
+            if time.monotonic() - planned > self.threshold:
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is not None:
+                    self._pending = {"stack": _stack(frame, self.limit)}
+
+    def start(self):
+        """Start the heartbeat and the watchdog. Can be called from any
+        thread."""
+        self._stopped.clear()
+        self.loop.call_soon_threadsafe(self._beat)
+        self._watchdog = threading.Thread(name="tedega_loop_watchdog",
+                                          target=self._watch, daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        """Stop the heartbeat and the watchdog."""
+        self._stopped.set()
+        handle = self._handle
+        if handle is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(handle.cancel)
+        if self._watchdog is not None and self._watchdog is not threading.current_thread():
+            self._watchdog.join()
+
+    def collect(self):
+        """Will return the statistics of the lag and the blocking
+        callbacks since the last call."""
+        histogram, self._histogram = self._histogram, Histogram()
+        blocked, self._blocked = self._blocked, []
+        stats = histogram.stats(scale=1e9)
+        stats["blocked"] = blocked
+        return stats
+
+
+class RuntimeProbe(Probe):
+    """Probe which logs the garbage collection pauses and the lag of
+    the event loop."""
+
+    def __init__(self, logger, gc_monitor=None, loop_monitor=None, interval=60,
+                 name="runtime"):
+        """
+        :logger: :class:`tedega_share.logger.Logger`
+        :gc_monitor: :class:`GCMonitor`
+        :loop_monitor: :class:`LoopMonitor`
+        :interval: Statistics are logged every X seconds
+        """
+        Probe.__init__(self, name, interval)
+        self.logger = logger
+        self.gc_monitor = gc_monitor
+        self.loop_monitor = loop_monitor
+
+    def run(self):
+        message = {}
+        if self.gc_monitor is not None:
+            message["gc"] = self.gc_monitor.collect()
+        if self.loop_monitor is not None:
+            message["loop"] = self.loop_monitor.collect()
+        self.logger.info(message, "SYSTEM")
+
+    def stop(self):
+        if self.gc_monitor is not None:
+            self.gc_monitor.uninstall()
+        if self.loop_monitor is not None:
+            self.loop_monitor.stop()
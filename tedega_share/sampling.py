@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sampling and rate limiting of log messages.
+
+A :class:`Sampler` is added as filter to the :class:`Logger` and keeps
+only a part of the messages of high volume categories like *REQUEST*::
+
+        sampler = Sampler({"REQUEST": Policy(rate=0.1, by_correlation_id=True),
+                           "PROCTIME": Policy(limit=100),
+                           logging.DEBUG: Policy(rate=0.01)})
+        get_logger().add_filter(sampler)
+
+The :class:`Policy` of a message is looked up by the tuple of its
+category and level, its category, its level and finally the default
+policy. Messages without a policy are kept.
+
+With `by_correlation_id` the decision depends only on the
+correlation_id of the message, so all messages of a request are either
+kept or dropped. Every kept message of a sampled category carries its
+`sample_rate`, the estimated fraction of the messages which have been
+kept, so the counts can be reconstructed downstream by dividing by the
+rate.
+"""
+
+import random
+import threading
+import time
+import zlib
+
+
+class TokenBucket(object):
+    """Allows `limit` events per second with bursts of up to `burst`
+    events."""
+
+    def __init__(self, limit, burst=None):
+        """
+        :limit: Events per second
+        :burst: Maximum number of events at once. Defaults to `limit`.
+        """
+        self.limit = limit
+        self.burst = burst if burst is not None else max(limit, 1)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        # Number of seen and allowed events of the current and the
+        # previous second, used to estimate the rate.
+        self._window = [0, 0, 1.0]
+        self._window_started_at = self._updated_at
+
+    def allow(self):
+        """Will return the estimated fraction of the allowed events if
+        the event is allowed, else 0."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.limit)
+            self._updated_at = now
+            window = self._window
+            if now - self._window_started_at >= 1.0:
+                window[:] = [0, 0, window[1] / window[0] if window[0] else 1.0]
+                self._window_started_at = now
+            window[0] += 1
+            if self._tokens < 1:
+                return 0
+            self._tokens -= 1
+            window[1] += 1
+            # Use the rate of the previous second until enough events
+            # of the current second have been seen.
+            if window[0] < 10:
+                return window[2]
+            return window[1] / window[0]
+
+
+class Policy(object):
+    """Sampling policy for a category or level of messages."""
+
+    def __init__(self, rate=1.0, limit=None, burst=None, by_correlation_id=False):
+        """
+        :rate: Fraction of the messages to keep (0 - 1)
+        :limit: Maximum number of kept messages per second
+        :burst: Maximum number of messages kept at once with `limit`
+        :by_correlation_id: Decide by the correlation_id of the message
+        instead of randomly.
+        """
+        if not 0 <= rate <= 1:
+            raise ValueError("Rate must be between 0 and 1.")
+        self.rate = rate
+        self.by_correlation_id = by_correlation_id
+        self.bucket = TokenBucket(limit, burst) if limit is not None else None
+        self._threshold = int(rate * 0xffffffff)
+
+    def sample(self, correlation_id):
+        """Will return the sample rate of the message if it is kept,
+        else 0."""
+        rate = self.rate
+        if rate < 1:
+            if self.by_correlation_id and correlation_id is not None:
+                if zlib.crc32(str(correlation_id).encode("utf-8")) > self._threshold:
+                    return 0
+            elif random.random() >= rate:
+                return 0
+        if self.bucket is not None:
+            rate *= self.bucket.allow()
+        return rate
+
+
+class Sampler(object):
+    """Filter for :class:`tedega_share.logger.Logger` which samples the
+    messages according to their policy."""
+
+    def __init__(self, policies=None, default=None):
+        """
+        :policies: Dictionary with the :class:`Policy` by category, by
+        level or by a tuple of category and level
+        :default: :class:`Policy` for all other messages
+        """
+        self._policies = dict(policies or {})
+        self.default = default
+        self._resolved = {}
+        self._dropped = {}
+
+    def set_policy(self, key, policy):
+        """Set or remove (if None) the policy for a category, level or a
+        tuple of both."""
+        policies = dict(self._policies)
+        if policy is None:
+            policies.pop(key, None)
+        else:
+            policies[key] = policy
+        self._policies = policies
+        self._resolved = {}
+
+    def policy(self, category, level):
+        """Will return the policy of messages with the given category
+        and level or None."""
+        key = (category, level)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        policies = self._policies
+        policy = policies.get(key, policies.get(category, policies.get(level, self.default)))
+        self._resolved[key] = policy
+        return policy
+
+    def filter(self, entry):
+        policy = self.policy(entry.category, entry.level)
+        if policy is None:
+            return True
+        rate = policy.sample(entry.correlation_id)
+        if not rate:
+            key = (entry.category, entry.level)
+            self._dropped[key] = self._dropped.get(key, 0) + 1
+            return False
+        if rate < 1:
+            if entry.extra is None:
+                entry.extra = {}
+            entry.extra["sample_rate"] = rate
+        return True
+
+    def stats(self):
+        """Will return the number of dropped messages by the tuple of
+        category and level."""
+        return dict(self._dropped)
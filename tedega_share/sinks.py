@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sinks which write the log records as newline delimited JSON.
+
+Every record is serialized only once: the line is built from the
+cached JSON rendering of the :class:`tedega_share.encoder.Envelope` and
+stored on the record, so all sinks writing the same record share it::
+
+        {"time": 1508224325.123456, "level": "INFO", "service": "users", ...}
+
+A sink is a logging handler with an additional method
+`emit_batch(records)`. :func:`tedega_share.logger.init_logger` wraps
+every sink into its own :class:`tedega_share.handler.AsyncHandler`, so
+every sink has its own queue, sender thread and level and a slow sink
+does not stall the others. The sender passes all queued records at
+once to `emit_batch`, which writes them with a single system call.
+
+* :class:`StreamSink` writes to stdout (or another stream).
+* :class:`FileSink` writes to a file which is rotated when it reaches
+  `max_bytes`. The rotated files are compressed with gzip.
+"""
+
+import json
+import logging
+import os
+import sys
+
+from .encoder import Envelope
+
+# Maximum number of buffers for one call of writev.
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+
+def record_line(record):
+    """Will return the record as line of JSON encoded in UTF-8. The line
+    is built once and cached on the record.
+
+    :record: `logging.LogRecord`
+    :returns: Bytes ending with a newline
+    """
+    line = record.__dict__.get("ndjson")
+    if line is None:
+        message = record.msg
+        if isinstance(message, Envelope):
+            body = message.to_json()
+        else:
+            body = json.dumps({"message": record.getMessage()})
+        line = '{{"time": {:.6f}, "level": {}, {}\n'.format(
+            record.created, json.dumps(record.levelname), body[1:]).encode("utf-8")
+        record.ndjson = line
+    return line
+
+
+class StreamSink(logging.Handler):
+    """Sink which writes the records to a stream."""
+
+    def __init__(self, stream=None, level=logging.NOTSET):
+        """
+        :stream: Stream to write to. Defaults to `sys.stdout`.
+        :level: Minimum level of the written records
+        """
+        logging.Handler.__init__(self, level)
+        self.stream = stream
+
+    def emit(self, record):
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        """Write the records with one write to the stream."""
+        stream = self.stream or sys.stdout
+        data = b"".join(record_line(record) for record in records)
+        buffer = getattr(stream, "buffer", None)
+        if buffer is not None:
+            buffer.write(data)
+            buffer.flush()
+        else:
+            stream.write(data.decode("utf-8"))
+            stream.flush()
+
+
+class FileSink(logging.Handler):
+    """Sink which writes the records to a file. The file is rotated if
+    it reaches `max_bytes`, the rotated files are named `<path>.1.gz`,
+    `<path>.2.gz` and so on."""
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backup_count=5,
+                 compress=True, level=logging.NOTSET):
+        """
+        :path: Path of the file
+        :max_bytes: The file is rotated if it reaches this size. 0
+        disables the rotation.
+        :backup_count: Number of kept rotated files
+        :compress: Compress the rotated files with gzip.
+        :level: Minimum level of the written records
+        """
+        logging.Handler.__init__(self, level)
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self._fd = None
+        self._size = 0
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._size = os.fstat(self._fd).st_size
+
+    def _write(self, lines):
+        size = sum(len(line) for line in lines)
+        if hasattr(os, "writev"):
+            written = os.writev(self._fd, lines)
+        else:
+            written = 0
+        if written < size:
+            data = memoryview(b"".join(lines))[written:]
+            while data:
+                data = data[os.write(self._fd, data):]
+        self._size += size
+
+    def emit(self, record):
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        """Write the records with one call of writev."""
+        if self._fd is None:
+            self._open()
+        lines = [record_line(record) for record in records]
+        for i in range(0, len(lines), IOV_MAX):
+            self._write(lines[i:i + IOV_MAX])
+        if self.max_bytes and self._size >= self.max_bytes:
+            self.rotate()
+
+    def _backup(self, number):
+        return "%s.%d%s" % (self.path, number, ".gz" if self.compress else "")
+
+    def rotate(self):
+        """Close the file and move it to the first backup. The oldest
+        backup is removed."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if not os.path.exists(self.path):
+            return
+        if not self.backup_count:
+            os.remove(self.path)
+            return
+        for number in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(self._backup(number)):
+                os.replace(self._backup(number), self._backup(number + 1))
+        if self.compress:
+            import gzip
+            import shutil
+            tmp = self._backup(1) + ".tmp"
+            with open(self.path, "rb") as src, gzip.open(tmp, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp, self._backup(1))
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self._backup(1))
+
+    def close(self):
+        self.acquire()
+        try:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        finally:
+            self.release()
+        logging.Handler.close(self)
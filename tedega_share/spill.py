@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Spilling of undeliverable log messages to the local disk.
+
+If fluentd is not reachable the senders keep the messages in memory
+only up to a fixed size. The messages exceeding this size are appended
+to a :class:`SpillBuffer` instead of being dropped. A
+:class:`SpillReplayProbe` sends them to fluentd again in the order they
+have been spilled, once the connection is back.
+
+The buffer consists of segment files of a fixed size which are memory
+mapped and only appended to. Every entry is stored as::
+
+        [length u32][crc32 u32][data]
+
+An entry with length 0 marks the end of the data in a segment. Entries
+with a wrong CRC (e.g written partly when the process died) end the
+segment as well. The position of the next entry to replay is stored in
+a cursor file, so spilled messages survive a restart of the service.
+Segments are removed once they have been replayed. If the number of
+segments exceeds `max_segments` the oldest segment is dropped, so the
+buffer never grows beyond `segment_size * max_segments` bytes.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from .monitor import Probe
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct("<II")
+CURSOR = struct.Struct("<QQ")
+SUFFIX = ".spill"
+
+
+class SpillBuffer(object):
+    """Append-only ring buffer of memory mapped segment files."""
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_segments=16):
+        """
+        :directory: Directory for the segment files
+        :segment_size: Size of one segment file in bytes
+        :max_segments: Maximum number of segment files
+        """
+        if max_segments < 1:
+            raise ValueError("At least one segment is needed.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._segments = sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(directory)
+                                if name.endswith(SUFFIX))
+        # Memory map and write offset of the last segment
+        self._map = None
+        self._offset = 0
+        # Memory map of the segment which is currently replayed
+        self._reader = None
+        self._stats = {"appended": 0, "replayed": 0, "dropped": 0}
+        if self._segments:
+            self._open(self._segments[-1])
+        self._cursor = self._load_cursor()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, "%010d%s" % (segment, SUFFIX))
+
+    def _map_segment(self, segment):
+        fd = os.open(self._path(segment), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != self.segment_size:
+                os.ftruncate(fd, self.segment_size)
+            return mmap.mmap(fd, self.segment_size)
+        finally:
+            os.close(fd)
+
+    def _open(self, segment):
+        """Map the segment for writing and find the end of its data."""
+        self._map = self._map_segment(segment)
+        offset = 0
+        while True:
+            entry = self._entry(self._map, offset)
+            if entry is None:
+                break
+            offset += HEADER.size + len(entry)
+        # Clear the rest of an entry which has been written partly.
+        if offset + HEADER.size <= self.segment_size and any(self._map[offset:offset + HEADER.size]):
+            self._map[offset:] = bytes(self.segment_size - offset)
+        self._offset = offset
+
+    def _entry(self, mm, offset):
+        """Will return the data of the entry at the offset or None if
+        there is no valid entry."""
+        if offset + HEADER.size > self.segment_size:
+            return None
+        length, crc = HEADER.unpack_from(mm, offset)
+        start = offset + HEADER.size
+        if length == 0 or start + length > self.segment_size:
+            return None
+        data = mm[start:start + length]
+        if zlib.crc32(data) != crc:
+            log.warning("Corrupt entry in spill buffer %s at %s", self.directory, offset)
+            return None
+        return data
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, "cursor"), "rb") as f:
+                cursor = CURSOR.unpack(f.read(CURSOR.size))
+        except (OSError, struct.error):
+            cursor = None
+        if cursor is None or cursor[0] not in self._segments:
+            return (self._segments[0], 0) if self._segments else (0, 0)
+        return cursor
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, "cursor")
+        with open(path + ".tmp", "wb") as f:
+            f.write(CURSOR.pack(*self._cursor))
+        os.replace(path + ".tmp", path)
+
+    def _remove(self, segment):
+        if self._reader is not None and self._reader[0] == segment:
+            self._reader[1].close()
+            self._reader = None
+        self._segments.remove(segment)
+        try:
+            os.unlink(self._path(segment))
+        except OSError:
+            pass
+
+    def _rotate(self):
+        """Start a new segment and drop the oldest segments if there
+        are too many."""
+        segment = self._segments[-1] + 1 if self._segments else 0
+        if self._map is not None:
+            self._map.close()
+        self._segments.append(segment)
+        self._map = self._map_segment(segment)
+        self._offset = 0
+        while len(self._segments) > self.max_segments:
+            self._stats["dropped"] += 1
+            self._remove(self._segments[0])
+        if self._cursor[0] not in self._segments:
+            self._cursor = (self._segments[0], 0)
+            self._save_cursor()
+
+    def append(self, data):
+        """Append the data as new entry.
+
+        :data: bytes
+        :returns: False if the data is larger than a segment
+        """
+        size = HEADER.size + len(data)
+        if size > self.segment_size:
+            return False
+        with self._lock:
+            if self._map is None or self._offset + size > self.segment_size:
+                self._rotate()
+            offset = self._offset
+            # The header is written last, so an entry is only valid
+            # once it has been written completely.
+            self._map[offset + HEADER.size:offset + size] = data
+            HEADER.pack_into(self._map, offset, len(data), zlib.crc32(data))
+            self._offset += size
+            self._stats["appended"] += 1
+        return True
+
+    def extend(self, items):
+        """Append every item of the list as an entry."""
+        for data in items:
+            self.append(data)
+
+    def read(self, max_bytes):
+        """Will return the oldest entries which have not been replayed
+        yet. At least one entry is returned if the buffer is not empty.
+
+        :max_bytes: Stop reading entries when this size is reached.
+        :returns: List of tuples with the data of the entry and the
+        position after the entry, which is passed to :meth:`commit`
+        once the entry has been replayed.
+        """
+        with self._lock:
+            entries = []
+            size = 0
+            segment, offset = self._cursor
+            while self._segments and size < max_bytes:
+                current = self._segments[-1]
+                if segment == current:
+                    if offset >= self._offset:
+                        break
+                    mm = self._map
+                else:
+                    if self._reader is None or self._reader[0] != segment:
+                        if self._reader is not None:
+                            self._reader[1].close()
+                        self._reader = (segment, self._map_segment(segment))
+                    mm = self._reader[1]
+                entry = self._entry(mm, offset)
+                if entry is None:
+                    if segment == current:
+                        break
+                    segment = next(s for s in self._segments if s > segment)
+                    offset = 0
+                    continue
+                offset += HEADER.size + len(entry)
+                size += len(entry)
+                entries.append((entry, (segment, offset)))
+            return entries
+
+    def commit(self, position, count=0):
+        """Mark the entries before the position as replayed. Segments
+        which have been replayed completely are removed.
+
+        :position: Position returned by :meth:`read`
+        :count: Number of replayed entries
+        """
+        with self._lock:
+            segment, offset = position
+            if segment not in self._segments:
+                # The segment has been dropped meanwhile.
+                return
+            for old in [s for s in self._segments if s < segment]:
+                self._remove(old)
+            self._cursor = (segment, offset)
+            self._stats["replayed"] += count
+            self._save_cursor()
+
+    @property
+    def empty(self):
+        """True if all entries have been replayed."""
+        with self._lock:
+            return not self._segments or self._cursor == (self._segments[-1], self._offset)
+
+    def stats(self):
+        """Will return a dictionary with the number of appended and
+        replayed entries, of dropped segments and of the segments on
+        disk.
+
+        :returns: Dictionary with counters
+        """
+        stats = dict(self._stats)
+        stats["segments"] = len(self._segments)
+        return stats
+
+    def close(self):
+        """Write the segments to disk and unmap them."""
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._map = None
+            if self._reader is not None:
+                self._reader[1].close()
+                self._reader = None
+
+
+class SpillReplayProbe(Probe):
+    """Probe which sends the entries of a :class:`SpillBuffer` again.
+    The replay stops at the first entry which can not be sent and is
+    continued on the next run."""
+
+    def __init__(self, buffer, send, interval=1.0, rate=1024 * 1024, name="spill"):
+        """
+        :buffer: :class:`SpillBuffer`
+        :send: Callable which gets the data of an entry and returns
+        True if it has been delivered.
+        :interval: Replay is run every X seconds
+        :rate: Maximum number of bytes replayed per second
+        """
+        Probe.__init__(self, name, interval)
+        self.buffer = buffer
+        self.send = send
+        self.rate = rate
+
+    def run(self):
+        if self.buffer.empty:
+            return
+        sent = 0
+        entries = self.buffer.read(int(self.rate * self.interval))
+        for data, position in entries:
+            if not self.send(data):
+                break
+            sent += 1
+        if sent:
+            self.buffer.commit(entries[sent - 1][1], sent)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Non-blocking sampling of the system utilisation.
+
+The :class:`SystemSampler` keeps the counters of the previous sample
+and computes the utilisation and the rates from the difference to the
+current counters. So the CPU usage is the average over the time since
+the last sample and taking a sample never blocks. The
+:class:`CpuMeter` does the same for the CPU usage only.
+"""
+
+import os
+import time
+
+import psutil
+
+
+def _cpu_busy(times):
+    """Will return the busy and the total time of the cpu times."""
+    total = sum(times)
+    # On Linux guest times are already included in user times.
+    total -= getattr(times, "guest", 0) + getattr(times, "guest_nice", 0)
+    idle = times.idle + getattr(times, "iowait", 0)
+    return total - idle, total
+
+
+def _cpu_percent(before, after):
+    busy_before, total_before = _cpu_busy(before)
+    busy_after, total_after = _cpu_busy(after)
+    total = total_after - total_before
+    if total <= 0:
+        return 0.0
+    percent = (busy_after - busy_before) / total * 100
+    return round(min(max(percent, 0.0), 100.0), 1)
+
+
+class CpuMeter(object):
+    """Measures the CPU usage in percent since the previous call without
+    blocking."""
+
+    def __init__(self):
+        self._last = psutil.cpu_times()
+
+    def __call__(self):
+        current = psutil.cpu_times()
+        percent = _cpu_percent(self._last, current)
+        self._last = current
+        return percent
+
+
+def _rates(before, after, elapsed, fields):
+    if before is None or after is None or elapsed <= 0:
+        return None
+    return dict((field, int((getattr(after, field) - getattr(before, field)) / elapsed))
+                for field in fields)
+
+
+class SystemSampler(object):
+    """Samples the utilisation of CPU, memory, swap, filesystems, disk
+    and network I/O and the context switches of the system."""
+
+    DISK_FIELDS = ("read_bytes", "write_bytes", "read_count", "write_count")
+    NET_FIELDS = ("bytes_sent", "bytes_recv", "packets_sent", "packets_recv",
+                  "errin", "errout", "dropin", "dropout")
+
+    def __init__(self):
+        self._last = self._counters()
+
+    def _counters(self):
+        try:
+            disk = psutil.disk_io_counters()
+        except (OSError, RuntimeError):
+            disk = None
+        return {"time": time.monotonic(),
+                "cpu": psutil.cpu_times(),
+                "cpus": psutil.cpu_times(percpu=True),
+                "stats": psutil.cpu_stats(),
+                "disk": disk,
+                "net": psutil.net_io_counters()}
+
+    def _filesystems(self):
+        result = {}
+        for partition in psutil.disk_partitions(all=False):
+            try:
+                result[partition.mountpoint] = psutil.disk_usage(partition.mountpoint).percent
+            except OSError:
+                continue
+        return result
+
+    def sample(self):
+        """Will return a dictionary with the current utilisation. CPU
+        usage and rates are the averages since the last sample.
+
+        :returns: Dictionary
+        """
+        last, current = self._last, self._counters()
+        self._last = current
+        elapsed = current["time"] - last["time"]
+        result = {"cpu": _cpu_percent(last["cpu"], current["cpu"]),
+                  "cpus": [_cpu_percent(before, after) for before, after
+                           in zip(last["cpus"], current["cpus"])],
+                  "memory": psutil.virtual_memory().percent,
+                  "swap": psutil.swap_memory().percent,
+                  "disk": psutil.disk_usage('/').percent,
+                  "filesystems": self._filesystems()}
+        if hasattr(os, "getloadavg"):
+            result["load"] = [round(load, 2) for load in os.getloadavg()]
+        stats = _rates(last["stats"], current["stats"], elapsed,
+                       ("ctx_switches", "interrupts"))
+        if stats is not None:
+            result.update(stats)
+        disk = _rates(last["disk"], current["disk"], elapsed, self.DISK_FIELDS)
+        if disk is not None:
+            result["disk_io"] = disk
+        net = _rates(last["net"], current["net"], elapsed, self.NET_FIELDS)
+        if net is not None:
+            result["net_io"] = net
+        return result
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tail based buffering of the debug messages of requests.
+
+The detailed messages of a request are only of interest if the request
+failed. The :class:`TailBuffer` is a filter for the
+:class:`tedega_share.logger.Logger` which holds back the messages up to
+`buffer_level` (DEBUG and INFO by default) of every request, identified
+by its correlation_id. The buffered messages of a request are written
+
+* when an ERROR (or higher) message of the request is logged,
+* when the status of the request is logged under *RETURNCODE* and is
+  500 or higher, or
+* when the request took longer than `latency` seconds.
+
+Otherwise they are discarded when the request ends. A request ends
+with its *RETURNCODE* message or when :meth:`TailBuffer.finish` is
+called. After the buffer of a request has been written, all further
+messages of the request are written immediately. Messages which are
+logged after the end of a request (e.g the spans of the request) are
+not buffered: they are written if the request failed or their level
+is at least `level`. The last `max_total` ended requests are
+remembered for this.
+
+Written messages carry the field `logged_at` with the time they have
+been logged and the `span_id` of the span they have been logged in.
+Every request keeps at most `max_records` messages (the
+oldest are dropped) and all requests together at most `max_total`
+messages. If the limit is exceeded the buffer of the oldest request is
+discarded.
+
+Messages without a correlation_id are not buffered. They are dropped if
+their level is below `level`, as the logger has to be enabled for
+DEBUG messages to buffer them.
+"""
+
+import collections
+import contextvars
+import logging
+import threading
+import time
+
+from .tracing import _current_span
+
+#: Keys of a dictionary message under *RETURNCODE* with the status.
+STATUS_KEYS = ("status", "returncode", "code")
+
+
+def _status(message):
+    """Will return the status of a *RETURNCODE* message or None."""
+    if isinstance(message, dict):
+        for key in STATUS_KEYS:
+            if key in message:
+                message = message[key]
+                break
+    try:
+        return int(message)
+    except (TypeError, ValueError):
+        return None
+
+
+class TailBuffer(object):
+    """Filter which buffers the messages of requests until it is known
+    if the request failed."""
+
+    def __init__(self, logger, max_records=200, max_total=20000, latency=None,
+                 buffer_level=logging.INFO, level=logging.INFO):
+        """
+        :logger: :class:`tedega_share.logger.Logger` writing the buffers
+        :max_records: Maximum number of buffered messages per request
+        :max_total: Maximum number of buffered messages of all requests
+        :latency: Write the buffer of requests which took longer than X
+        seconds.
+        :buffer_level: Messages up to this level are buffered.
+        :level: Messages without correlation_id below this level are
+        dropped.
+        """
+        self.logger = logger
+        self.max_records = max_records
+        self.max_total = max_total
+        self.latency = latency
+        self.buffer_level = buffer_level
+        self.level = level
+        self._lock = threading.Lock()
+        # correlation_id -> [deque of (entry, time), started] or None
+        # if the messages of the request are written immediately.
+        self._requests = collections.OrderedDict()
+        # correlation_id -> True if the request failed, for the ended
+        # requests.
+        self._ended = collections.OrderedDict()
+        self._total = 0
+        self._stats = {"buffered": 0, "written": 0, "discarded": 0}
+
+    def filter(self, entry):
+        correlation_id = entry.correlation_id
+        if correlation_id is None:
+            return entry.level >= self.level
+        if entry.category == "RETURNCODE":
+            status = _status(entry.message)
+            self.finish(correlation_id, failed=status is not None and status >= 500)
+            return True
+        if entry.level > self.buffer_level:
+            if entry.level >= logging.ERROR:
+                self._write(correlation_id, keep=True)
+            return True
+        with self._lock:
+            if correlation_id in self._requests:
+                request = self._requests[correlation_id]
+                if request is None:
+                    return True
+            elif correlation_id in self._ended:
+                return self._ended[correlation_id] or entry.level >= self.level
+            else:
+                request = self._requests[correlation_id] = [
+                    collections.deque(maxlen=self.max_records), time.monotonic()]
+            if len(request[0]) == self.max_records:
+                self._total -= 1
+                self._stats["discarded"] += 1
+            # The span is only known while the message is logged.
+            span = _current_span.get()
+            if span is not None:
+                entry.extra = dict(entry.extra or {}, span_id=span.span_id)
+            request[0].append((entry, time.time()))
+            self._total += 1
+            self._stats["buffered"] += 1
+            self._limit()
+        return False
+
+    def _limit(self):
+        """Discard the oldest requests until the limits are kept."""
+        requests = self._requests
+        while self._total > self.max_total or len(requests) > self.max_total:
+            self._discard(next(iter(requests)))
+
+    def _discard(self, correlation_id):
+        request = self._requests.pop(correlation_id, None)
+        if request is not None:
+            self._total -= len(request[0])
+            self._stats["discarded"] += len(request[0])
+
+    def _write(self, correlation_id, keep):
+        """Write the buffered messages of the request. If `keep` is
+        True further messages of the request are written immediately."""
+        with self._lock:
+            request = self._requests.pop(correlation_id, None)
+            if keep:
+                self._requests[correlation_id] = None
+                self._limit()
+            if request is None:
+                return
+            self._total -= len(request[0])
+            self._stats["written"] += len(request[0])
+        # Written outside of the current span, the messages carry the
+        # span they have been logged in.
+        contextvars.Context().run(self._emit, request[0])
+
+    def _emit(self, entries):
+        for entry, logged_at in entries:
+            extra = dict(entry.extra or {}, logged_at=logged_at)
+            self.logger.emit(entry.level, entry.message, entry.category,
+                             entry.correlation_id, extra)
+
+    def finish(self, correlation_id, failed=False, duration=None):
+        """End the request. Its buffered messages are written if it
+        failed or took longer than `latency`, else they are discarded.
+
+        :correlation_id: Correlation id of the request
+        :failed: True if the request failed
+        :duration: Duration of the request in seconds. Defaults to the
+        time since its first buffered message.
+        """
+        if not failed and self.latency is not None:
+            if duration is None:
+                request = self._requests.get(correlation_id)
+                if request is not None:
+                    duration = time.monotonic() - request[1]
+            failed = duration is not None and duration >= self.latency
+        if failed:
+            self._write(correlation_id, keep=False)
+        else:
+            with self._lock:
+                self._discard(correlation_id)
+        with self._lock:
+            ended = self._ended
+            ended[correlation_id] = failed
+            ended.move_to_end(correlation_id)
+            while len(ended) > self.max_total:
+                ended.popitem(last=False)
+
+    def stats(self):
+        """Will return the number of buffered, written and discarded
+        messages and of the currently buffered messages."""
+        stats = dict(self._stats)
+        stats["pending"] = self._total
+        return stats
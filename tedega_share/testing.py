@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers to test and benchmark services using tedega_share.
+
+:class:`FakeFluentd` is a local stand-in for fluentd which understands
+all modes of the Forward protocol (Message, Forward, PackedForward and
+CompressedPackedForward), acknowledges messages with a `chunk` option
+and can simulate a slow or failing fluentd::
+
+        with FakeFluentd() as fluentd:
+            init_logger("service", host=fluentd.host, port=fluentd.port)
+            get_logger().info("Hello")
+            fluentd.wait_for(1)
+            assert fluentd.events[0][2]["message"] == "Hello"
+"""
+
+import gzip
+import random
+import socket
+import threading
+import time
+
+import msgpack
+
+
+def _ext_hook(code, data):
+    """Convert the EventTime extension type into a float."""
+    if code == 0 and len(data) == 8:
+        seconds = int.from_bytes(data[:4], "big")
+        nanoseconds = int.from_bytes(data[4:], "big")
+        return seconds + nanoseconds / 1e9
+    return msgpack.ExtType(code, data)
+
+
+def _unpack(data):
+    unpacker = msgpack.Unpacker(raw=False, ext_hook=_ext_hook)
+    unpacker.feed(data)
+    return list(unpacker)
+
+
+def decode(message):
+    """Will return the events of a Forward protocol message.
+
+    :message: Decoded msgpack message
+    :returns: Tuple with the list of (tag, time, record) events and
+    the option of the message.
+    """
+    tag, entries = message[0], message[1]
+    if isinstance(entries, (bytes, list)):
+        option = message[2] if len(message) > 2 else {}
+        if isinstance(entries, bytes):
+            if option.get("compressed") == "gzip":
+                entries = gzip.decompress(entries)
+            entries = _unpack(entries)
+        return [(tag, entry[0], entry[1]) for entry in entries], option
+    option = message[3] if len(message) > 3 else {}
+    return [(tag, message[1], message[2])], option
+
+
+class FakeFluentd(object):
+    """Local server implementing the Forward protocol of fluentd. The
+    received events are collected in :attr:`events`."""
+
+    def __init__(self, host="127.0.0.1", port=0, ack=True, latency=0.0,
+                 failure_rate=0.0, keep=True):
+        """
+        :host: Host to listen on
+        :port: Port to listen on. 0 chooses a free port.
+        :ack: Acknowledge messages which have a `chunk` option.
+        :latency: Seconds to wait before processing a message.
+        :failure_rate: Probability to close the connection instead of
+        processing a message.
+        :keep: Keep the received events. If False only the counters are
+        updated, e.g for benchmarks.
+        """
+        self.ack = ack
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.keep = keep
+        #: List of raw received messages
+        self.messages = []
+        #: List of (tag, time, record) tuples
+        self.events = []
+        self.stats = {"connections": 0, "messages": 0, "events": 0,
+                      "bytes": 0, "failures": 0}
+        self._cond = threading.Condition()
+        self._connections = set()
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self.host, self.port = self._sock.getsockname()[:2]
+        self._thread = None
+
+    def start(self):
+        """Start accepting connections in a background thread."""
+        self._sock.listen(128)
+        self._thread = threading.Thread(name="tedega_fake_fluentd",
+                                        target=self._accept, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Close the server and all connections."""
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        with self._cond:
+            connections = list(self._connections)
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def wait_for(self, count, timeout=5.0):
+        """Wait until at least `count` events have been received.
+
+        :returns: True if the events have been received in time
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.stats["events"] < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            with self._cond:
+                self._connections.add(conn)
+                self.stats["connections"] += 1
+            threading.Thread(name="tedega_fake_fluentd_connection",
+                             target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        unpacker = msgpack.Unpacker(raw=False, ext_hook=_ext_hook)
+        try:
+            while True:
+                data = conn.recv(256 * 1024)
+                if not data:
+                    return
+                with self._cond:
+                    self.stats["bytes"] += len(data)
+                unpacker.feed(data)
+                for message in unpacker:
+                    if self.latency:
+                        time.sleep(self.latency)
+                    if self.failure_rate and random.random() < self.failure_rate:
+                        with self._cond:
+                            self.stats["failures"] += 1
+                        return
+                    self._received(conn, message)
+        except OSError:
+            pass
+        finally:
+            with self._cond:
+                self._connections.discard(conn)
+            conn.close()
+
+    def _received(self, conn, message):
+        events, option = decode(message)
+        with self._cond:
+            if self.keep:
+                self.messages.append(message)
+                self.events.extend(events)
+            self.stats["messages"] += 1
+            self.stats["events"] += len(events)
+            self._cond.notify_all()
+        if self.ack and option.get("chunk"):
+            conn.sendall(msgpack.packb({"ack": option["chunk"]}))
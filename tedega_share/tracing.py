@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Hierarchical timing of requests.
+
+The correlation_id of the current request and the currently active
+span are stored in context variables. This way they follow the
+request through threads (with `contextvars.copy_context`) and asyncio
+tasks without being passed around by hand. The :class:`Logger` adds
+them to every message which is logged while a span is active.
+
+A :class:`span` can be used as context manager or as decorator::
+
+        @span("handle_request")
+        def handle_request(request):
+            with span("load"):
+                ...
+            with span("render"):
+                ...
+
+When the outermost span of a request ends, the timing tree of all
+nested spans is logged in one message of the category *PROCTIME*::
+
+        {"span": {"name": "handle_request", "span_id": "...",
+                  "start": 0.0, "time": 0.12,
+                  "children": [{"name": "load", "start": 0.001,
+                                "time": 0.1, ...}, ...]}}
+
+`start` is the offset in seconds from the begin of the outermost span,
+`time` the duration of the span in seconds.
+"""
+
+import contextvars
+import functools
+import random
+from time import perf_counter_ns
+
+#: Maximum number of spans in the tree of one request. Further spans
+#: are still timed but not added to the tree.
+MAX_SPANS = 1000
+
+_correlation_id = contextvars.ContextVar("tedega_correlation_id", default=None)
+_current_span = contextvars.ContextVar("tedega_span", default=None)
+
+
+def get_correlation_id():
+    """Will return the correlation_id of the current context or None."""
+    return _correlation_id.get()
+
+
+def get_current_span():
+    """Will return the active :class:`span` of the current context or
+    None."""
+    return _current_span.get()
+
+
+def set_correlation_id(correlation_id):
+    """Set the correlation_id of the current context. Usually called
+    when a request enters the service with the correlation_id of the
+    request.
+
+    :correlation_id: Correlation id of the request
+    :returns: Token to restore the previous value with
+    :func:`reset_correlation_id`
+    """
+    return _correlation_id.set(correlation_id)
+
+
+def reset_correlation_id(token):
+    """Restore the correlation_id which was set before the token was
+    created with :func:`set_correlation_id`."""
+    _correlation_id.reset(token)
+
+
+class span(object):
+    """Context manager and decorator which times a block of code as
+    span of the current request. If there is no correlation_id in the
+    current context a new one is generated for the outermost span."""
+
+    __slots__ = ("name", "span_id", "parent", "children", "error",
+                 "started_at", "ended_at", "_root", "_count", "_tokens")
+
+    def __init__(self, name):
+        """
+        :name: Name of the span
+        """
+        self.name = name
+        self.span_id = None
+        self.parent = None
+        self.children = []
+        self.error = None
+        self.started_at = None
+        self.ended_at = None
+        self._root = None
+        self._count = 0
+        self._tokens = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.span_id = "%016x" % random.getrandbits(64)
+        tokens = []
+        if parent is None:
+            self._root = self
+            if _correlation_id.get() is None:
+                import uuid
+                tokens.append(_correlation_id.set(str(uuid.uuid4())))
+        else:
+            self.parent = parent
+            self._root = parent._root
+        tokens.append(_current_span.set(self))
+        self._tokens = tokens
+        self.started_at = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.ended_at = perf_counter_ns()
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        correlation_id = _correlation_id.get()
+        for token in reversed(self._tokens):
+            token.var.reset(token)
+        root = self._root
+        if self.parent is not None:
+            if root._count < MAX_SPANS:
+                root._count += 1
+                self.parent.children.append(self)
+        else:
+            _log_span(self, correlation_id)
+        return False
+
+    def __call__(self, func):
+        import inspect
+        name = self.name
+        if inspect.iscoroutinefunction(func):
+            async def wrap(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+        else:
+            def wrap(*args, **kwargs):
+                with span(name):
+                    return func(*args, **kwargs)
+        return functools.wraps(func)(wrap)
+
+    @property
+    def time(self):
+        """Duration of the span in seconds."""
+        end = self.ended_at if self.ended_at is not None else perf_counter_ns()
+        return (end - self.started_at) / 1e9
+
+    def to_dict(self, root_started_at=None):
+        """Will return the span and all its children as dictionary."""
+        if root_started_at is None:
+            root_started_at = self.started_at
+        result = {"name": self.name,
+                  "span_id": self.span_id,
+                  "start": (self.started_at - root_started_at) / 1e9,
+                  "time": self.time}
+        if self.error is not None:
+            result["error"] = self.error
+        if self.children:
+            result["children"] = [child.to_dict(root_started_at)
+                                  for child in self.children]
+        return result
+
+
+def _log_span(root, correlation_id):
+    # Imported here, as the logger module depends on this module.
+    from .logger import log
+    if log is not None:
+        log.info(lambda: {"span": root.to_dict()}, "PROCTIME", correlation_id)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures shared by the tests.
+"""
+import json
+import logging
+import pytest
+from tedega_share.logger import Logger
+
+
+class MemoryHandler(logging.Handler):
+    """Handler which collects the decoded messages."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(json.loads(record.getMessage()))
+
+
+@pytest.fixture
+def log(request):
+    """:class:`tedega_share.logger.Logger` at level DEBUG. The logged
+    messages are collected as dictionaries in `log.messages`."""
+    handler = MemoryHandler()
+    python_logger = logging.getLogger(request.module.__name__)
+    python_logger.setLevel(logging.DEBUG)
+    python_logger.propagate = False
+    python_logger.handlers = [handler]
+    log = Logger(python_logger, "xxx")
+    log.messages = handler.messages
+    return log
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_adaptive
+----------------------------------
+
+Tests for `tedega_share.adaptive` module.
+"""
+import logging
+import pytest
+from tedega_share.adaptive import AdaptiveController
+
+
+def _log_all(log):
+    del log.messages[:]
+    log.debug("debug")
+    log.info("request", "REQUEST", correlation_id="1")
+    log.debug("auth", "AUTH")
+    log.error("error", "REQUEST")
+    return [m["message"] for m in log.messages]
+
+
+def test_stages(log):
+    cpu = [95.0]
+    controller = AdaptiveController(log, recover_after=2, get_cpu=lambda: cpu[0],
+                                    stages=[{}, {logging.DEBUG: 0.0}, {"REQUEST": 0.0}])
+    log.add_filter(controller)
+    assert _log_all(log) == ["debug", "request", "auth", "error"]
+    controller.run()
+    change = log.messages[-1]
+    assert change["stage"] == 1 and change["previous"] == 0
+    assert change["rates"] == {"DEBUG": 0.0}
+    assert change["cpu"] == 95.0
+    assert _log_all(log) == ["request", "auth", "error"]
+    controller.run()
+    controller.run()
+    assert controller.stage == 2
+    assert _log_all(log) == ["debug", "auth", "error"]
+    # Recovery only after two checks below the low thresholds.
+    cpu[0] = 80.0
+    controller.run()
+    controller.run()
+    assert controller.stage == 2
+    cpu[0] = 10.0
+    controller.run()
+    assert controller.stage == 2
+    controller.run()
+    assert controller.stage == 1
+    assert controller.stats()["dropped"] == 2
+
+
+def test_protected(log):
+    with pytest.raises(ValueError):
+        AdaptiveController(log, stages=[{logging.ERROR: 0.0}])
+    with pytest.raises(ValueError):
+        AdaptiveController(log, stages=[{"AUTH": 0.5}])
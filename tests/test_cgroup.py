@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cgroup
+----------------------------------
+
+Tests for `tedega_share.cgroup` module.
+"""
+import os
+import threading
+import pytest
+from tedega_share.cgroup import CgroupSampler, ContainerProbe
+
+pytestmark = pytest.mark.skipif(not os.path.exists("/proc/self/status"),
+                                reason="Needs the proc filesystem")
+
+
+def _write(directory, name, content):
+    with open(os.path.join(str(directory), name), "w") as f:
+        f.write(content)
+
+
+def test_cgroup_v2(tmpdir):
+    _write(tmpdir, "cgroup.controllers", "cpu memory io")
+    _write(tmpdir, "cpu.max", "200000 100000\n")
+    _write(tmpdir, "cpu.stat", "usage_usec 1000000\nnr_periods 10\n"
+                               "nr_throttled 1\nthrottled_usec 5000\n")
+    _write(tmpdir, "memory.current", "268435456\n")
+    _write(tmpdir, "memory.max", "max\n")
+    _write(tmpdir, "memory.pressure", "some avg10=1.50 avg60=0.80 avg300=0.20 total=1\n"
+                                      "full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n")
+    sampler = CgroupSampler(root=str(tmpdir))
+    assert sampler.version == 2
+    _write(tmpdir, "cpu.stat", "usage_usec 1500000\nnr_periods 30\n"
+                               "nr_throttled 6\nthrottled_usec 105000\n")
+    sample = sampler.sample()
+    cgroup = sample["cgroup"]
+    assert cgroup["cpu_limit"] == 2.0
+    assert cgroup["cpu_usage"] > 0
+    assert cgroup["throttled_periods"] == 5
+    assert cgroup["throttled_seconds"] == 0.1
+    assert cgroup["throttled_ratio"] == 0.25
+    assert cgroup["memory"] == 268435456
+    assert cgroup["memory_limit"] is None
+    assert cgroup["memory_pressure"] == 1.5
+    process = sample["process"]
+    assert process["rss"] > 0
+    assert process["threads"] >= 1
+    assert process["fds"] >= 3
+    assert process["ctx_switches_voluntary"] >= 0
+    sampler.close()
+
+
+def test_cgroup_v1(tmpdir):
+    for controller in ("cpu", "cpuacct", "memory"):
+        tmpdir.mkdir(controller)
+    _write(tmpdir.join("cpu"), "cpu.cfs_quota_us", "50000\n")
+    _write(tmpdir.join("cpu"), "cpu.cfs_period_us", "100000\n")
+    _write(tmpdir.join("cpu"), "cpu.stat", "nr_periods 0\nnr_throttled 0\nthrottled_time 0\n")
+    _write(tmpdir.join("cpuacct"), "cpuacct.usage", "1000\n")
+    _write(tmpdir.join("memory"), "memory.usage_in_bytes", "1024\n")
+    _write(tmpdir.join("memory"), "memory.limit_in_bytes", "9223372036854771712\n")
+    sampler = CgroupSampler(root=str(tmpdir))
+    assert sampler.version == 1
+    cgroup = sampler.sample()["cgroup"]
+    assert cgroup["cpu_limit"] == 0.5
+    assert cgroup["throttled_ratio"] == 0.0
+    assert cgroup["memory"] == 1024
+    assert cgroup["memory_limit"] is None
+    sampler.close()
+
+
+def test_no_cgroup(tmpdir):
+    sampler = CgroupSampler(root=str(tmpdir))
+    assert sampler.version is None
+    sample = sampler.sample()
+    assert sample["cgroup"]["cpu_limit"] is None
+    assert "memory" not in sample["cgroup"]
+    assert "rss" in sample["process"]
+
+
+def test_probe(log, tmpdir):
+    _write(tmpdir, "cgroup.controllers", "cpu memory")
+    _write(tmpdir, "memory.current", "1024\n")
+    probe = ContainerProbe(log, root=str(tmpdir))
+    probe.run()
+    assert log.messages == []
+    probe.run()
+    assert log.messages[-1]["category"] == "SYSTEM"
+    assert log.messages[-1]["cgroup"]["memory"] == 1024
+    fds = list(probe.sampler._fds.values())
+    assert fds
+    probe.stop()
+    # The files are closed.
+    with pytest.raises(OSError):
+        os.fstat(fds[0])
+
+
+def test_close_while_sampling(tmpdir, monkeypatch):
+    _write(tmpdir, "cgroup.controllers", "cpu memory")
+    _write(tmpdir, "memory.current", "1024\n")
+    sampler = CgroupSampler(root=str(tmpdir))
+    reading, closed = threading.Event(), threading.Event()
+    pread = os.pread
+
+    def slow_pread(fd, size, offset):
+        reading.set()
+        closed.wait(0.2)
+        return pread(fd, size, offset)
+    monkeypatch.setattr(os, "pread", slow_pread)
+    closer = threading.Thread(target=lambda: (reading.wait(), sampler.close(), closed.set()))
+    closer.start()
+    sample = sampler.sample()
+    closer.join()
+    # The sample was not disturbed and the files are closed afterwards.
+    assert sample["cgroup"]["memory"] == 1024
+    assert closed.is_set()
+    assert sampler._fds == {}
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_connectivity
+----------------------------------
+
+Tests for `tedega_share.connectivity` module.
+"""
+import socket
+import threading
+import time
+from tedega_share.connectivity import ConnectivityProber, ConnectivityProbe
+
+
+def _closed_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_check():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+    port = server.getsockname()[1]
+    closed = _closed_port()
+    prober = ConnectivityProber([("127.0.0.1", port), ("localhost", str(closed))],
+                                timeout=1.0)
+    try:
+        result = prober.check()
+        up = result["127.0.0.1:%s" % port]
+        assert up["up"] is True
+        assert up["connect"] >= 0 and up["dns"] >= 0
+        down = result["localhost:%s" % closed]
+        assert down["up"] is False
+        assert down["error"] == "ConnectionRefusedError"
+        # The resolved address is cached.
+        assert prober.check()["127.0.0.1:%s" % port]["dns"] == 0.0
+    finally:
+        prober.close()
+        server.close()
+
+
+def test_changes():
+    probe = ConnectivityProbe([], report_interval=None)
+    changes = probe.changes({"a:1": {"up": True}, "b:1": {"up": False}})
+    assert changes == {"a:1": {"up": True, "previous": None},
+                       "b:1": {"up": False, "previous": None}}
+    assert probe.changes({"a:1": {"up": True}, "b:1": {"up": False}}) == {}
+    changes = probe.changes({"a:1": {"up": False}, "b:1": {"up": False}})
+    assert changes == {"a:1": {"up": False, "previous": True}}
+
+
+def test_close_while_checking():
+    prober = ConnectivityProber([("localhost", 80)], timeout=0.2)
+
+    async def hanging_resolve(host, port, result):
+        # A DNS lookup which hangs in the executor
+        await prober._loop.run_in_executor(None, time.sleep, 1.0)
+    prober._resolve = hanging_resolve
+    results = []
+    thread = threading.Thread(target=lambda: results.append(prober.check()))
+    thread.start()
+    time.sleep(0.1)
+    # The loop is running in the other thread, so it is closed there.
+    prober.close()
+    started_at = time.monotonic()
+    thread.join()
+    assert results[0]["localhost:80"]["error"] == "timeout"
+    assert prober._loop is None
+    # Waiting for the hanging lookup is limited by the timeout.
+    assert time.monotonic() - started_at < 0.8
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_dedup
+----------------------------------
+
+Tests for `tedega_share.dedup` module.
+"""
+import time
+from tedega_share.dedup import Deduplicator
+
+
+def test_suppress_and_summarize(log):
+    dedup = Deduplicator(log, window=60)
+    log.add_filter(dedup)
+    for _ in range(100):
+        log.error("Connection refused", "CUSTOM")
+    log.error({"error": "other"})
+    log.error(lambda: "not deduplicated")
+    log.error(lambda: "not deduplicated")
+    assert [m.get("message", m.get("error")) for m in log.messages] == [
+        "Connection refused", "other", "not deduplicated", "not deduplicated"]
+    dedup.run()
+    summary = log.messages[-1]
+    assert summary["category"] == "CUSTOM"
+    assert summary["message"] == "Connection refused"
+    assert summary["suppressed"] == 99
+    assert summary["first"] <= summary["last"]
+    # Nothing more to summarize.
+    dedup.run()
+    assert len(log.messages) == 5
+
+
+def test_window_and_lru(log):
+    dedup = Deduplicator(log, window=0.05, max_fingerprints=2, fields=["error"])
+    log.add_filter(dedup)
+    log.error({"error": "a", "i": 1})
+    log.error({"error": "a", "i": 2})
+    time.sleep(0.06)
+    log.error({"error": "a", "i": 3})
+    # The summary of the last window is written before the message.
+    assert [m.get("suppressed") for m in log.messages] == [None, 1, None]
+    log.error({"error": "a", "i": 4})
+    log.error({"error": "b"})
+    log.error({"error": "c"})
+    # The evicted message of the first window is summarized.
+    assert log.messages[-2]["suppressed"] == 1
+    assert log.messages[-2]["i"] == 3
+    assert log.messages[-1]["error"] == "c"
+
+
+def test_mixed_key_types(log):
+    dedup = Deduplicator(log, window=60)
+    log.add_filter(dedup)
+    log.error({1: "a", "1": "b"})
+    log.error({"1": "b", 1: "a"})
+    log.error({1: "b", "1": "a"})
+    assert len(log.messages) == 2
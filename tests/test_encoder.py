@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_encoder
+----------------------------------
+
+Tests for `tedega_share.encoder` module.
+"""
+import datetime
+import decimal
+import json
+import logging
+import msgpack
+from fluent import handler
+from tedega_share.encoder import EnvelopeEncoder, EnvelopeFormatter
+from tedega_share.logger import Logger
+from tedega_share.testing import FakeFluentd
+
+
+def _expected(host=True, **payload):
+    msg = {"service": "xxx", "category": "PING", "correlation_id": "123"}
+    if host:
+        msg["host"] = "myhost"
+    msg.update(payload)
+    return msg
+
+
+def test_envelope_renderings():
+    encoder = EnvelopeEncoder("xxx", "myhost")
+    envelope = encoder.envelope({"foo": 1, "bar": [1, 2]}, "PING", "123")
+    assert json.loads(str(envelope)) == _expected(host=False, foo=1, bar=[1, 2])
+    assert msgpack.unpackb(envelope.to_msgpack()) == _expected(foo=1, bar=[1, 2])
+    assert envelope.to_dict() == _expected(foo=1, bar=[1, 2])
+
+
+def test_envelope_string_and_empty_message():
+    encoder = EnvelopeEncoder("xxx", "myhost")
+    envelope = encoder.envelope("hello", "PING", "123")
+    assert json.loads(envelope.to_json()) == _expected(host=False, message="hello")
+    assert msgpack.unpackb(envelope.to_msgpack()) == _expected(message="hello")
+    envelope = encoder.envelope({}, "PING", "123")
+    assert json.loads(envelope.to_json()) == _expected(host=False)
+    assert msgpack.unpackb(envelope.to_msgpack()) == _expected()
+
+
+def test_envelope_large_payload():
+    encoder = EnvelopeEncoder("xxx", "myhost")
+    payload = dict(("key%d" % i, i) for i in range(20))
+    envelope = encoder.envelope(payload, "PING", "123")
+    assert msgpack.unpackb(envelope.to_msgpack()) == _expected(**payload)
+
+
+def test_envelope_overriding_keys():
+    encoder = EnvelopeEncoder("xxx", "myhost")
+    envelope = encoder.envelope({"host": "other"}, "PING", "123")
+    expected = _expected()
+    expected["host"] = "other"
+    assert json.loads(envelope.to_json()) == expected
+    assert msgpack.unpackb(envelope.to_msgpack()) == expected
+
+
+def test_envelope_fallback_encoding():
+    encoder = EnvelopeEncoder("xxx", "myhost")
+    now = datetime.datetime.now()
+    envelope = encoder.envelope({"now": now}, "PING", "123")
+    assert "now" in json.loads(envelope.to_json())
+    assert msgpack.unpackb(envelope.to_msgpack())["host"] == "myhost"
+
+
+def test_fluent_handler_fallback_encoding():
+    with FakeFluentd() as fluentd:
+        fluent_handler = handler.FluentHandler("xxx", host=fluentd.host, port=fluentd.port)
+        fluent_handler.setFormatter(EnvelopeFormatter())
+        python_logger = logging.getLogger("test_encoder")
+        python_logger.setLevel(logging.INFO)
+        python_logger.propagate = False
+        python_logger.handlers = [fluent_handler]
+        log = Logger(python_logger, "xxx")
+        log.info({"now": datetime.datetime(2020, 1, 2), "price": decimal.Decimal("1.5"),
+                  "count": 1}, "CUSTOM")
+        assert fluentd.wait_for(1)
+        fluent_handler.close()
+    record = fluentd.events[0][2]
+    assert record["category"] == "CUSTOM"
+    assert record["count"] == 1
+    assert "2020-01-02" in record["now"]
+    assert "1.5" in str(record["price"])
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_exporter
+----------------------------------
+
+Tests for `tedega_share.exporter` module.
+"""
+import urllib.error
+import urllib.request
+import pytest
+from tedega_share.exporter import CONTENT_TYPE, MetricsExporter, Registry
+from tedega_share.metrics import ProctimeAggregator
+
+
+def test_render():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Handled requests", ["method"])
+    registry.gauge("up").set(1)
+    latency = registry.histogram("latency_seconds", labels=["path"], buckets=[0.1, 1])
+    requests.inc(labels={"method": "GET"})
+    requests.inc(2, {"method": 'P"OST'})
+    for value in (0.05, 0.5, 5):
+        latency.observe(value, {"path": "/"})
+    text = registry.render().decode("utf-8")
+    assert text.endswith("# EOF\n")
+    assert "# TYPE requests counter\n" in text
+    assert "# HELP requests Handled requests\n" in text
+    assert 'requests_total{method="GET"} 1\n' in text
+    assert 'requests_total{method="P\\"OST"} 2\n' in text
+    assert "up 1\n" in text
+    assert 'latency_seconds_bucket{path="/",le="0.1"} 1\n' in text
+    assert 'latency_seconds_bucket{path="/",le="1.0"} 2\n' in text
+    assert 'latency_seconds_bucket{path="/",le="+Inf"} 3\n' in text
+    assert 'latency_seconds_count{path="/"} 3\n' in text
+    assert 'latency_seconds_sum{path="/"} 5.55\n' in text
+    # The exposition is cached until a value changes.
+    assert registry.render() is registry.render()
+    registry.gauge("up").set(1)
+    assert registry.render() is registry.render()
+    cached = registry.render()
+    registry.gauge("up").set(0)
+    assert b"up 0\n" in registry.render() and registry.render() is not cached
+    with pytest.raises(ValueError):
+        registry.counter("up")
+
+
+def test_exporter(log):
+    aggregator = ProctimeAggregator()
+    aggregator.record("f", 2000000)
+    aggregator.record("f", 3000000000, "ValueError")
+    exporter = MetricsExporter(aggregator=aggregator, log_metrics=False)
+    log.add_filter(exporter)
+    log.info({"cpu": 12.5, "cpus": [10.0, 15.0], "filesystems": {"/": 40.1},
+              "load": [0.5, 0.2, 0.1]}, "SYSTEM")
+    log.info({"hosts": {"db:5432": {"up": False, "error": "timeout", "time": 5.0}}}, "PING")
+    log.info({"func": "f", "count": 2}, "PROCTIME")
+    # Spans and the concurrency are not exported.
+    log.info({"span": {"name": "request", "time": 0.1}}, "PROCTIME")
+    log.info({"func": "f", "concurrency": {"current": 1}}, "PROCTIME")
+    log.info("Still logged")
+    assert [m.get("message") for m in log.messages] == [None, None, "Still logged"]
+    assert log.messages[0]["span"]["name"] == "request"
+    exporter.run()
+    text = exporter.registry.render().decode("utf-8")
+    assert "tedega_system_cpu 12.5\n" in text
+    assert 'tedega_system_cpus{key="1"} 15.0\n' in text
+    assert 'tedega_system_filesystems{key="/"} 40.1\n' in text
+    assert 'tedega_ping_up{host="db:5432"} 0\n' in text
+    assert 'tedega_ping_seconds{host="db:5432"} 5.0\n' in text
+    assert "tedega_ping_connect_seconds{" not in text
+    assert 'tedega_proctime_seconds_bucket{func="f",le="0.0025"} 1\n' in text
+    assert 'tedega_proctime_seconds_bucket{func="f",le="2.5"} 1\n' in text
+    assert 'tedega_proctime_seconds_count{func="f"} 2\n' in text
+    assert 'tedega_proctime_errors_total{func="f",error="ValueError"} 1\n' in text
+
+
+def test_server():
+    exporter = MetricsExporter()
+    exporter.registry.gauge("up").set(1)
+    server = exporter.serve("127.0.0.1", 0)
+    try:
+        url = "http://%s:%s" % server.address
+        with urllib.request.urlopen(url + "/metrics") as response:
+            assert response.headers["Content-Type"] == CONTENT_TYPE
+            assert b"\nup 1\n" in response.read()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "/other")
+    finally:
+        exporter.stop()
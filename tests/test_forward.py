@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_forward
+----------------------------------
+
+Tests for `tedega_share.forward` module.
+"""
+import datetime
+import decimal
+import gzip
+import logging
+import socket
+import msgpack
+from tedega_share.encoder import Envelope, EnvelopeFormatter
+from tedega_share.forward import EnvelopeFluentHandler, PackedForwardSender
+from tedega_share.logger import Logger
+from tedega_share.testing import FakeFluentd
+
+
+def _unpack(data):
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(data)
+    return list(unpacker)
+
+
+def test_batches_per_tag():
+    server = FakeFluentd().start()
+    sender = PackedForwardSender(port=server.port, flush_interval=60)
+    for i in range(3):
+        sender.emit("a", 1, {"i": i})
+    sender.emit("b", 2, {"i": 3})
+    sender.close()
+    assert server.wait_for(4)
+    server.stop()
+    messages = dict((m[0], m) for m in server.messages)
+    assert len(server.messages) == 2
+    assert messages["a"][2] == {"size": 3}
+    assert _unpack(messages["a"][1]) == [[1, {"i": i}] for i in range(3)]
+    assert _unpack(messages["b"][1]) == [[2, {"i": 3}]]
+    assert sender.stats()["records"] == 4
+
+
+def test_flush_on_size():
+    server = FakeFluentd().start()
+    sender = PackedForwardSender(port=server.port, batch_size=1, flush_interval=60)
+    sender.emit("a", 1, {"i": 1})
+    sender.emit("a", 1, {"i": 2})
+    assert sender.stats()["messages"] == 2
+    sender.close()
+    server.stop()
+
+
+def test_compress_and_ack():
+    server = FakeFluentd(ack=True).start()
+    sender = PackedForwardSender(port=server.port, compress=True, ack=True)
+    sender.emit("a", 1, {"i": 1})
+    sender.close()
+    server.stop()
+    message = server.messages[0]
+    assert message[2]["compressed"] == "gzip"
+    assert _unpack(gzip.decompress(message[1])) == [[1, {"i": 1}]]
+    assert sender.stats()["errors"] == 0
+
+
+def test_unreachable_overflow():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    overflow = []
+    sender = PackedForwardSender(port=port, bufmax=1, overflow_handler=overflow.extend)
+    sender.emit("a", 1, {"i": 1})
+    sender.close()
+    stats = sender.stats()
+    assert stats["dropped"] == 1
+    assert stats["errors"] == 1
+    assert len(overflow) == 1
+    # Replay the spilled message once fluentd is back.
+    server = FakeFluentd().start()
+    sender = PackedForwardSender(port=server.port)
+    assert sender.send_message(overflow[0])
+    sender.close()
+    assert server.wait_for(1)
+    server.stop()
+    assert _unpack(server.messages[0][1]) == [[1, {"i": 1}]]
+
+
+def test_close_spills_pendings():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    overflow = []
+    sender = PackedForwardSender(port=port, overflow_handler=overflow.extend)
+    sender.emit("a", 1, {"i": 1})
+    sender.flush()
+    assert sender.stats()["pending"] == 1
+    sender.close()
+    assert sender.stats()["pending"] == 0
+    assert len(overflow) == 1
+
+
+def test_envelope_fluent_handler(monkeypatch):
+    # Envelopes are sent in their msgpack rendering without a dictionary.
+    monkeypatch.setattr(Envelope, "to_packable_dict", None)
+    with FakeFluentd() as fluentd:
+        fluent_handler = EnvelopeFluentHandler("xxx", host=fluentd.host, port=fluentd.port)
+        fluent_handler.setFormatter(EnvelopeFormatter())
+        python_logger = logging.getLogger("test_forward")
+        python_logger.setLevel(logging.INFO)
+        python_logger.propagate = False
+        python_logger.handlers = [fluent_handler]
+        log = Logger(python_logger, "xxx")
+        log.info({"now": datetime.datetime(2020, 1, 2), "price": decimal.Decimal("1.5"),
+                  "count": 1}, "CUSTOM")
+        python_logger.info("plain")
+        assert fluentd.wait_for(2)
+        fluent_handler.close()
+    tag, _, record = fluentd.events[0]
+    assert tag == "xxx"
+    assert record["category"] == "CUSTOM"
+    assert record["count"] == 1
+    assert "2020-01-02" in record["now"]
+    assert "1.5" in str(record["price"])
+    assert fluentd.events[1][2]["message"] == "plain"
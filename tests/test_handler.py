@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_handler
+----------------------------------
+
+Tests for `tedega_share.handler` module.
+"""
+import logging
+import threading
+import pytest
+from tedega_share.handler import AsyncHandler
+
+
+class MemoryHandler(logging.Handler):
+
+    def __init__(self, gate=None):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.gate = gate
+        self.closed = False
+
+    def emit(self, record):
+        if self.gate:
+            self.gate.wait()
+        self.records.append(record.getMessage())
+
+    def close(self):
+        self.closed = True
+        logging.Handler.close(self)
+
+
+def _record(msg):
+    return logging.LogRecord("test", logging.INFO, __file__, 0, msg, None, None)
+
+
+def _fill(handler, target, num):
+    # The first record is taken by the sender thread which then blocks
+    # in the target until the gate opens.
+    handler.handle(_record(0))
+    while handler.stats()["queued"]:
+        pass
+    for i in range(1, num + 1):
+        handler.handle(_record(i))
+
+
+def test_unknown_overflow():
+    with pytest.raises(ValueError):
+        AsyncHandler(MemoryHandler(), overflow="xxx")
+
+
+def test_close_flushes_queue():
+    target = MemoryHandler()
+    h = AsyncHandler(target)
+    for i in range(100):
+        h.handle(_record(i))
+    h.close()
+    assert target.records == [str(i) for i in range(100)]
+    assert target.closed
+    assert h.stats() == {"queued": 0, "sent": 100, "dropped": 0, "errors": 0}
+
+
+def test_drop_newest():
+    gate = threading.Event()
+    target = MemoryHandler(gate)
+    h = AsyncHandler(target, maxsize=2)
+    _fill(h, target, 4)
+    gate.set()
+    h.close()
+    assert target.records == ["0", "1", "2"]
+    assert h.stats()["dropped"] == 2
+
+
+def test_drop_oldest():
+    gate = threading.Event()
+    target = MemoryHandler(gate)
+    h = AsyncHandler(target, maxsize=2, overflow="drop-oldest")
+    _fill(h, target, 4)
+    gate.set()
+    h.close()
+    assert target.records == ["0", "3", "4"]
+    assert h.stats()["dropped"] == 2
+
+
+def test_block_with_timeout():
+    gate = threading.Event()
+    target = MemoryHandler(gate)
+    h = AsyncHandler(target, maxsize=1, overflow="block", timeout=0.05)
+    _fill(h, target, 2)
+    assert h.stats()["dropped"] == 1
+    threading.Timer(0.05, gate.set).start()
+    h.timeout = 5
+    h.handle(_record(3))
+    h.close()
+    assert target.records == ["0", "1", "3"]
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_import
+----------------------------------
+
+Tests for the lazy imports of the `tedega_share` package.
+"""
+import subprocess
+import sys
+
+HEAVY_MODULES = ("psutil", "asyncio", "fluent", "msgpack", "passlib")
+
+
+def _python(*args):
+    return subprocess.run([sys.executable] + list(args), check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+def _heavy_modules(*modules):
+    """Will return the heavy modules which are loaded after importing
+    the modules in a new interpreter."""
+    code = ("import sys, {};"
+            "print(','.join(m for m in {!r} if m in sys.modules))".format(
+                ", ".join(modules), HEAVY_MODULES))
+    return _python("-c", code).stdout.strip()
+
+
+def test_lazy_api():
+    code = ("import sys, tedega_share;"
+            "assert 'tedega_share.logger' not in sys.modules;"
+            "tedega_share.get_logger;"
+            "assert 'tedega_share.logger' in sys.modules")
+    _python("-c", code)
+
+
+def test_no_heavy_imports():
+    assert _heavy_modules("tedega_share") == ""
+    assert _heavy_modules("tedega_share.logger", "tedega_share.lib.security") == ""
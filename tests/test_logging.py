@@ -43,3 +43,24 @@ def test_buildtag():
     os.environ.setdefault("DOCKER_HOSTNAME", "foobar")
     tag = build_tag("xxx")
     assert tag == "foobar.xxx.%s" % hostname
+
+
+def test_disabled_level_skips_message():
+    import logging
+    from tedega_share.logger import Logger
+    calls = []
+
+    def payload():
+        calls.append(1)
+        return {"foo": "bar"}
+
+    python_logger = logging.getLogger("test_disabled_level")
+    python_logger.setLevel(logging.INFO)
+    log = Logger(python_logger, "xxx")
+    log.debug(payload)
+    assert not log.is_enabled_for(logging.DEBUG)
+    assert calls == []
+    python_logger.setLevel(logging.DEBUG)
+    log.debug(payload)
+    assert log.is_enabled_for(logging.DEBUG)
+    assert calls == [1]
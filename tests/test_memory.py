@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_memory
+----------------------------------
+
+Tests for `tedega_share.memory` module.
+"""
+import tracemalloc
+import pytest
+from tedega_share.memory import MemoryProbe
+
+
+class Leak(object):
+    pass
+
+
+def _leak(leaked):
+    leaked.extend(Leak() for _ in range(5000))
+
+
+def test_growth(log):
+    leaked = []
+    probe = MemoryProbe(log, duty_cycle=1, top=5)
+    try:
+        probe.run()
+        assert tracemalloc.is_tracing()
+        assert log.messages == []
+        _leak(leaked)
+        probe.run()
+        report = log.messages[-1]
+        assert report["category"] == "SYSTEM"
+        traced = report["tracemalloc"]
+        assert traced["growth"] > 0
+        assert len(traced["top"]) <= 5
+        assert any("test_memory.py" in site["site"] for site in traced["top"])
+        _leak(leaked)
+        probe.run()
+        growth = log.messages[-1]["objects"]["growth"]
+        assert growth[Leak.__module__ + ".Leak"] > 1000
+    finally:
+        probe.stop()
+    assert not tracemalloc.is_tracing()
+
+
+def test_duty_cycle(log):
+    probe = MemoryProbe(log, duty_cycle=0.5, objects=0)
+    probe.run()
+    assert tracemalloc.is_tracing()
+    probe.run()
+    assert not tracemalloc.is_tracing()
+    assert "objects" not in log.messages[-1]
+    with pytest.raises(ValueError):
+        MemoryProbe(log, duty_cycle=0)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_metrics
+----------------------------------
+
+Tests for `tedega_share.metrics` module.
+"""
+import threading
+from tedega_share.metrics import Histogram, ShardedHistogram, ProctimeAggregator
+
+
+def test_histogram_buckets():
+    histogram = Histogram(precision=5)
+    last = -1
+    for value in list(range(5000)) + [2 ** 40, 2 ** 63]:
+        index = histogram.index(value)
+        low, high = histogram.bounds(index)
+        assert low <= value <= high
+        assert index >= last
+        last = index
+        # Relative error is bound by the precision.
+        assert high - low <= max(1, low / 16)
+
+
+def test_histogram_stats():
+    histogram = Histogram()
+    for value in range(1, 1001):
+        histogram.record(value * 1000)
+    stats = histogram.stats(scale=1000)
+    assert stats["count"] == 1000
+    assert stats["mean"] == 500.5
+    assert 0.95 < stats["min"] <= 1
+    assert 1000 <= stats["max"] < 1035
+    for key, expected in [("p50", 500), ("p90", 900), ("p99", 990), ("p999", 999)]:
+        assert abs(stats[key] - expected) / expected < 0.04
+
+
+def test_sharded_histogram():
+    histogram = ShardedHistogram()
+
+    def record():
+        for i in range(1000):
+            histogram.record(i)
+    threads = [threading.Thread(target=record) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert histogram.snapshot().count == 4000
+    # The shards of the finished threads are retired.
+    assert histogram._shards == []
+    assert histogram.snapshot().count == 4000
+
+
+def test_proctime_aggregator_interval():
+    aggregator = ProctimeAggregator()
+    aggregator.record("foo", 1000)
+    aggregator.record("foo", 3000, error="ValueError")
+    stats = aggregator.collect()
+    assert len(stats) == 1
+    assert stats[0]["func"] == "foo"
+    assert stats[0]["count"] == 2
+    assert stats[0]["mean"] == 2e-6
+    assert stats[0]["errors"] == {"ValueError": 1}
+    assert aggregator.collect() == []
+    aggregator.record("foo", 1000)
+    stats = aggregator.collect()
+    assert stats[0]["count"] == 1
+    assert "errors" not in stats[0]
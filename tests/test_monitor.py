@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_monitor
+----------------------------------
+
+Tests for `tedega_share.monitor` module.
+"""
+import threading
+import time
+import pytest
+from tedega_share.monitor import Scheduler, Probe, FunctionProbe
+
+
+class CountingProbe(Probe):
+
+    def __init__(self, name, interval, jitter=0.0):
+        Probe.__init__(self, name, interval, jitter)
+        self.runs = []
+        self.stopped = False
+
+    def run(self):
+        self.runs.append(time.monotonic())
+
+    def stop(self):
+        self.stopped = True
+
+
+def test_invalid_interval():
+    with pytest.raises(ValueError):
+        Probe("xxx", interval=0)
+
+
+def test_probes_share_one_thread():
+    scheduler = Scheduler()
+    threads = threading.active_count()
+    a = scheduler.register(CountingProbe("a", 0.02))
+    b = scheduler.register(CountingProbe("b", 0.03, jitter=0.5))
+    time.sleep(0.2)
+    assert threading.active_count() == threads + 1
+    scheduler.stop()
+    assert 7 <= len(a.runs) <= 11
+    assert 4 <= len(b.runs) <= 8
+    # Runs are planned on a grid and do not drift.
+    assert abs((a.runs[-1] - a.runs[0]) - (len(a.runs) - 1) * 0.02) < 0.02
+
+
+def test_replace_unregister_and_reconfigure():
+    scheduler = Scheduler()
+    first = scheduler.register(CountingProbe("a", 0.01))
+    second = scheduler.register(CountingProbe("a", 60))
+    assert first.stopped
+    assert scheduler.probes == {"a": second}
+    scheduler.reconfigure("a", interval=0.01)
+    time.sleep(0.1)
+    assert len(second.runs) >= 5
+    scheduler.unregister("a")
+    assert second.stopped
+    runs = len(second.runs)
+    time.sleep(0.05)
+    assert len(second.runs) == runs
+    scheduler.stop()
+
+
+def test_failing_probe():
+    scheduler = Scheduler()
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise ValueError()
+    scheduler.register(FunctionProbe("fail", fail, interval=0.01))
+    time.sleep(0.05)
+    scheduler.stop()
+    assert len(calls) > 1
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_multiprocess
+----------------------------------
+
+Tests for `tedega_share.multiprocess` module.
+"""
+import multiprocessing
+import os
+from tedega_share.metrics import ProctimeAggregator
+from tedega_share.multiprocess import SharedMetrics
+
+
+def _publish(aggregator, shared):
+    shared.publish({"precision": aggregator.precision,
+                    "functions": aggregator.export()})
+
+
+def _worker(path, queue):
+    shared = SharedMetrics(path)
+    queue.put(shared.is_leader())
+    aggregator = ProctimeAggregator()
+    aggregator.record("f", 2000, "ValueError")
+    aggregator.record("g", 1000)
+    _publish(aggregator, shared)
+    queue.put(True)
+    # Keep the process alive until the leader has read the slot.
+    queue.get()
+
+
+def test_shared(tmpdir):
+    path = os.path.join(str(tmpdir), "metrics")
+    shared = SharedMetrics(path, slots=4)
+    assert shared.is_leader()
+    aggregator = ProctimeAggregator()
+    aggregator.record("f", 1000)
+    _publish(aggregator, shared)
+    assert shared.collect() == []
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    worker = context.Process(target=_worker, args=(path, queue))
+    worker.start()
+    try:
+        # The lock of the leader is held by this process.
+        assert queue.get(timeout=10) is False
+        assert queue.get(timeout=10)
+        aggregator.record("f", 1000)
+        _publish(aggregator, shared)
+        assert set(shared.read()) == {os.getpid(), worker.pid}
+        stats = dict((item["func"], item) for item in shared.collect())
+    finally:
+        queue.put(None)
+        worker.join(10)
+    assert stats["f"]["count"] == 2
+    assert stats["f"]["errors"] == {"ValueError": 1}
+    assert stats["g"]["count"] == 1
+    # Nothing new since the last collection, the slot of the worker is
+    # free again.
+    assert shared.collect() == []
+    assert list(shared.read()) == [os.getpid()]
+    shared.close()
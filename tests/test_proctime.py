@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_proctime
+----------------------------------
+
+Tests for the `log_proctime` decorator of the `tedega_share.logger` module.
+"""
+import asyncio
+import threading
+import time
+import pytest
+from tedega_share import logger
+from tedega_share.logger import log_proctime, track_concurrency
+from tedega_share.metrics import ConcurrencyAggregator, ProctimeAggregator
+
+
+@pytest.fixture
+def aggregator(monkeypatch):
+    aggregator = ProctimeAggregator()
+    monkeypatch.setattr(logger, "proctime_aggregator", aggregator)
+    return aggregator
+
+
+@pytest.fixture
+def concurrency(monkeypatch):
+    aggregator = ConcurrencyAggregator()
+    monkeypatch.setattr(logger, "concurrency_aggregator", aggregator)
+    return aggregator
+
+
+def _stats(aggregator):
+    return dict((stats.pop("func").rsplit(".", 1)[-1], stats)
+                for stats in aggregator.collect())
+
+
+def test_function_metadata_and_errors(aggregator):
+    class Foo(object):
+        @log_proctime
+        def bar(self, x):
+            """Docstring"""
+            if x is None:
+                raise ValueError()
+            return x
+
+    foo = Foo()
+    assert Foo.bar.__name__ == "bar"
+    assert Foo.bar.__doc__ == "Docstring"
+    assert foo.bar(1) == 1
+    with pytest.raises(ValueError):
+        foo.bar(None)
+    stats = aggregator.collect()[0]
+    assert stats["func"].endswith("Foo.bar")
+    assert stats["count"] == 2
+    assert stats["errors"] == {"ValueError": 1}
+
+
+def test_coroutine(aggregator):
+    @log_proctime
+    async def sleep():
+        await asyncio.sleep(0.05)
+        return 1
+
+    assert asyncio.run(sleep()) == 1
+    assert _stats(aggregator)["sleep"]["max"] >= 0.05
+
+
+def test_generator(aggregator):
+    @log_proctime
+    def produce():
+        time.sleep(0.01)
+        received = yield 1
+        time.sleep(0.01)
+        yield received
+        return 3
+
+    gen = produce()
+    assert next(gen) == 1
+    time.sleep(0.1)
+    assert gen.send(2) == 2
+    with pytest.raises(StopIteration) as e:
+        next(gen)
+    assert e.value.value == 3
+    stats = _stats(aggregator)["produce"]
+    # The time of the consumer is not included.
+    assert 0.019 <= stats["min"] < 0.08
+
+
+def test_generator_throw_and_close(aggregator):
+    @log_proctime
+    def produce():
+        try:
+            yield 1
+        except KeyError:
+            yield 2
+        yield 3
+
+    gen = produce()
+    next(gen)
+    assert gen.throw(KeyError()) == 2
+    gen.close()
+    gen = produce()
+    next(gen)
+    with pytest.raises(ValueError):
+        gen.throw(ValueError())
+    stats = _stats(aggregator)["produce"]
+    assert stats["count"] == 2
+    assert stats["errors"] == {"ValueError": 1}
+
+
+def test_async_generator(aggregator):
+    @log_proctime
+    async def produce():
+        await asyncio.sleep(0.01)
+        yield 1
+        await asyncio.sleep(0.01)
+        yield 2
+
+    async def consume():
+        items = []
+        async for item in produce():
+            items.append(item)
+            await asyncio.sleep(0.1)
+        return items
+
+    assert asyncio.run(consume()) == [1, 2]
+    stats = _stats(aggregator)["produce"]
+    assert 0.019 <= stats["min"] < 0.08
+
+
+def test_concurrency_limit(concurrency):
+    @track_concurrency(limit=2)
+    def work():
+        time.sleep(0.1)
+
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = concurrency.collect()[0]
+    assert stats["func"].endswith("work")
+    stats = stats["concurrency"]
+    assert (stats["current"], stats["peak"], stats["limit"], stats["waiting"]) == (0, 2, 2, 0)
+    assert (stats["started"], stats["completed"]) == (4, 4)
+    assert stats["wait"]["count"] == 4
+    assert stats["wait"]["max"] >= 0.05
+    assert 0 < stats["mean"] <= 2
+    assert stats["throughput"] > 0
+    # Idle functions are omitted.
+    assert concurrency.collect() == []
+
+
+def test_concurrency_coroutine(concurrency):
+    @track_concurrency
+    async def sleep():
+        await asyncio.sleep(0.05)
+
+    async def serve():
+        await asyncio.gather(*[sleep() for i in range(5)])
+
+    asyncio.run(serve())
+    stats = concurrency.collect()[0]["concurrency"]
+    assert (stats["peak"], stats["completed"]) == (5, 5)
+    assert "wait" not in stats
+    with pytest.raises(TypeError):
+        @track_concurrency
+        def produce():
+            yield 1
+
+
+def test_concurrency_loops_and_limits(concurrency):
+    @track_concurrency(limit=1)
+    async def sleep():
+        await asyncio.sleep(0.01)
+
+    async def serve():
+        await asyncio.gather(sleep(), sleep())
+
+    # Every event loop gets its own semaphore.
+    asyncio.run(serve())
+    asyncio.run(serve())
+    stats = concurrency.collect()[0]["concurrency"]
+    assert (stats["peak"], stats["completed"]) == (1, 4)
+    concurrency.tracker("other", 1)
+    with pytest.raises(ValueError):
+        concurrency.tracker("other", 2)
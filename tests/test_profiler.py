@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_profiler
+----------------------------------
+
+Tests for `tedega_share.profiler` module.
+"""
+import threading
+import time
+import pytest
+from tedega_share.profiler import ProfileProbe, StackSampler, decode_profile
+
+
+def _busy_loop(stopped):
+    while not stopped.is_set():
+        sum(range(1000))
+
+
+def test_profile(log):
+    stopped = threading.Event()
+    thread = threading.Thread(target=_busy_loop, args=(stopped,))
+    thread.start()
+    sampler = StackSampler(rate=200, max_overhead=0)
+    probe = ProfileProbe(log, sampler)
+    sampler.start()
+    try:
+        time.sleep(0.3)
+    finally:
+        sampler.stop()
+        stopped.set()
+        thread.join()
+    probe.run()
+    message = log.messages[-1]
+    assert message["category"] == "PROFILE"
+    assert message["samples"] > 10
+    assert 0 < message["overhead"] < 1
+    stacks = decode_profile(message["profile"])
+    assert sum(stacks.values()) >= message["samples"]
+    busy = [stack for stack in stacks if stack.endswith("test_profiler:_busy_loop")]
+    assert busy
+    assert busy[0].startswith("threading:Thread._bootstrap")
+    # Nothing sampled since the last run.
+    probe.run()
+    assert len(log.messages) == 1
+
+
+class _FakeClock(object):
+    """Replaces the clock and the stop event of a :class:`StackSampler`.
+    Every sample takes `cost` seconds, waiting advances the clock."""
+
+    def __init__(self, cost, samples):
+        self.now = 0.0
+        self.cost = cost
+        self.samples = samples
+
+    def perf_counter(self):
+        return self.now
+
+    def sample(self):
+        self.now += self.cost
+        self.samples -= 1
+
+    def is_set(self):
+        return self.samples <= 0
+
+    def wait(self, timeout):
+        self.now += timeout
+
+
+def _overhead(monkeypatch, max_overhead, rate=10000):
+    """Will return the fraction of the time spent sampling."""
+    sampler = StackSampler(rate=rate, max_overhead=max_overhead)
+    clock = _FakeClock(0.001, 100)
+    monkeypatch.setattr(time, "perf_counter", clock.perf_counter)
+    monkeypatch.setattr(sampler, "sample", clock.sample)
+    sampler._stopped = clock
+    sampler._run()
+    return sampler._busy / clock.now
+
+
+def test_overhead_cap(monkeypatch):
+    assert _overhead(monkeypatch, 0) == 1.0
+    assert _overhead(monkeypatch, 0.002) == pytest.approx(0.002)
+    assert _overhead(monkeypatch, 0.05) == pytest.approx(0.05)
+    # The rate is kept if the cap allows it.
+    assert _overhead(monkeypatch, 0.05, rate=10) == pytest.approx(0.01)
+    sampler = StackSampler()
+    with pytest.raises(ValueError):
+        sampler.set_rate(0)
+    sampler.set_rate(5, max_overhead=0.05)
+    assert (sampler.rate, sampler.max_overhead) == (5, 0.05)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_runtime
+----------------------------------
+
+Tests for `tedega_share.runtime` module.
+"""
+import asyncio
+import gc
+import time
+from tedega_share.runtime import GCMonitor, LoopMonitor, RuntimeProbe
+
+
+def _blocking_callback():
+    time.sleep(0.5)
+
+
+async def _serve():
+    await asyncio.sleep(0.2)
+    asyncio.get_running_loop().call_soon(_blocking_callback)
+    await asyncio.sleep(0.3)
+
+
+def test_gc(log):
+    monitor = GCMonitor()
+    probe = RuntimeProbe(log, monitor)
+    monitor.install()
+    try:
+        gc.collect(0)
+        gc.collect(2)
+        probe.run()
+    finally:
+        probe.stop()
+    assert monitor._callback not in gc.callbacks
+    stats = log.messages[-1]["gc"]
+    assert log.messages[-1]["category"] == "SYSTEM"
+    assert stats["0"]["count"] >= 1
+    assert stats["2"]["count"] >= 1
+    assert 0 < stats["2"]["max"] < 10
+    assert "collected" in stats["2"]
+    # Reset after every run.
+    probe.run()
+    assert "2" not in log.messages[-1]["gc"]
+
+
+def test_loop(log):
+    loop = asyncio.new_event_loop()
+    monitor = LoopMonitor(loop, heartbeat=0.05, threshold=0.2)
+    probe = RuntimeProbe(log, loop_monitor=monitor)
+    monitor.start()
+    try:
+        loop.run_until_complete(_serve())
+    finally:
+        probe.stop()
+        loop.close()
+    probe.run()
+    stats = log.messages[-1]["loop"]
+    assert stats["count"] > 3
+    assert stats["max"] >= 0.4
+    blocked = stats["blocked"]
+    assert len(blocked) == 1
+    assert blocked[0]["lag"] >= 0.4
+    assert blocked[0]["stack"][-1].endswith("in _blocking_callback")
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sampling
+----------------------------------
+
+Tests for `tedega_share.sampling` module.
+"""
+import logging
+import time
+from tedega_share.sampling import Policy, Sampler, TokenBucket
+
+
+def test_policy_lookup():
+    request, debug, both = Policy(0.5), Policy(0.1), Policy(0)
+    sampler = Sampler({"REQUEST": request, logging.DEBUG: debug,
+                       ("REQUEST", logging.ERROR): both})
+    assert sampler.policy("REQUEST", logging.INFO) is request
+    assert sampler.policy("REQUEST", logging.ERROR) is both
+    assert sampler.policy("AUTH", logging.DEBUG) is debug
+    assert sampler.policy("AUTH", logging.INFO) is None
+    sampler.set_policy("REQUEST", None)
+    assert sampler.policy("REQUEST", logging.INFO) is None
+
+
+def test_sample_by_correlation_id(log):
+    log.add_filter(Sampler({"REQUEST": Policy(0.5, by_correlation_id=True)}))
+    for i in range(200):
+        for _ in range(3):
+            log.info("request", "REQUEST", correlation_id=str(i))
+    log.info("other", "AUTH")
+    kept = [m for m in log.messages if m["category"] == "REQUEST"]
+    ids = set(m["correlation_id"] for m in kept)
+    # All or none of the messages of a request are kept.
+    assert len(kept) == 3 * len(ids)
+    assert 60 < len(ids) < 140
+    assert all(m["sample_rate"] == 0.5 for m in kept)
+    assert "sample_rate" not in log.messages[-1]
+
+
+def test_rate_limit(log):
+    sampler = Sampler(default=Policy(limit=10, burst=5))
+    log.add_filter(sampler)
+    for i in range(100):
+        log.info({"i": i})
+    assert len(log.messages) == 5
+    assert sampler.stats() == {(None, logging.INFO): 95}
+    log.remove_filter(sampler)
+    log.info("unfiltered")
+    assert len(log.messages) == 6
+
+
+def test_token_bucket(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    bucket = TokenBucket(1000, burst=10)
+    rates = []
+    for _ in range(100):
+        rates.append(bucket.allow())
+        # Half a token per event
+        now[0] += 0.0005
+    assert rates[0] == 1.0
+    # The burst and 99 * 0.5 tokens
+    assert sum(1 for rate in rates if rate) == 59
+    assert rates[19] == 0
+    # 20 of 21 events are allowed.
+    assert rates[20] == 20 / 21
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sinks
+----------------------------------
+
+Tests for `tedega_share.sinks` module.
+"""
+import gzip
+import io
+import json
+import logging
+import os
+import threading
+from tedega_share import logger
+from tedega_share.encoder import EnvelopeEncoder
+from tedega_share.handler import AsyncHandler
+from tedega_share.sinks import FileSink, StreamSink, record_line
+from tedega_share.testing import FakeFluentd
+
+
+def _record(msg, level=logging.INFO):
+    return logging.LogRecord("test", level, __file__, 0, msg, None, None)
+
+
+class SlowSink(StreamSink):
+
+    def __init__(self, gate):
+        StreamSink.__init__(self, io.StringIO())
+        self.gate = gate
+
+    def emit_batch(self, records):
+        self.gate.wait()
+        StreamSink.emit_batch(self, records)
+
+
+def test_record_line():
+    envelope = EnvelopeEncoder("xxx", "host").envelope({"a": 1}, "CUSTOM")
+    record = _record(envelope)
+    line = record_line(record)
+    assert record_line(record) is line
+    data = json.loads(line.decode("utf-8"))
+    assert data["level"] == "INFO"
+    assert data["service"] == "xxx"
+    assert data["category"] == "CUSTOM"
+    assert data["a"] == 1
+    assert json.loads(record_line(_record("plain %s")).decode("utf-8"))["message"] == "plain %s"
+
+
+def test_stream_sink_level_and_isolation():
+    gate = threading.Event()
+    slow = AsyncHandler(SlowSink(gate))
+    stream = io.StringIO()
+    sink = StreamSink(stream, level=logging.WARNING)
+    fast = AsyncHandler(sink)
+    fast.setLevel(sink.level)
+    python_logger = logging.getLogger("test_sinks")
+    python_logger.setLevel(logging.DEBUG)
+    python_logger.propagate = False
+    python_logger.handlers = [slow, fast]
+    python_logger.info("info")
+    python_logger.error("error")
+    # The blocked sink does not stall the other.
+    fast.flush()
+    assert [json.loads(line)["message"] for line in stream.getvalue().splitlines()] == ["error"]
+    gate.set()
+    slow.close()
+    fast.close()
+    assert len(slow.target.stream.getvalue().splitlines()) == 2
+
+
+def test_file_sink_rotation(tmpdir):
+    path = str(tmpdir.join("service.log"))
+    sink = FileSink(path, max_bytes=300, backup_count=2)
+    for i in range(3):
+        sink.emit_batch([_record("x" * 50) for _ in range(3)])
+    sink.emit_batch([_record("last")])
+    sink.close()
+    assert sorted(os.listdir(str(tmpdir))) == ["service.log", "service.log.1.gz",
+                                               "service.log.2.gz"]
+    with gzip.open(path + ".1.gz") as f:
+        assert len(f.read().splitlines()) == 3
+    with open(path) as f:
+        assert json.loads(f.read())["message"] == "last"
+
+
+def test_init_logger_sinks(tmpdir):
+    stream = io.StringIO()
+    path = str(tmpdir.join("service.log"))
+    with FakeFluentd(ack=False) as server:
+        logger.init_logger("test_sinks", host="127.0.0.1", port=server.port,
+                           sinks=[StreamSink(stream), FileSink(path)])
+        log = logger.get_logger()
+        try:
+            log.info({"value": 1}, "CUSTOM")
+            for handler in log._logger.handlers:
+                handler.flush()
+            server.wait_for(1)
+            assert server.events[0][2]["value"] == 1
+            assert json.loads(stream.getvalue())["value"] == 1
+            with open(path) as f:
+                assert json.loads(f.read())["value"] == 1
+        finally:
+            for handler in log._logger.handlers:
+                handler.close()
+            log._logger.handlers = []
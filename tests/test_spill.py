@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_spill
+----------------------------------
+
+Tests for `tedega_share.spill` module.
+"""
+import os
+from tedega_share.spill import SpillBuffer, SpillReplayProbe
+
+
+def _replay(buffer):
+    return [data for data, _ in buffer.read(1 << 30)]
+
+
+def test_append_read_commit(tmpdir):
+    buffer = SpillBuffer(str(tmpdir), segment_size=64)
+    assert buffer.empty
+    buffer.extend([b"a" * 20, b"b" * 20, b"c" * 20])
+    assert buffer.stats()["segments"] == 2
+    entries = buffer.read(1)
+    assert [data for data, _ in entries] == [b"a" * 20]
+    buffer.commit(entries[-1][1], 1)
+    assert _replay(buffer) == [b"b" * 20, b"c" * 20]
+    buffer.commit(buffer.read(1 << 30)[-1][1], 2)
+    assert buffer.empty
+    # The replayed segment has been removed.
+    assert buffer.stats()["segments"] == 1
+    assert not buffer.append(b"x" * 64)
+
+
+def test_recovery(tmpdir):
+    buffer = SpillBuffer(str(tmpdir), segment_size=1024)
+    buffer.extend([b"first", b"second", b"third"])
+    buffer.commit(buffer.read(1)[0][1], 1)
+    buffer.close()
+    # A partly written entry at the end is ignored.
+    path = os.path.join(str(tmpdir), "0000000000.spill")
+    with open(path, "r+b") as f:
+        f.seek(8 * 3 + len(b"firstsecondthird"))
+        f.write(b"\x05\x00\x00\x00\x01\x02\x03\x04ab")
+    buffer = SpillBuffer(str(tmpdir), segment_size=1024)
+    assert _replay(buffer) == [b"second", b"third"]
+    buffer.append(b"fourth")
+    assert _replay(buffer) == [b"second", b"third", b"fourth"]
+
+
+def test_bounded(tmpdir):
+    buffer = SpillBuffer(str(tmpdir), segment_size=32, max_segments=2)
+    for i in range(10):
+        buffer.append(b"%020d" % i)
+    assert buffer.stats()["dropped"] == 8
+    assert len(os.listdir(str(tmpdir))) <= 3
+    assert _replay(buffer) == [b"%020d" % 8, b"%020d" % 9]
+
+
+def test_replay(tmpdir):
+    buffer = SpillBuffer(str(tmpdir))
+    buffer.extend([b"one", b"two", b"three"])
+    sent = []
+
+    def send(data):
+        if data == b"three" and len(sent) < 3:
+            sent.append(None)
+            return False
+        sent.append(data)
+        return True
+
+    probe = SpillReplayProbe(buffer, send, rate=1024)
+    probe.run()
+    assert sent == [b"one", b"two", None]
+    assert not buffer.empty
+    probe.run()
+    assert sent[-1] == b"three"
+    assert buffer.empty
+    assert buffer.stats()["replayed"] == 3
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_system
+----------------------------------
+
+Tests for `tedega_share.system` module.
+"""
+import time
+from tedega_share.system import CpuMeter, SystemSampler
+
+
+def test_sample():
+    sampler = SystemSampler()
+    sum(i * i for i in range(200000))
+    time.sleep(0.05)
+    started_at = time.monotonic()
+    sample = sampler.sample()
+    # Taking a sample does not block.
+    assert time.monotonic() - started_at < 1
+    assert 0 <= sample["cpu"] <= 100
+    assert len(sample["cpus"]) >= 1
+    assert all(0 <= cpu <= 100 for cpu in sample["cpus"])
+    for key in ("memory", "swap", "disk"):
+        assert 0 <= sample[key] <= 100
+    assert "/" in sample["filesystems"]
+    assert sample["ctx_switches"] >= 0
+    assert sample["net_io"]["bytes_sent"] >= 0
+
+
+def test_cpu_meter():
+    meter = CpuMeter()
+    sum(i * i for i in range(200000))
+    assert 0 <= meter() <= 100
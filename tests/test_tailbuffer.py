@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_tailbuffer
+----------------------------------
+
+Tests for `tedega_share.tailbuffer` module.
+"""
+from tedega_share.tailbuffer import TailBuffer
+from tedega_share.tracing import span
+
+
+def _messages(log):
+    return [(m["correlation_id"], m.get("message", m.get("status"))) for m in log.messages]
+
+
+def test_flush_on_failure(log):
+    tail = TailBuffer(log, max_records=2)
+    log.add_filter(tail)
+    for cid in ("ok", "error", "status"):
+        for i in range(3):
+            log.debug("step %s" % i, correlation_id=cid)
+    log.warning("warning", correlation_id="ok")
+    log.info(200, "RETURNCODE", correlation_id="ok")
+    log.error("failed", correlation_id="error")
+    log.debug("after", correlation_id="error")
+    log.info({"status": 503}, "RETURNCODE", correlation_id="status")
+    log.debug("no request")
+    log.info("no request")
+    assert _messages(log) == [
+        ("ok", "warning"), ("ok", 200),
+        ("error", "step 1"), ("error", "step 2"), ("error", "failed"), ("error", "after"),
+        ("status", "step 1"), ("status", "step 2"), ("status", 503),
+        (None, "no request")]
+    assert "logged_at" in log.messages[2]
+    assert tail.stats() == {"buffered": 9, "written": 4, "discarded": 5, "pending": 0}
+
+
+def test_latency_and_limit(log):
+    tail = TailBuffer(log, max_total=3, latency=1.0)
+    log.add_filter(tail)
+    log.info("fast", correlation_id="a")
+    tail.finish("a", duration=0.1)
+    log.info("slow", correlation_id="b")
+    tail.finish("b", duration=2.0)
+    assert _messages(log) == [("b", "slow")]
+    for cid in "cdef":
+        log.info("x", correlation_id=cid)
+    # The oldest request has been discarded.
+    assert tail.stats()["pending"] == 3
+    tail.finish("c", failed=True)
+    assert len(log.messages) == 1
+
+
+def test_after_end(log):
+    tail = TailBuffer(log)
+    log.add_filter(tail)
+    log.info(200, "RETURNCODE", correlation_id="ok")
+    log.info(500, "RETURNCODE", correlation_id="failed")
+    # E.g the spans, which are logged after the request ended
+    log.info("span", "PROCTIME", correlation_id="ok")
+    log.debug("late", correlation_id="ok")
+    log.debug("late", correlation_id="failed")
+    assert _messages(log) == [("ok", 200), ("failed", 500), ("ok", "span"), ("failed", "late")]
+    assert tail.stats()["pending"] == 0
+
+
+def test_span_of_buffered_messages(log):
+    tail = TailBuffer(log)
+    log.add_filter(tail)
+    with span("load") as load:
+        log.debug("step", correlation_id="error")
+    log.debug("no span", correlation_id="error")
+    with span("render") as render:
+        log.error("failed", correlation_id="error")
+    assert [m.get("span_id") for m in log.messages] == [load.span_id, None, render.span_id]
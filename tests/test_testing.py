@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_testing
+----------------------------------
+
+Tests for `tedega_share.testing` module.
+"""
+import gzip
+import socket
+import msgpack
+from fluent import sender
+from tedega_share.testing import FakeFluentd, decode
+
+
+def test_decode():
+    entries = msgpack.packb([1, {"a": 1}]) + msgpack.packb([2, {"a": 2}])
+    expected = [("t", 1, {"a": 1}), ("t", 2, {"a": 2})]
+    assert decode(["t", 1, {"a": 1}]) == ([("t", 1, {"a": 1})], {})
+    assert decode(["t", [[1, {"a": 1}], [2, {"a": 2}]]]) == (expected, {})
+    assert decode(["t", entries, {"size": 2}])[0] == expected
+    option = {"compressed": "gzip"}
+    assert decode(["t", gzip.compress(entries), option]) == (expected, option)
+
+
+def test_fluent_sender():
+    with FakeFluentd() as fluentd:
+        fluent = sender.FluentSender("app", host=fluentd.host, port=fluentd.port,
+                                     nanosecond_precision=True)
+        fluent.emit("test", {"a": 1})
+        assert fluentd.wait_for(1)
+        tag, timestamp, record = fluentd.events[0]
+        assert tag == "app.test"
+        assert isinstance(timestamp, float)
+        assert record == {"a": 1}
+        fluent.close()
+
+
+def test_ack_and_failure():
+    with FakeFluentd(failure_rate=1.0) as fluentd:
+        conn = socket.create_connection((fluentd.host, fluentd.port))
+        conn.sendall(msgpack.packb(["t", 1, {}, {"chunk": "abc"}]))
+        assert conn.recv(100) == b""
+        assert fluentd.stats["failures"] == 1
+        fluentd.failure_rate = 0
+        conn = socket.create_connection((fluentd.host, fluentd.port))
+        conn.sendall(msgpack.packb(["t", 1, {}, {"chunk": "abc"}]))
+        assert msgpack.unpackb(conn.recv(100), raw=False) == {"ack": "abc"}
+        assert fluentd.events == [("t", 1, {})]
+        conn.close()
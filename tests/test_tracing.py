@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_tracing
+----------------------------------
+
+Tests for `tedega_share.tracing` module.
+"""
+import asyncio
+import pytest
+from tedega_share import logger
+from tedega_share.tracing import span, get_correlation_id, set_correlation_id, reset_correlation_id
+
+
+@pytest.fixture
+def messages(log, monkeypatch):
+    monkeypatch.setattr(logger, "log", log)
+    return log.messages
+
+
+def test_nested_spans(messages):
+    @span("outer")
+    def outer():
+        logger.log.info("inside")
+        with span("inner"):
+            pass
+        with pytest.raises(ValueError):
+            with span("failing"):
+                raise ValueError()
+        return get_correlation_id()
+
+    correlation_id = outer()
+    assert correlation_id is not None
+    assert get_correlation_id() is None
+    inside, tree = messages
+    assert inside["correlation_id"] == correlation_id
+    assert inside["span_id"] == tree["span"]["span_id"]
+    assert tree["correlation_id"] == correlation_id
+    assert tree["category"] == "PROCTIME"
+    assert tree["span"]["name"] == "outer"
+    inner, failing = tree["span"]["children"]
+    assert inner["name"] == "inner"
+    assert failing["error"] == "ValueError"
+    assert 0 <= inner["start"] <= failing["start"] <= tree["span"]["time"]
+
+
+def test_given_correlation_id(messages):
+    token = set_correlation_id("123")
+    with span("request"):
+        logger.log.info("inside")
+    reset_correlation_id(token)
+    assert [m["correlation_id"] for m in messages] == ["123", "123"]
+
+
+def test_async_spans(messages):
+    @span("task")
+    async def task(i):
+        await asyncio.sleep(0.01 * i)
+
+    @span("request")
+    async def request():
+        await asyncio.gather(task(1), task(2))
+
+    asyncio.run(request())
+    tree = messages[0]["span"]
+    assert [child["name"] for child in tree["children"]] == ["task", "task"]